@@ -0,0 +1,226 @@
+# bench.py
+#  - time every pipeline step on a synthetic gallery set and compare to a baseline
+#
+# topaz_bench generates (or reuses) a synthetic gallery set for a scale, runs the whole
+# pipeline on it with every step forced, CPU only and a short training schedule, and
+# writes the step timings to a results JSON:
+#
+#   {"scale": ..., "dataset": {...}, "settings": {...}, "environment": {...},
+#    "steps": {"preprocess": 12.3, ...}, "total": 123.4}
+#
+# With --baseline the timings are compared to an earlier results file.  A step
+# regresses when it is more than --threshold (fraction) slower and at least
+# --min-seconds slower than the baseline; any regression makes topaz_bench exit 1.
+# --save-baseline writes the results as the new baseline.  No baselines are shipped,
+# record one on the machine the comparisons will run on.
+#
+# Usage - $ topaz_bench --scale small --workdir /tmp/topaz_bench --save-baseline benchmarks/baselines/small.json
+#         $ topaz_bench --scale small --workdir /tmp/topaz_bench --baseline benchmarks/baselines/small.json
+#
+
+import json
+import os
+import platform
+import shutil
+import sys
+import time
+
+import click
+
+from benchmarks import synthetic
+from scripts import parameters_factory as pf
+from scripts import step_cache as sc
+from scripts import topaz_run as tr
+
+#
+# bench_config()
+# a topaz_run configuration for the synthetic gallery set under workdir
+#
+def bench_config(workdir, galleries, rows, cols, box_size, epochs, epoch_size, execution_mode, workers):
+
+    downsampling = 2 if box_size >= 64 else 1
+    return {
+        "experiment": {"specimen": "synthetic", "session": "bench", "run": "run001", "slabPickRun": "run001"},
+        "input": {
+            "base_program_path": os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+            "base_project_path": workdir,
+            "rawdata_images": "{base_project_path}/gallery/*.mrc",
+            "rawdata_particles": "{base_project_path}/gallery/particles.txt",
+        },
+        "output": {
+            "file_save_model_path": "{base_project_path}/{run}/models",
+            "dir": "{base_project_path}/{run}",
+        },
+        "pipeline": {
+            "run_calculate_centers": "yes",
+            "run_preprocess": "yes",
+            "run_convert": "yes",
+            "run_split_test_train": "yes",
+            "run_train": "yes",
+            "run_extract": "yes",
+            "run_visualize_picks": "yes",
+            "run_evaluate_picks": "yes",
+        },
+        "parameters": {
+            "boxSize": box_size,
+            "downsampling": downsampling,
+            "number_of_held_out_test_images": max(1, galleries // 4),
+            "number_of_predicted_particles": rows * cols,
+            "number_workers": workers,
+            "train_radius": 3,
+            "extract_radius": max(2, box_size // (3 * downsampling)),
+            "number_of_images_to_visualize": 2,
+            "display_plots": "no",
+            "score": 0,
+            "preprocess_workers": workers,
+            "extract_workers": workers,
+            "execution_mode": execution_mode,
+            "number_of_epochs": epochs,
+            "epoch_size": epoch_size,
+        },
+    }
+
+def environment():
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "topaz": sc.topaz_version(),
+    }
+
+#
+# run_benchmark()
+# run the pipeline repeat times on a fresh output directory, keep the fastest time
+# of every step
+#
+def run_benchmark(sys_params, config_file, repeat):
+
+    best = {}
+    for _ in range(repeat):
+        user_params = pf.read_topaz_parameters(config_file)
+        if os.path.exists(user_params.output.dir):
+            shutil.rmtree(user_params.output.dir)
+        tr.ensure_directory_exists(user_params.output.dir)
+
+        status, errors, durations = tr.run_pipeline(sys_params, user_params, ("all",))
+        if errors:
+            raise click.ClickException("pipeline failed in " + ", ".join(errors))
+        for step, duration in durations.items():
+            if duration is None:
+                continue
+            best[step] = min(duration, best.get(step, duration))
+    return {step: round(best[step], 3) for step in tr.PIPELINE_STEPS if step in best}
+
+#
+# compare()
+# rows of (step, baseline, current, change, regressed)
+#
+def compare(baseline, results, threshold, min_seconds):
+
+    rows = []
+    for step, current in results["steps"].items():
+        if step not in baseline["steps"]:
+            continue
+        base = baseline["steps"][step]
+        change = (current - base) / base if base > 0 else 0.0
+        regressed = current > base * (1 + threshold) and current - base >= min_seconds
+        rows.append((step, base, current, change, regressed))
+    return rows
+
+@click.command(context_settings={"show_default": True})
+@click.option("--scale", type=click.Choice(list(synthetic.SCALES)), default="small", help="preset gallery set size")
+@click.option("--galleries", type=int, default=None, help="number of galleries, overrides the scale")
+@click.option("--grid", type=(int, int), default=None, help="rows and columns per gallery, overrides the scale")
+@click.option("--box-size", type=int, default=None, help="tile size in pixels, overrides the scale")
+@click.option("--seed", type=int, default=0, help="seed of the synthetic data")
+@click.option("--workdir", default="topaz_bench", help="directory for the synthetic data, run output and logs")
+@click.option("--epochs", type=int, default=2, help="topaz train epochs")
+@click.option("--epoch-size", type=int, default=50, help="topaz train parameter updates per epoch")
+@click.option("--execution-mode", type=click.Choice(["subprocess", "inprocess"]), default="subprocess")
+@click.option("--workers", type=int, default=1, help="preprocess/extract workers and train data loader workers")
+@click.option("--repeat", type=int, default=1, help="runs per step, the fastest is reported")
+@click.option("--output", default=None, help="results JSON, default <workdir>/results.json")
+@click.option("--baseline", default=None, help="baseline results JSON to compare against")
+@click.option("--threshold", type=float, default=0.25, help="allowed slowdown per step as a fraction")
+@click.option("--min-seconds", type=float, default=1.0, help="slowdowns smaller than this are never regressions")
+@click.option("--save-baseline", default=None, help="also write the results to this baseline file")
+def topaz_bench(scale, galleries, grid, box_size, seed, workdir, epochs, epoch_size, execution_mode,
+                workers, repeat, output, baseline, threshold, min_seconds, save_baseline):
+
+    # CPU only, nothing is downloaded
+    os.environ["CUDA_VISIBLE_DEVICES"] = ""
+
+    default_galleries, rows, cols, default_box_size = synthetic.SCALES[scale]
+    galleries = galleries or default_galleries
+    rows, cols = grid or (rows, cols)
+    box_size = box_size or default_box_size
+    dataset = {"galleries": galleries, "rows": rows, "cols": cols, "box_size": box_size, "seed": seed}
+
+    workdir = os.path.abspath(workdir)
+    os.makedirs(workdir, exist_ok=True)
+    sys_params = tr.Sys_Params()
+    log = tr.initialize_logging(sys_params, os.path.join(workdir, "bench_event.log"),
+                                os.path.join(workdir, "bench_perf.log"))
+
+    # the data set is regenerated only when its description changes
+    dataset_file = os.path.join(workdir, "dataset.json")
+    existing = None
+    if os.path.exists(dataset_file):
+        with open(dataset_file, "r") as f:
+            existing = json.load(f)
+    if existing != dataset:
+        start_time = time.time()
+        if os.path.exists(os.path.join(workdir, "gallery")):
+            shutil.rmtree(os.path.join(workdir, "gallery"))
+        synthetic.make_gallery_set(workdir, galleries, rows, cols, box_size, seed)
+        with open(dataset_file, "w") as f:
+            json.dump(dataset, f)
+        log.loginfo("topaz_bench", f"generated {galleries} galleries in {time.time() - start_time:.2f} seconds")
+
+    config_file = os.path.join(workdir, "bench_params.json")
+    with open(config_file, "w") as f:
+        json.dump(bench_config(workdir, galleries, rows, cols, box_size, epochs, epoch_size,
+                               execution_mode, workers), f, indent=4)
+
+    steps = run_benchmark(sys_params, config_file, repeat)
+    results = {
+        "scale": scale,
+        "dataset": dataset,
+        "settings": {"epochs": epochs, "epoch_size": epoch_size, "execution_mode": execution_mode,
+                     "workers": workers, "repeat": repeat},
+        "environment": environment(),
+        "steps": steps,
+        "total": round(sum(steps.values()), 3),
+    }
+
+    output = output or os.path.join(workdir, "results.json")
+    for path in [output] + ([save_baseline] if save_baseline else []):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(results, f, indent=4)
+
+    for step, seconds in steps.items():
+        click.echo(f"{step:20s} {seconds:10.2f} s")
+    click.echo(f"{'total':20s} {results['total']:10.2f} s")
+
+    if baseline:
+        with open(baseline, "r") as f:
+            baseline_results = json.load(f)
+        if baseline_results.get("dataset") != dataset or baseline_results.get("settings") != results["settings"]:
+            click.echo("warning: the baseline was recorded with a different data set or settings")
+        regressions = 0
+        click.echo(f"{'step':20s} {'baseline':>10s} {'current':>10s} {'change':>8s}")
+        for step, base, current, change, regressed in compare(baseline_results, results, threshold, min_seconds):
+            regressions += regressed
+            click.echo(f"{step:20s} {base:10.2f} {current:10.2f} {100 * change:7.1f}%" +
+                       ("  REGRESSION" if regressed else ""))
+        log.close()
+        if regressions:
+            sys.exit(1)
+        return
+
+    log.close()
+
+if __name__ == "__main__":
+    topaz_bench()
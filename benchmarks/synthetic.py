@@ -0,0 +1,88 @@
+# synthetic.py
+#  - synthetic slabpick-style gallery sets for benchmarks
+#
+# Each gallery is a rows x cols grid of box_size tiles assembled with
+# make_test_grid.create_grid_image.  A tile holds one dark, slightly blurred disk
+# (the "particle") on Gaussian noise, except for the trailing empty cells of the last
+# gallery, which only hold noise, like the padding slabpick leaves.  Everything is
+# drawn from a seeded RNG, so a scale and seed always produce the same files.
+#
+# Output layout (same as a slabpick gallery directory):
+#   <out>/gallery/particles_000.mrc ...
+#   <out>/gallery/particle_map.csv   - tomogram,particle,gallery,row,col
+#   <out>/gallery/particles.txt      - image_name,x_coord,y_coord of the occupied cells
+#
+
+import csv
+import os
+
+import mrcfile
+import numpy as np
+
+from scripts import calc_centers
+from scripts import make_test_grid
+
+# galleries, rows, cols, box_size
+SCALES = {
+    "tiny": (4, 8, 8, 32),
+    "small": (12, 8, 8, 64),
+    "medium": (48, 16, 15, 64),
+    "large": (200, 16, 15, 88),
+}
+
+def particle_tile(rng, box_size):
+    """
+    One box_size x box_size tile with a dark disk of radius box_size / 5 at a
+    slightly jittered center, on the 0.5 +- 0.1 background create_grid_image uses.
+    """
+    y, x = np.mgrid[0:box_size, 0:box_size].astype(np.float32)
+    center = box_size / 2 + rng.uniform(-1.5, 1.5, size=2)
+    radius = box_size / 5
+    distance = np.hypot(x - center[0], y - center[1])
+    disk = 1 / (1 + np.exp((distance - radius) / 1.5))
+    tile = rng.normal(0.5, 0.1, (box_size, box_size)) - 0.35 * disk
+    return tile.astype(np.float32)
+
+def noise_tile(rng, box_size):
+    return rng.normal(0.5, 0.1, (box_size, box_size)).astype(np.float32)
+
+#
+# make_gallery_set()
+# write galleries, particle_map.csv and particles.txt under out_dir/gallery.
+# The last gallery has empty_rows rows without particles.
+#
+# return:
+# the gallery directory
+#
+def make_gallery_set(out_dir, galleries, rows, cols, box_size, seed=0, empty_rows=2):
+
+    rng = np.random.default_rng(seed)
+    gallery_dir = os.path.join(out_dir, "gallery")
+    os.makedirs(gallery_dir, exist_ok=True)
+    empty_rows = min(empty_rows, rows - 1)
+
+    with open(os.path.join(gallery_dir, "particle_map.csv"), "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["tomogram", "particle", "gallery", "row", "col"])
+        particle = 0
+        for gallery in range(galleries):
+            occupied_rows = rows - empty_rows if gallery == galleries - 1 else rows
+            tiles = []
+            for row in range(rows):
+                for col in range(cols):
+                    if row < occupied_rows:
+                        tiles.append(particle_tile(rng, box_size))
+                        writer.writerow(["synthetic", particle, gallery, row, col])
+                        particle += 1
+                    else:
+                        tiles.append(noise_tile(rng, box_size))
+
+            # create_grid_image draws its background from the global numpy RNG
+            np.random.seed(seed + gallery)
+            image = make_test_grid.create_grid_image(tiles, rows, cols, {1: (box_size, box_size)})
+            with mrcfile.new(os.path.join(gallery_dir, f"particles_{gallery:03d}.mrc"), overwrite=True) as mrc:
+                mrc.set_data(image.astype(np.float32))
+
+    calc_centers.calculate_occupied_centers(os.path.join(gallery_dir, "particle_map.csv"), gallery_dir,
+                                            os.path.join(gallery_dir, "particles.txt"))
+    return gallery_dir
@@ -1,58 +1,163 @@
 import os
+import re
+import glob
+import mrcfile
+import numpy as np
+import pandas as pd
 
-def calculate_centers(grid_size, image_size, project_name, output_file):
+def gallery_dimensions(paths):
+    """
+    Read (nx, ny) from the header of each gallery MRC file.
+
+    Returns an (n, 2) integer array.
+    """
+    dimensions = np.empty((len(paths), 2), dtype=np.int64)
+    for i, path in enumerate(paths):
+        with mrcfile.open(path, permissive=True, header_only=True) as mrc:
+            dimensions[i] = (int(mrc.header.nx), int(mrc.header.ny))
+    return dimensions
+
+def calculate_centers(rows, cols, raw_images_dir, output_file, image_size=None, chunk_galleries=4096):
     """
     Calculate the center coordinates of each image in a grid and save to a file.
 
+    The row/column grid is built once with NumPy and scaled by the tile size of each
+    gallery, which is read from its own MRC header (nx / cols, ny / rows) unless
+    image_size is given.  Galleries are processed chunk_galleries at a time and each
+    chunk is written with a single bulk write, so memory stays bounded for tens of
+    thousands of galleries.
+
     Parameters:
-    - grid_size: Tuple (rows, cols) specifying the number of rows and columns in the grid.
-    - image_size: Tuple (width, height) specifying the size of each image in pixels.
-    - project_name: String specifying the directory name for the project
+    - rows, cols: number of rows and columns in the grid of every gallery.
+    - raw_images_dir: directory holding the gallery .mrc files.
     - output_file: String specifying the filename to save the coordinates.
+    - image_size: optional tuple (width, height) of each image in pixels for all galleries.
+    - chunk_galleries: number of galleries written per bulk write.
 
+    Returns the number of centers written.
     """
-    # Unpack grid_size
-    rows, cols = grid_size
+    paths = sorted(glob.glob(os.path.join(raw_images_dir, "*.mrc")))
+    if not paths:
+        raise FileNotFoundError("No MRC files found in " + raw_images_dir)
 
-    # Unpack image_size
-    img_width, img_height = image_size
+    # grid positions in row-major order, computed once for every gallery
+    grid_row, grid_col = np.divmod(np.arange(rows * cols), cols)
 
-    # Initialize list to store image identifiers and centers
-    data = []
+    count = 0
+    with open(output_file, 'w') as f:
+        f.write("image_name\tx_coord\ty_coord\n")
+        for start in range(0, len(paths), chunk_galleries):
+            chunk = paths[start:start + chunk_galleries]
+            names = [os.path.splitext(os.path.basename(path))[0] for path in chunk]
+            if image_size is None:
+                dimensions = gallery_dimensions(chunk)
+                img_width = dimensions[:, 0] // cols
+                img_height = dimensions[:, 1] // rows
+            else:
+                img_width = np.full(len(chunk), image_size[0])
+                img_height = np.full(len(chunk), image_size[1])
 
-    # Iterate over each file name
-    for filename in os.listdir("/home/phil.smoot/projects/phil.smoot/raw_data/curated_ml_challenge/" + project_name ):
+            # one row of centers per gallery, then flattened gallery-major
+            center_x = grid_col[np.newaxis, :] * img_width[:, np.newaxis] + (img_width // 2)[:, np.newaxis]
+            center_y = grid_row[np.newaxis, :] * img_height[:, np.newaxis] + (img_height // 2)[:, np.newaxis]
+            table = pd.DataFrame({
+                "image_name": np.repeat(names, rows * cols),
+                "x_coord": center_x.ravel(),
+                "y_coord": center_y.ravel(),
+            })
+            table.to_csv(f, sep="\t", header=False, index=False)
+            count += len(table)
 
-        if filename.endswith('.mrc'):
-            # Iterate over each grid position
-            for row in range(rows):
-                for col in range(cols):
-                    # Calculate center of current image
-                    center_x = col * img_width + img_width // 2
-                    center_y = row * img_height + img_height // 2
-                
-                    base_name = os.path.splitext(filename)[0]
-                    # Append to data list
-                    data.append((base_name, center_x, center_y))
+    return count
 
-    # Write data to the output file
-    with open(output_file, 'w') as f:
-        # write the header
-        var1 = "image_name"
-        var2 = "x_coord"
-        var3 = "y_coord"
-        f.write(f"{var1}\t{var2}\t{var3}\n")
-        # write the data
-        for item in data:
-            f.write(f"{item[0]}\t{item[1]}\t{item[2]}\n")
-
-    print(f"Center coordinates saved to '{output_file}'")
-
-# Example usage:
-# calculate_centers((16, 15), (88, 88), 'ml_challenge', 'particles_88x88, ml_challenge.txt')
-# calculate_centers((16, 15), (88, 88), 'ml_challenge_with_junk', 'particles_88x88, ml_challenge_with_junk.txt')
-calculate_centers((16, 15), (64, 64), 'apo-ferritin', 'particles_64x64_apo.txt')
-calculate_centers((16, 15), (64, 64), 'beta-galactosidase', 'particles_64x64_beta_gal.txt')
-calculate_centers((16, 15), (80, 80), 'virus-like-particle', 'particles_80x80_virus.txt')
-calculate_centers((16, 15), (84, 84), 'thyroglobulin', 'particles_84x84_thg.txt')
-calculate_centers((16, 15), (88, 88), 'ribosome_iter1', 'particles_88x88_ribo.txt')
\ No newline at end of file
+def read_occupied_cells(particle_map):
+    """
+    Read the populated (gallery, row, col) cells of a slabpick particle_map.csv.
+
+    The map has 5 columns per row (tomogram, particle, gallery, row, col); only the
+    last 3 are parsed, in one pass, and duplicate cells are dropped.
+
+    Returns a DataFrame with integer columns gallery, row, col.
+    """
+    cells = pd.read_csv(particle_map, usecols=[2, 3, 4], dtype=np.int64)
+    cells.columns = ["gallery", "row", "col"]
+    return cells.drop_duplicates(ignore_index=True)
+
+def gallery_ids(paths):
+    """
+    Gallery id of each gallery file: the trailing digits of its name
+    (particles_007.mrc -> 7).
+
+    Raises ValueError when a name carries no id or two files have the same id.
+    """
+    ids = {}
+    for path in paths:
+        match = re.search(r"(\d+)$", os.path.splitext(os.path.basename(path))[0])
+        if match is None:
+            raise ValueError("gallery file " + path + " has no gallery id (trailing digits) in its name")
+        gallery = int(match.group(1))
+        if gallery in ids:
+            raise ValueError("gallery files " + ids[gallery] + " and " + path + " have the same gallery id")
+        ids[gallery] = path
+    return np.array(list(ids), dtype=np.int64)
+
+def calculate_occupied_centers(particle_map, raw_images_dir, output_file):
+    """
+    Calculate the center coordinates of only the populated grid cells listed in
+    particle_map.csv and save to a file.
+
+    The grid shape is the maximum row and column in the map.  Cells are joined to
+    the gallery files by gallery id and the tile size of each gallery is read from
+    its own MRC header.
+
+    Raises ValueError when a gallery of the map has no file, e.g. galleries numbered
+    from 0 in the map and from 1 in the file names, instead of shifting or dropping
+    particles.
+
+    Parameters:
+    - particle_map: path of the slabpick particle_map.csv.
+    - raw_images_dir: directory holding the gallery .mrc files.
+    - output_file: String specifying the filename to save the coordinates.
+
+    Returns the number of centers written.
+    """
+    paths = sorted(glob.glob(os.path.join(raw_images_dir, "*.mrc")))
+    if not paths:
+        raise FileNotFoundError("No MRC files found in " + raw_images_dir)
+
+    cells = read_occupied_cells(particle_map)
+    rows = int(cells["row"].max()) + 1
+    cols = int(cells["col"].max()) + 1
+
+    dimensions = gallery_dimensions(paths)
+    galleries = pd.DataFrame({
+        "gallery": gallery_ids(paths),
+        "image_name": [os.path.splitext(os.path.basename(path))[0] for path in paths],
+        "img_width": dimensions[:, 0] // cols,
+        "img_height": dimensions[:, 1] // rows,
+    })
+    missing = np.setdiff1d(cells["gallery"].unique(), galleries["gallery"])
+    if len(missing):
+        raise ValueError(f"{len(missing)} galleries of {particle_map} have no gallery file in {raw_images_dir} "
+                         f"(map galleries {cells['gallery'].min()}..{cells['gallery'].max()}, file ids "
+                         f"{galleries['gallery'].min()}..{galleries['gallery'].max()}, first missing {missing[0]})")
+    table = cells.merge(galleries, on="gallery", how="inner")
+    table.sort_values(["image_name", "row", "col"], inplace=True, kind="stable")
+
+    table["x_coord"] = table["col"] * table["img_width"] + table["img_width"] // 2
+    table["y_coord"] = table["row"] * table["img_height"] + table["img_height"] // 2
+    table.to_csv(output_file, sep="\t", index=False, columns=["image_name", "x_coord", "y_coord"])
+
+    return len(table)
+
+if __name__ == "__main__":
+    # Example usage:
+    # calculate_centers(16, 15, raw_data + 'ml_challenge', 'particles_88x88, ml_challenge.txt', (88, 88))
+    # calculate_centers(16, 15, raw_data + 'ml_challenge_with_junk', 'particles_88x88, ml_challenge_with_junk.txt', (88, 88))
+    raw_data = "/home/phil.smoot/projects/phil.smoot/raw_data/curated_ml_challenge/"
+    calculate_centers(16, 15, raw_data + 'apo-ferritin', 'particles_64x64_apo.txt', (64, 64))
+    calculate_centers(16, 15, raw_data + 'beta-galactosidase', 'particles_64x64_beta_gal.txt', (64, 64))
+    calculate_centers(16, 15, raw_data + 'virus-like-particle', 'particles_80x80_virus.txt', (80, 80))
+    calculate_centers(16, 15, raw_data + 'thyroglobulin', 'particles_84x84_thg.txt', (84, 84))
+    calculate_centers(16, 15, raw_data + 'ribosome_iter1', 'particles_88x88_ribo.txt', (88, 88))
+    print("Center coordinates saved")
@@ -0,0 +1,179 @@
+# evaluate_picks.py
+#  - precision / recall / F1 / average precision of predicted picks against ground truth
+#
+# Predicted picks are matched to ground truth picks of the same image within a
+# matching radius.  All ground truth picks go into one KD-tree; each image is shifted
+# along x by its own offset so picks of different images can never match.  Predictions
+# are matched from the highest score down, each to the nearest ground truth pick within
+# the radius that no higher scoring prediction took, so every ground truth pick counts
+# once and the matches above any threshold are the ones that threshold would make.
+#
+# The precision/recall curve over the whole score range is computed in one pass over
+# the predictions sorted by score, so 10^6 picks take seconds.
+#
+# Outputs
+#   <prefix>_curve.csv   - threshold, picks, true_positives, precision, recall, f1 at every
+#                          distinct score
+#   <prefix>_summary.csv - ground truth and pick counts, average precision, best F1 and
+#                          its threshold, and the metrics at the configured score
+#
+# Usage - $ topaz_evaluate -p predicted_particles.txt -t particles.txt -r 10 --images image_list_test.txt -o evaluation
+#
+
+import csv
+
+import click
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+
+#
+# match_picks()
+# flags the predictions that match a ground truth pick
+#
+# input:
+# predicted - DataFrame with image_name, x_coord, y_coord, score
+# truth - DataFrame with image_name, x_coord, y_coord
+# radius - matching radius in pixels
+#
+# return:
+# boolean array, True for predictions that are true positives
+#
+def match_picks(predicted, truth, radius):
+
+    matched = np.zeros(len(predicted), dtype=bool)
+    if len(predicted) == 0 or len(truth) == 0:
+        return matched
+
+    names = pd.Categorical(pd.concat([predicted.image_name, truth.image_name], ignore_index=True))
+    codes = names.codes.astype(np.float64)
+    predicted_codes, truth_codes = codes[:len(predicted)], codes[len(predicted):]
+
+    # images are laid side by side along x, further apart than the matching radius
+    extent = max(predicted.x_coord.max(), truth.x_coord.max()) - min(predicted.x_coord.min(), truth.x_coord.min())
+    spacing = float(extent) + 2 * radius + 1
+    truth_points = np.column_stack([truth.x_coord.to_numpy() + truth_codes * spacing, truth.y_coord.to_numpy()])
+    predicted_points = np.column_stack([predicted.x_coord.to_numpy() + predicted_codes * spacing,
+                                        predicted.y_coord.to_numpy()])
+
+    order = np.argsort(-predicted.score.to_numpy(), kind="stable")
+    in_range = cKDTree(truth_points).query_ball_point(predicted_points[order], radius)
+
+    # greedy by score: a prediction whose nearest pick is taken still takes a free one in range
+    taken = np.zeros(len(truth_points), dtype=bool)
+    for index, candidates in zip(order, in_range):
+        if not candidates:
+            continue
+        candidates = np.asarray(candidates)
+        candidates = candidates[~taken[candidates]]
+        if len(candidates) == 0:
+            continue
+        offsets = truth_points[candidates] - predicted_points[index]
+        nearest = candidates[np.argmin(np.einsum("ij,ij->i", offsets, offsets))]
+        taken[nearest] = True
+        matched[index] = True
+    return matched
+
+#
+# precision_recall_curve()
+# precision, recall and F1 at every distinct score, highest score first
+#
+def precision_recall_curve(scores, matched, num_truth):
+
+    order = np.argsort(-scores, kind="stable")
+    scores = scores[order]
+    true_positives = np.cumsum(matched[order])
+    picks = np.arange(1, len(scores) + 1)
+
+    # a threshold keeps every pick with an equal score, so report the last of each run
+    last = np.r_[scores[1:] != scores[:-1], True] if len(scores) else np.zeros(0, dtype=bool)
+    scores, true_positives, picks = scores[last], true_positives[last], picks[last]
+
+    precision = true_positives / picks
+    recall = true_positives / num_truth if num_truth else np.zeros(len(picks))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        f1 = np.where(precision + recall > 0, 2 * precision * recall / (precision + recall), 0.0)
+
+    return pd.DataFrame({"threshold": scores, "picks": picks, "true_positives": true_positives,
+                         "precision": precision, "recall": recall, "f1": f1})
+
+def average_precision(curve):
+    recall = curve.recall.to_numpy()
+    return float(np.sum(np.diff(np.r_[0.0, recall]) * curve.precision.to_numpy()))
+
+def read_picks(file_path):
+    picks = pd.read_csv(file_path, sep="\t", dtype={"image_name": str})
+    return picks.dropna(subset=["image_name"])
+
+def read_image_names(file_path):
+    return set(pd.read_csv(file_path, sep="\t", dtype={"image_name": str}).image_name)
+
+#
+# evaluate()
+# match, build the curve and write <output_prefix>_curve.csv and <output_prefix>_summary.csv
+#
+# images - optional set of image names to restrict the evaluation to (e.g. the test split)
+#
+# return:
+# the summary as a dict
+#
+def evaluate(predicted_particles, truth_particles, radius, output_prefix, images=None, score=0):
+
+    predicted = read_picks(predicted_particles)
+    truth = read_picks(truth_particles)
+    if images is not None:
+        predicted = predicted.loc[predicted.image_name.isin(images)]
+        truth = truth.loc[truth.image_name.isin(images)]
+
+    matched = match_picks(predicted, truth, radius)
+    curve = precision_recall_curve(predicted.score.to_numpy(), matched, len(truth))
+    curve.to_csv(output_prefix + "_curve.csv", index=False)
+
+    summary = {
+        "images": truth.image_name.nunique(),
+        "ground_truth": len(truth),
+        "picks": len(predicted),
+        "matched": int(matched.sum()),
+        "match_radius": radius,
+        "average_precision": average_precision(curve),
+        "best_f1": 0.0,
+        "best_f1_threshold": "",
+        "score": score,
+        "precision_at_score": 0.0,
+        "recall_at_score": 0.0,
+        "f1_at_score": 0.0,
+    }
+    if len(curve):
+        best = curve.f1.idxmax()
+        summary["best_f1"] = float(curve.f1[best])
+        summary["best_f1_threshold"] = float(curve.threshold[best])
+        above = curve.loc[curve.threshold >= score]
+        if len(above):
+            at_score = above.iloc[-1]
+            summary["precision_at_score"] = float(at_score.precision)
+            summary["recall_at_score"] = float(at_score.recall)
+            summary["f1_at_score"] = float(at_score.f1)
+
+    with open(output_prefix + "_summary.csv", "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=list(summary.keys()))
+        writer.writeheader()
+        writer.writerow(summary)
+
+    return summary
+
+@click.command(context_settings={"show_default": True})
+@click.option("-p", "--predicted", required=True, help="predicted particles (topaz extract output)")
+@click.option("-t", "--truth", required=True, help="ground truth particles, e.g. the converted particles.txt")
+@click.option("-r", "--radius", type=float, required=True, help="matching radius in pixels")
+@click.option("--images", default=None, help="image list (e.g. image_list_test.txt) to restrict the evaluation to")
+@click.option("-s", "--score", type=float, default=0, help="score threshold to report precision/recall at")
+@click.option("-o", "--output-prefix", default="evaluation", help="prefix of the _curve.csv and _summary.csv files")
+def evaluate_picks(predicted, truth, radius, images, score, output_prefix):
+
+    summary = evaluate(predicted, truth, radius, output_prefix,
+                       read_image_names(images) if images else None, score)
+    for key, value in summary.items():
+        click.echo(f"{key}: {value}")
+
+if __name__ == "__main__":
+    evaluate_picks()
@@ -0,0 +1,211 @@
+# executors.py
+#  - run pipeline steps as batch jobs with scheduler dependencies
+#
+# An executor takes Jobs in dependency order.  submit() returns a job id that later jobs
+# list in their after; a job starts once every job it depends on has completed
+# successfully (SLURM afterok), and is cancelled when one of them fails.  An array job
+# runs its command array_size times with SLURM_ARRAY_TASK_ID set to 0 .. array_size - 1.
+#
+#   SlurmExecutor - submits every job with sbatch, one job array per sharded step
+#   LocalExecutor - emulates the scheduler on this node: jobs and array tasks run as
+#                   child processes, started as soon as their dependencies completed and
+#                   their cpus fit into the node's free cpus
+#
+# resources of a job (all optional):
+#   {"cpus": 8, "mem": "32G", "time": "04:00:00", "gpus": 1, "partition": "gpu",
+#    "account": "...", "extra": ["--qos=high"]}
+#
+
+import os
+import re
+import shlex
+import subprocess
+import time
+
+COMPLETED = "COMPLETED"
+FAILED = "FAILED"
+CANCELLED = "CANCELLED"
+
+class Job:
+
+    def __init__(self, name, command, resources=None, array_size=None, after=(), log_path=None):
+        self.name = name
+        # shell command, $SLURM_ARRAY_TASK_ID is the task index of an array job
+        self.command = command
+        self.resources = resources or {}
+        self.array_size = array_size
+        self.after = list(after)
+        self.log_path = log_path
+
+class SlurmExecutor:
+
+    def __init__(self, log_dir, log=None, poll_interval=30.0):
+        self.log_dir = log_dir
+        self.log = log
+        self.poll_interval = poll_interval
+        self.job_ids = []
+        os.makedirs(log_dir, exist_ok=True)
+
+    #
+    # sbatch_arguments()
+    # the sbatch command line of job
+    #
+    def sbatch_arguments(self, job):
+        resources = job.resources
+        arguments = ["sbatch", "--parsable", "--job-name=" + job.name,
+                     "--cpus-per-task=" + str(resources.get("cpus", 1))]
+        if resources.get("mem"):
+            arguments.append("--mem=" + str(resources["mem"]))
+        if resources.get("time"):
+            arguments.append("--time=" + str(resources["time"]))
+        if resources.get("gpus"):
+            arguments.append("--gpus=" + str(resources["gpus"]))
+        if resources.get("partition"):
+            arguments.append("--partition=" + resources["partition"])
+        if resources.get("account"):
+            arguments.append("--account=" + resources["account"])
+        arguments.extend(resources.get("extra", []))
+        if job.array_size is not None:
+            arguments.append(f"--array=0-{job.array_size - 1}")
+            output = os.path.join(self.log_dir, job.name + "_%A_%a.out")
+        else:
+            output = os.path.join(self.log_dir, job.name + "_%j.out")
+        arguments.append("--output=" + (job.log_path or output))
+        if job.after:
+            # dependents of a failed job are cancelled instead of pending forever
+            arguments.append("--dependency=afterok:" + ":".join(job.after))
+            arguments.append("--kill-on-invalid-dep=yes")
+        arguments.append("--wrap=" + job.command)
+        return arguments
+
+    def submit(self, job):
+        arguments = self.sbatch_arguments(job)
+        output = subprocess.run(arguments, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+        # --parsable prints "<job id>[;<cluster>]"
+        job_id = output.stdout.decode().strip().split(";")[0]
+        self.job_ids.append(job_id)
+        if self.log is not None:
+            self.log.loginfo("SlurmExecutor", f"submitted {job.name} as job {job_id}: "
+                                              + " ".join(shlex.quote(argument) for argument in arguments[:-1]))
+        return job_id
+
+    #
+    # wait()
+    # poll squeue until every submitted job has left the queue
+    #
+    # return:
+    # {job id: COMPLETED | FAILED | CANCELLED}, the worst state of an array's tasks
+    #
+    def wait(self):
+        if not self.job_ids:
+            return {}
+        while True:
+            output = subprocess.run(["squeue", "-h", "-o", "%i", "-j", ",".join(self.job_ids)],
+                                    stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+            if not output.stdout.strip():
+                break
+            time.sleep(self.poll_interval)
+
+        output = subprocess.run(["sacct", "-n", "-X", "-P", "-o", "JobID,State", "-j", ",".join(self.job_ids)],
+                                stdout=subprocess.PIPE, check=True)
+        states = {job_id: COMPLETED for job_id in self.job_ids}
+        for line in output.stdout.decode().splitlines():
+            if "|" not in line:
+                continue
+            task, state = line.split("|", 1)
+            job_id = re.split(r"[_.]", task)[0]
+            if job_id not in states or state.startswith(COMPLETED):
+                continue
+            if states[job_id] != FAILED:
+                states[job_id] = CANCELLED if state.startswith(CANCELLED) else FAILED
+        return states
+
+class LocalExecutor:
+
+    def __init__(self, log_dir, log=None, cpus=None, poll_interval=0.2):
+        self.log_dir = log_dir
+        self.log = log
+        self.cpus = cpus or os.cpu_count() or 1
+        self.poll_interval = poll_interval
+        self.jobs = {}
+        os.makedirs(log_dir, exist_ok=True)
+
+    def submit(self, job):
+        job_id = str(len(self.jobs) + 1)
+        unknown = [dependency for dependency in job.after if dependency not in self.jobs]
+        if unknown:
+            raise ValueError(f"{job.name} depends on unknown jobs {unknown}")
+        self.jobs[job_id] = job
+        if self.log is not None:
+            self.log.loginfo("LocalExecutor", f"submitted {job.name} as job {job_id}"
+                                              + (f" after {', '.join(job.after)}" if job.after else ""))
+        return job_id
+
+    def _start(self, job_id, task):
+        job = self.jobs[job_id]
+        name = f"{job.name}_{job_id}" + (f"_{task}" if task is not None else "")
+        env = dict(os.environ, SLURM_JOB_ID=job_id, SLURM_CPUS_PER_TASK=str(job.resources.get("cpus", 1)))
+        if task is not None:
+            env["SLURM_ARRAY_TASK_ID"] = str(task)
+        with open(os.path.join(self.log_dir, name + ".out"), "w") as output:
+            return subprocess.Popen(job.command, shell=True, stdout=output, stderr=subprocess.STDOUT, env=env)
+
+    #
+    # wait()
+    # run the submitted jobs
+    #
+    # return:
+    # {job id: COMPLETED | FAILED | CANCELLED}
+    #
+    def wait(self):
+        states = {}
+        # (job id, task) not started yet, in submission order
+        pending = [(job_id, task) for job_id, job in self.jobs.items()
+                   for task in (range(job.array_size) if job.array_size is not None else [None])]
+        running = {}
+        failed_tasks = set()
+        free_cpus = self.cpus
+
+        while pending or running:
+            for key, process in list(running.items()):
+                if process.poll() is None:
+                    continue
+                del running[key]
+                free_cpus += min(self.jobs[key[0]].resources.get("cpus", 1), self.cpus)
+                if process.returncode != 0:
+                    failed_tasks.add(key[0])
+
+            # a job is done once none of its tasks are pending or running
+            for job_id in self.jobs:
+                if job_id in states or any(key[0] == job_id for key in pending + list(running)):
+                    continue
+                states[job_id] = FAILED if job_id in failed_tasks else COMPLETED
+                if self.log is not None:
+                    self.log.loginfo("LocalExecutor", f"job {job_id} {self.jobs[job_id].name} {states[job_id]}")
+
+            for key in list(pending):
+                if key not in pending:
+                    continue
+                job = self.jobs[key[0]]
+                after = [states.get(dependency) for dependency in job.after]
+                if any(state in (FAILED, CANCELLED) for state in after):
+                    pending = [other for other in pending if other[0] != key[0]]
+                    states[key[0]] = CANCELLED
+                    if self.log is not None:
+                        self.log.loginfo("LocalExecutor", f"job {key[0]} {job.name} CANCELLED, a dependency failed")
+                    continue
+                if not all(state == COMPLETED for state in after):
+                    continue
+                cpus = min(job.resources.get("cpus", 1), self.cpus)
+                if cpus > free_cpus:
+                    # first come first served, like a scheduler without backfill
+                    break
+                pending.remove(key)
+                free_cpus -= cpus
+                running[key] = self._start(*key)
+
+            if pending or running:
+                time.sleep(self.poll_interval)
+        return states
+
+EXECUTORS = {"local": LocalExecutor, "slurm": SlurmExecutor}
@@ -0,0 +1,144 @@
+# gallery_watch.py
+#  - track the galleries of a session that is still being collected
+#
+# topaz_run --watch polls the rawdata_images glob and picks every new gallery with the
+# existing model: the gallery is preprocessed, extracted on its own and its picks are
+# appended to predicted_particles.txt, so the work per gallery does not grow with the
+# session.  A gallery is new once it is not in the watch state, and ready once its
+# size and mtime did not change between two polls and it is at least settle seconds
+# old, so galleries still being written are left for a later poll.
+#
+# <output.dir>/watch_state.json:
+#   {"galleries": {"<path>": {"size": 1234, "mtime_ns": ..., "model": "model_epoch10.sav", "picks": 212}},
+#    "failed": {"<path>": {"size": 1234, "mtime_ns": ...}},
+#    "particles": {"size": ..., "mtime_ns": ...}, "appending": 123456}
+#
+# appending is the size of predicted_particles.txt before an append that is not
+# recorded yet.  A watch that was killed in between truncates the file back to it, so
+# those galleries are picked again without duplicate rows.  A gallery that failed is
+# retried once it changes.
+#
+
+import glob
+import json
+import os
+import time
+
+class GalleryWatcher:
+
+    def __init__(self, pattern, state_file, predicted_particles, settle=5.0):
+        self.pattern = pattern
+        self.state_file = state_file
+        self.predicted_particles = predicted_particles
+        self.settle = settle
+        # file_signature() of every unrecorded gallery at the last poll
+        self.seen = {}
+        self.state = {"galleries": {}, "failed": {}, "particles": None}
+
+    #
+    # restore()
+    # load the watch state.  Without one, galleries already preprocessed by a pipeline
+    # run whose predicted_particles.txt exists count as picked.
+    #
+    # return:
+    # the number of galleries already picked
+    #
+    def restore(self, processed_micrograph):
+        try:
+            with open(self.state_file, "r") as f:
+                self.state.update(json.load(f))
+        except FileNotFoundError:
+            if os.path.exists(self.predicted_particles):
+                for path in sorted(glob.glob(self.pattern)):
+                    if os.path.exists(processed_micrograph(path)):
+                        self.state["galleries"][path] = dict(file_signature(path), model=None, picks=None)
+                self.save()
+
+        appending = self.state.pop("appending", None)
+        if appending is not None:
+            if os.path.exists(self.predicted_particles) and os.path.getsize(self.predicted_particles) > appending:
+                with open(self.predicted_particles, "r+") as f:
+                    f.truncate(appending)
+            self.save()
+        return len(self.state["galleries"])
+
+    def save(self):
+        tmp = self.state_file + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.state, f, indent=1)
+        os.replace(tmp, self.state_file)
+
+    #
+    # poll()
+    # the new galleries that are completely written, sorted
+    #
+    def poll(self):
+        ready = []
+        now = time.time()
+        for path in sorted(glob.glob(self.pattern)):
+            if path in self.state["galleries"]:
+                continue
+            try:
+                signature = file_signature(path)
+            except FileNotFoundError:
+                continue
+            if self.state["failed"].get(path) == signature:
+                continue
+            if self.seen.get(path) == signature and now - signature["mtime_ns"] / 1e9 >= self.settle:
+                ready.append(path)
+            self.seen[path] = signature
+        return ready
+
+    #
+    # particles_changed()
+    # True when the raw particle file changed since it was last converted
+    #
+    def particles_changed(self, particles):
+        return os.path.exists(particles) and file_signature(particles) != self.state["particles"]
+
+    def record_particles(self, particles):
+        self.state["particles"] = file_signature(particles)
+        self.save()
+
+    #
+    # append_picks()
+    # append the picks of batch_file to predicted_particles.txt and record galleries
+    #
+    # return:
+    # the number of picks appended
+    #
+    def append_picks(self, batch_file, galleries, model):
+        with open(batch_file, "r") as f:
+            header = f.readline()
+            lines = [line for line in f if line.strip()]
+        counts = {}
+        for line in lines:
+            name = line.split("\t", 1)[0]
+            counts[name] = counts.get(name, 0) + 1
+
+        size = os.path.getsize(self.predicted_particles) if os.path.exists(self.predicted_particles) else 0
+        self.state["appending"] = size
+        self.save()
+        write_header = size == 0
+        with open(self.predicted_particles, "a") as f:
+            if write_header:
+                f.write(header if header.strip() else "image_name\tx_coord\ty_coord\tscore\n")
+            f.writelines(lines)
+
+        for path in galleries:
+            name = os.path.splitext(os.path.basename(path))[0]
+            self.state["galleries"][path] = dict(self.seen.get(path) or file_signature(path), model=model,
+                                                 picks=counts.get(name, 0))
+            self.state["failed"].pop(path, None)
+        self.state.pop("appending")
+        self.save()
+        return len(lines)
+
+    def record_failed(self, galleries):
+        for path in galleries:
+            self.state["failed"][path] = self.seen.get(path) or file_signature(path)
+        self.save()
+
+def file_signature(path):
+    st = os.stat(path)
+    return {"size": st.st_size, "mtime_ns": st.st_mtime_ns}
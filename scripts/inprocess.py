@@ -0,0 +1,167 @@
+# inprocess.py
+#  - run topaz commands inside the long lived topaz_run process
+#
+# "topaz <command> ..." command lines are parsed with the command's own argparse
+# definition and handed to its main() entry point, so torch, numpy and topaz are
+# imported once per topaz_run instead of once per step and shard.  Output printed by
+# the command is streamed into the event log the same way shell_runner does for child
+# processes.
+#
+# sys.stdout/sys.stderr are process wide, so in-process commands run one at a time.
+# The env of a command (the OMP_NUM_THREADS limits of shards and of the core budget)
+# is applied to os.environ and torch's thread count while it runs and restored after.
+# Commands this module does not handle (and execution_mode "subprocess") keep using
+# shell_runner.
+#
+
+import argparse
+import glob
+import importlib
+import os
+import shlex
+import sys
+import threading
+import time
+import traceback
+from contextlib import contextmanager, redirect_stdout, redirect_stderr
+
+from scripts import resource_usage
+from scripts import shell_runner
+
+INPROCESS_COMMANDS = {
+    "preprocess": "topaz.commands.preprocess",
+    "convert": "topaz.commands.convert",
+    "train_test_split": "topaz.commands.train_test_split",
+    "train": "topaz.commands.train",
+    "extract": "topaz.commands.extract",
+}
+
+_command_lock = threading.Lock()
+_logging = threading.local()
+
+#
+# supports()
+# True when command is a topaz command line that can be run in-process
+#
+def supports(command):
+    argv = shlex.split(command)
+    return len(argv) > 1 and argv[0] == "topaz" and argv[1] in INPROCESS_COMMANDS
+
+#
+# expand_globs()
+# expand glob arguments the way the shell does for the subprocess path
+#
+def expand_globs(arguments):
+    expanded = []
+    for argument in arguments:
+        matches = sorted(glob.glob(argument)) if glob.has_magic(argument) else []
+        expanded.extend(matches if matches else [argument])
+    return expanded
+
+#
+# _LogStream
+# file-like object that sends complete lines written by the owning thread to the
+# event log.  Writes from other threads, and the logger's own console echo, go to the
+# original stream.
+#
+class _LogStream:
+
+    def __init__(self, log, log_module, progress, original):
+        self.log = log
+        self.log_module = log_module
+        self.progress = progress
+        self.original = original
+        self.owner = threading.get_ident()
+        self.buffer = ""
+
+    def write(self, text):
+        if getattr(_logging, "busy", False) or threading.get_ident() != self.owner:
+            return self.original.write(text)
+        _logging.busy = True
+        try:
+            self.buffer += text
+            while "\n" in self.buffer:
+                line, self.buffer = self.buffer.split("\n", 1)
+                self.log.loginfo(self.log_module, line)
+                self.progress.update(line)
+        finally:
+            _logging.busy = False
+        return len(text)
+
+    def flush(self):
+        if self.buffer and not getattr(_logging, "busy", False):
+            self.write("\n")
+        self.original.flush()
+
+    def isatty(self):
+        return False
+
+#
+# scoped_environment()
+# apply env to os.environ, and its OMP_NUM_THREADS to torch, until the block ends
+#
+@contextmanager
+def scoped_environment(env):
+    import torch
+
+    env = env if env is not None else os.environ
+    saved = {name: os.environ.get(name) for name in env if os.environ.get(name) != env[name]}
+    os.environ.update({name: env[name] for name in saved})
+    num_threads = torch.get_num_threads()
+    threads = env.get("OMP_NUM_THREADS", "")
+    if threads.isdigit() and int(threads) > 0:
+        torch.set_num_threads(int(threads))
+    try:
+        yield
+    finally:
+        torch.set_num_threads(num_threads)
+        for name, value in saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+#
+# run_command()
+# same interface and result as shell_runner.run_command for supported topaz commands
+#
+def run_command(command, log, log_module, project, env=None, total_items=None):
+
+    argv = shlex.split(command)
+    name = argv[1]
+    module = importlib.import_module(INPROCESS_COMMANDS[name])
+    parser = module.add_arguments(argparse.ArgumentParser("topaz " + name, fromfile_prefix_chars="@"))
+    progress = shell_runner.ProgressTracker(log, log_module, total_items)
+
+    with _command_lock:
+        start_time = time.time()
+        self_usage = resource_usage.SelfUsage()
+        stdout = _LogStream(log, log_module, progress, sys.stdout)
+        stderr = _LogStream(log, log_module, progress, sys.stderr)
+        returncode = 0
+        with scoped_environment(env), redirect_stdout(stdout), redirect_stderr(stderr):
+            try:
+                args = parser.parse_args(expand_globs(argv[2:]))
+                module.main(args)
+            except SystemExit as e:
+                if isinstance(e.code, int):
+                    returncode = e.code
+                else:
+                    returncode = 0 if e.code is None else 1
+            except Exception:
+                for line in traceback.format_exc().splitlines():
+                    stderr.write(line + "\n")
+                returncode = 1
+            stdout.flush()
+            stderr.flush()
+        wall_time = time.time() - start_time
+        usage = self_usage.delta()
+
+    log.loginfo(log_module, f"in-process exit code {returncode} after {wall_time:.2f} seconds")
+    log.logperf(project, log_module, "returncode", str(returncode), "code")
+    log.logperf(project, log_module, "wall_time", f"{wall_time:.2f}", "seconds")
+    # process wide, includes other threads of topaz_run working at the same time
+    usage.log(log, project, log_module)
+    resource_usage.record(log_module, usage)
+
+    return shell_runner.CommandResult(command, returncode, wall_time, usage)
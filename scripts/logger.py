@@ -1,113 +1,301 @@
 # logger.py
-# 
+#
+# Logger hands every record to a background writer thread through a bounded queue,
+# so callers (streamed child output, per-shard metrics) only pay for a queue put.
+# The writer formats records, writes them in batches, flushes the files when the
+# queue drains or every flush_interval seconds, and rotates files larger than
+# max_bytes.  Records still queued at interpreter exit are written by an atexit hook.
+# Records logged after close() (a late thread, the atexit path) are appended to the
+# files by the caller itself once the writer thread has finished.
+#
+import atexit
+import json
+import math
+import os
+import queue
+import threading
+import time
 from datetime import datetime
 
+PERF_FORMATS = ("csv", "jsonl")
+
+_EVENT = 0
+_PERF = 1
+_FLUSH = 2
+_STOP = 3
+
 #
 # initialize()
 #
 # open eventlog for writing in append mode.  The file is created if it doesn't exist.
 # event log format - [date time of event][calling module] msg
-# 
-# open perflog for writing in append mode.  
-# output format - datetime,module,metric,measure,unit  (comma deliminated for easy parsing)
 #
-# input: 
+# open perflog for writing in append mode.
+# output format (perf_format "csv") - datetime,module,metric,measure,unit  (comma deliminated for easy parsing)
+# output format (perf_format "jsonl") - one JSON object per line with typed fields
+#   {"timestamp", "time", "run", "step", "metric", "value", "unit"}
+#
+# input:
 # eventlog - the path to the eventlog file
 # perflog - the path to the perflog file
 # logging level - 0 == write to file;  1 == write to file and console
-# 
+# perf_format - "csv" or "jsonl"
+# max_queue - records queued before callers wait for the writer
+# flush_interval - seconds between flushes while records keep arriving
+# max_bytes - rotate a log file once it is larger than this, 0 never rotates
+# backup_count - number of rotated files kept (eventlog.1 ... eventlog.N)
+#
 # return:
 # none
 #
 
 class Logger:
 
-    def __init__(self, eventlog, perflog, level): 
+    def __init__(self, eventlog, perflog, level, perf_format="csv", max_queue=10000,
+                 flush_interval=1.0, max_bytes=0, backup_count=3):
+
+        if perf_format not in PERF_FORMATS:
+            raise ValueError("perf_format must be csv or jsonl, not " + perf_format)
 
         self.level = level
         self.datetime_format = "%m/%d/%Y, %H:%M:%S"
+        self.perf_format = perf_format
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.closed = False
+        # closed and the put of a record change together, so nothing is queued after _STOP
+        self._lock = threading.Lock()
+        self._second = None
+        self._date_time = ""
 
-        # initialize eventlog
-        try:
-            self.eventlog = open(eventlog, "a")
-        except:
-            if self.level:
-                print("file open failed for eventlog = " + eventlog)
-        else:
-            now = datetime.now()
-            date_time = now.strftime(self.datetime_format)
-            message = "[" + date_time + "] Intialized eventlog"
-            try: 
-                self.eventlog.write(message + "\n")
-            except:
-                if self.level:
-                    print("file write failed to eventlog")
-            else:
-                if self.level:
-                    print(message)
-
-        # initialize perflog
+        self.eventlog_path = eventlog
+        self.perflog_path = perflog
+        self.eventlog = self._open(eventlog, "eventlog")
+        self.perflog = self._open(perflog, "perflog")
+
+        self.writer = threading.Thread(target=self._write_records, name="Logger", daemon=True)
+        self.writer.start()
+        atexit.register(self.close)
+
+        if self.eventlog is not None:
+            self._put((_EVENT, time.time(), (None, "Intialized eventlog")))
+        if self.perflog is not None:
+            # a regular perf record, so the perflog stays parseable in either format
+            self.logperf("", "Logger", "initialized", "1", "count")
+
+    def _open(self, path, name):
         try:
-            self.perflog = open(perflog, "a")
+            return open(path, "a")
         except:
             if self.level:
-                print("file open failed for perflog = " + perflog)
-        else:
-            now = datetime.now()
-            date_time = now.strftime(self.datetime_format)
-            message = "[" + date_time + "] Intialized perflog"
-            try: 
-                self.eventlog.write(message + "\n")
-            except:
-                if self.level:
-                    print("file write into perflog failed")
-            else:
-                if self.level:
-                    print(message)           
-
-    #                  
+                print("file open failed for " + name + " = " + path)
+            return None
+
+    #
     # loginfo()
     # append info to eventlog
     # format - [date time of message][module] msg
-    #           
+    #
     def loginfo(self, module, msg):
-        now = datetime.now()
-        date_time = now.strftime(self.datetime_format)
-        message = "[" + date_time + "] [" + module + "] " + msg
-        self.eventlog.write(message + "\n")
-        if self.level:
-            print(message)
-
-    #                  
+        self._put((_EVENT, time.time(), (module, msg)))
+
+    #
     # logperf()
     # append info to perflog
-    # format - datetime,calling_module,metric,measure,unit 
-    #           
+    # format - datetime,calling_module,metric,measure,unit
+    #
     def logperf(self, project, module, metric, measure, unit):
-        now = datetime.now()
-        date_time = now.strftime(self.datetime_format)
-        message = date_time + "," + project + "," + module + "," + metric + "," + measure + "," + unit
-        self.perflog.write(message + "\n")
-        if self.level:
-            print(message)
+        self._put((_PERF, time.time(), (project, module, metric, measure, unit)))
+
+    #
+    # flush() - returns once every record logged so far is written and flushed
+    #
+    def flush(self) -> None:
+        done = threading.Event()
+        if self._put((_FLUSH, time.time(), done)):
+            done.wait()
 
     #
-    # close() - closes the eventlog and perflog
+    # close() - writes the queued records and closes the eventlog and perflog
     #
     def close(self) -> None:
-        now = datetime.now()
-        date_time = now.strftime("%m/%d/%Y, %H:%M:%S")
-        message = "[" + date_time + "] [" +  "Logger.close" + "] " + "log files closed"
-        self.eventlog.write(message + "\n")
-        self.eventlog.close()
-        self.perflog.close()
-        if self.level:
-            print(message)
-
-# test code for above functions - 
+        with self._lock:
+            if self.closed:
+                return
+            self.queue.put((_EVENT, time.time(), ("Logger.close", "log files closed")))
+            self.closed = True
+            self.queue.put((_STOP, time.time(), None))
+        self.writer.join()
+        with self._lock:
+            for f in (self.eventlog, self.perflog):
+                if f is not None:
+                    f.close()
+        atexit.unregister(self.close)
+
+    #
+    # _put()
+    # queue record for the writer thread, or after close() write it in this thread
+    #
+    # return:
+    # True when the record was queued
+    #
+    def _put(self, record):
+        with self._lock:
+            if not self.closed:
+                self.queue.put(record)
+                return True
+        kind, timestamp, payload = record
+        if kind != _EVENT and kind != _PERF:
+            return False
+        self.writer.join()
+        with self._lock:
+            f = self.eventlog if kind == _EVENT else self.perflog
+            path = self.eventlog_path if kind == _EVENT else self.perflog_path
+            try:
+                line = self._format(kind, timestamp, payload)
+            except Exception as e:
+                line = "[Logger] unformattable record " + repr(payload) + ": " + repr(e)
+            if f is not None:
+                try:
+                    with open(path, "a") as late:
+                        late.write(line + "\n")
+                except OSError:
+                    pass
+            if self.level:
+                print(line, flush=True)
+        return False
+
+    def _format_time(self, timestamp):
+        # strftime once per second of log time
+        second = int(timestamp)
+        if second != self._second:
+            self._second = second
+            self._date_time = datetime.fromtimestamp(second).strftime(self.datetime_format)
+        return self._date_time
+
+    def _format(self, kind, timestamp, payload):
+        date_time = self._format_time(timestamp)
+        if kind == _EVENT:
+            module, msg = payload
+            if module is None:
+                return "[" + date_time + "] " + msg
+            return "[" + date_time + "] [" + module + "] " + msg
+        project, module, metric, measure, unit = payload
+        if self.perf_format == "jsonl":
+            return json.dumps({"timestamp": datetime.fromtimestamp(timestamp).isoformat(timespec="milliseconds"),
+                               "time": round(timestamp, 3), "run": project, "step": module,
+                               "metric": metric, "value": typed_value(measure), "unit": unit})
+        return date_time + "," + ",".join(str(field) for field in payload)
+
+    #
+    # _write_records()
+    # writer thread - takes the next record, then everything else already queued, and
+    # writes the batch.  Files are flushed when asked to, when no record arrived for
+    # flush_interval seconds, and at least every flush_interval seconds otherwise.
+    #
+    def _write_records(self):
+        last_flush = time.time()
+        dirty = False
+        running = True
+        while running:
+            try:
+                batch = [self.queue.get(timeout=self.flush_interval)]
+            except queue.Empty:
+                batch = []
+            while batch and len(batch) < 1000:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            events = []
+            perf = []
+            waiting = []
+            console = []
+            for kind, timestamp, payload in batch:
+                if kind == _EVENT or kind == _PERF:
+                    try:
+                        line = self._format(kind, timestamp, payload)
+                    except Exception as e:
+                        line = "[Logger] unformattable record " + repr(payload) + ": " + repr(e)
+                    (events if kind == _EVENT else perf).append(line + "\n")
+                    console.append(line)
+                elif kind == _FLUSH:
+                    waiting.append(payload)
+                else:
+                    running = False
+
+            self._write(self.eventlog, events, "eventlog")
+            self._write(self.perflog, perf, "perflog")
+            if self.level and console:
+                print("\n".join(console), flush=True)
+
+            dirty = dirty or bool(events or perf)
+            now = time.time()
+            if waiting or not running or (dirty and (not batch or now - last_flush >= self.flush_interval)):
+                try:
+                    for f in (self.eventlog, self.perflog):
+                        if f is not None:
+                            f.flush()
+                    self._rotate()
+                except OSError as e:
+                    if self.level:
+                        print("log flush failed: " + repr(e))
+                last_flush = now
+                dirty = False
+            for done in waiting:
+                done.set()
+
+    def _write(self, f, lines, name):
+        if f is None or not lines:
+            return
+        try:
+            f.writelines(lines)
+        except:
+            if self.level:
+                print("file write failed to " + name)
+
+    def _rotate(self):
+        if self.max_bytes <= 0:
+            return
+        if self.eventlog is not None and self.eventlog.tell() >= self.max_bytes:
+            self.eventlog = self._rotate_file(self.eventlog, self.eventlog_path)
+        if self.perflog is not None and self.perflog.tell() >= self.max_bytes:
+            self.perflog = self._rotate_file(self.perflog, self.perflog_path)
+
+    def _rotate_file(self, f, path):
+        f.close()
+        for i in range(self.backup_count - 1, 0, -1):
+            if os.path.exists(f"{path}.{i}"):
+                os.replace(f"{path}.{i}", f"{path}.{i + 1}")
+        if self.backup_count > 0:
+            os.replace(path, path + ".1")
+        else:
+            os.remove(path)
+        return open(path, "a")
+
+#
+# typed_value()
+# int or float for numeric perflog measures, the string otherwise
+#
+def typed_value(measure):
+    try:
+        return int(measure)
+    except (TypeError, ValueError):
+        pass
+    try:
+        value = float(measure)
+    except (TypeError, ValueError):
+        return measure
+    return value if math.isfinite(value) else measure
+
+# test code for above functions -
 # logger = Logger("", "testperflog", 1)
 # logger = Logger("testeventlog", "", 1)
 # logger = Logger("testevent.log", "testperf.log", 1)
+# logger = Logger("testevent.log", "testperf.jsonl", 1, perf_format="jsonl")
 # logger.loginfo("hpcutil.loginfo", "test msg")
 # logger.logperf("test", "hpcutil.logperf", "particle_picking_per_tomo", "6000", "seconds" )
-# logger.close()
\ No newline at end of file
+# logger.close()
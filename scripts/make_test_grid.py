@@ -1,42 +1,32 @@
 '''
 
-Goal: Make a test grid composed of random images from 5 test grids with varying image sizes.
+Goal: Make test grids composed of random images from test grids with varying image sizes.
 Steps:
-1. Define Grid and Image Sizes: Set the dimensions for the grids and the individual image sizes.
-2. Load Images from MRC Files: The load_images_from_mrc function reads an MRC file and extracts images centered in the grid.
-3. Random Image Selection: For each cell in Grid 6, a random image is selected from one of the 5 grids.
-4. Create a Large Grid Image: The create_grid_image function assembles the randomly selected images into a single large image.
-5. Save grid to .png and .mrc files
+1. Open the source grids: every source MRC is memory mapped and viewed as a
+   (rows, cols, tile_h, tile_w) array of tiles, so only the tiles that are used are read.
+2. Random Image Selection: for every cell of every composite a seeded RNG picks a source
+   grid and a tile of it; the picks are kept as index arrays.
+3. Create the composites: each composite MRC is created with mrcfile.new_mmap, filled with
+   Gaussian noise and the picked tiles are copied in with one fancy-indexing assignment per
+   source grid.  Only one composite and the tiles it uses are in memory at a time.
+4. Particle files: one tab separated image_name/x_coord/y_coord file per source grid (class),
+   appended to while the composites are written.
+5. Optionally save the first composite to .png
+
+Usage - $ python -m scripts.make_test_grid -s apo:particles_001.mrc:64 -s beta_gal:particles_002.mrc:64 \
+            -s virus:particles_003.mrc:80 -s thg:particles_004.mrc:84 -s ribo:particles_005.mrc:88 \
+            --galleries 1000 --grid 16 15 --seed 7 --output-dir composite
 
 '''
 
-import random
-import numpy as np
+import os
+
+import click
 import mrcfile
+import numpy as np
+import pandas as pd
 from PIL import Image
 
-# Function to load images from an MRC file
-def load_images_from_mrc(mrc_path, image_size, grid_size):
-    """
-    Load images from an MRC file and return them as a list of numpy arrays.
-    """
-    with mrcfile.open(mrc_path, permissive=True) as mrc:
-        data = mrc.data
-
-    images = []
-    rows, cols = grid_size
-    img_h, img_w = image_size
-    for i in range(rows):
-        for j in range(cols):
-            # Calculate the position to extract the image
-            y_start = i * img_h
-            y_end = y_start + img_h
-            x_start = j * img_w
-            x_end = x_start + img_w
-            image = data[y_start:y_end, x_start:x_end]
-            images.append(image)
-    return images
-
 # Create a large image for Grid 6
 def create_grid_image(images, rows, cols, image_sizes):
     """
@@ -44,10 +34,10 @@ def create_grid_image(images, rows, cols, image_sizes):
     """
     max_width = max(size[0] for size in image_sizes.values())
     max_height = max(size[1] for size in image_sizes.values())
-    
+
     grid_width = cols * max_width
     grid_height = rows * max_height
-    
+
     # Create an empty grid with Gaussian noise background
     grid_image_data = np.random.normal(0.5, 0.1, (grid_height, grid_width)).astype(np.float32)
 
@@ -71,14 +61,15 @@ def normalize_image_data(data):
     return ((data - data_min) / (data_max - data_min) * 255).astype(np.uint8)
 
 # Save the final Grid 6 image to a PNG file
-def save_image_to_png(image_data, path):
+def save_image_to_png(image_data, path, show=True):
     """
     Save numpy array image data to a PNG file.
     """
     image_normalized = normalize_image_data(image_data)
     image_pil = Image.fromarray(image_normalized, mode='L')
     image_pil.save(path)
-    image_pil.show()
+    if show:
+        image_pil.show()
 
 # Save the Grid 6 image as MRC
 def save_to_mrc(image_data, mrc_path):
@@ -88,126 +79,154 @@ def save_to_mrc(image_data, mrc_path):
     with mrcfile.new(mrc_path, overwrite=True) as mrc:
         mrc.set_data(image_data.astype(np.float32))  # Ensure the data is in float32 format for MRC
 
-# Define the grid size and image sizes
-grid_size = (16, 15)
-image_sizes = {
-    1: (64, 64),
-    2: (64, 64),
-    3: (80, 80),
-    4: (84, 84),
-    5: (88, 88)
-}
-
-# 1 = apo; #2 beta_gal; #3 = virus; #4 = thg;  #5 = ribo
-grid1 = "/hpc/projects/group.czii/phil.smoot/topaz_wrapper/execute_projects/composite/base_composite_micrographs/particles_001.mrc"
-grid2 = "/hpc/projects/group.czii/phil.smoot/topaz_wrapper/execute_projects/composite/base_composite_micrographs/particles_002.mrc"
-grid3 = "/hpc/projects/group.czii/phil.smoot/topaz_wrapper/execute_projects/composite/base_composite_micrographs/particles_003.mrc"
-grid4 = "/hpc/projects/group.czii/phil.smoot/topaz_wrapper/execute_projects/composite/base_composite_micrographs/particles_004.mrc"
-grid5 = "/hpc/projects/group.czii/phil.smoot/topaz_wrapper/execute_projects/composite/base_composite_micrographs/particles_005.mrc"
-
-# Load images from each MRC file
-grid_images = {
-    1: load_images_from_mrc(grid1, image_sizes[1], grid_size),
-    2: load_images_from_mrc(grid2, image_sizes[2], grid_size),
-    3: load_images_from_mrc(grid3, image_sizes[3], grid_size),
-    4: load_images_from_mrc(grid4, image_sizes[4], grid_size),
-    5: load_images_from_mrc(grid5, image_sizes[5], grid_size)
-}
-
-# Create Grid 6 by randomly selecting images from the first 5 grids
-grid_6_images = []    
-particles1_data = []
-particles2_data = []
-particles3_data = []
-particles4_data = []
-particles5_data = []
-
-
-# for _ in range(grid_size[0] * grid_size[1]):
-for row in range(16):
-    for col in range(15):
-        
-        center_x = col * 88 + 88 // 2
-        center_y = row * 88 + 88 // 2
- 
-        random_grid = random.randint(1, 5)
-
-        if random_grid == 1:
-            particles1_data.append(("composite_particles", center_x, center_y))
-        elif random_grid == 2:
-            particles2_data.append(("composite_particles", center_x, center_y))
-        elif random_grid == 3:
-            particles3_data.append(("composite_particles", center_x, center_y))
-        elif random_grid == 4:
-            particles4_data.append(("composite_particles", center_x, center_y))
-        else:
-           particles5_data.append(("composite_particles", center_x, center_y))
-             
-        random_image = random.choice(grid_images[random_grid])
-        grid_6_images.append(random_image)
-
-# Write data to the output file
-with open("apo_composite_particles.txt", 'w') as f:
-    # write the header
-    var1 = "image_name"
-    var2 = "x_coord"
-    var3 = "y_coord"
-    f.write(f"{var1}\t{var2}\t{var3}\n")
-    # write the data
-    for item in particles1_data:
-        f.write(f"{item[0]}\t{item[1]}\t{item[2]}\n")
-
-# Write data to the output file
-with open("beta_gal_composite_particles.txt", 'w') as f:
-    # write the header
-    var1 = "image_name"
-    var2 = "x_coord"
-    var3 = "y_coord"
-    f.write(f"{var1}\t{var2}\t{var3}\n")
-    # write the data
-    for item in particles2_data:
-        f.write(f"{item[0]}\t{item[1]}\t{item[2]}\n")
-
-# Write data to the output file
-with open("virus_composite_particles.txt", 'w') as f:
-    # write the header
-    var1 = "image_name"
-    var2 = "x_coord"
-    var3 = "y_coord"
-    f.write(f"{var1}\t{var2}\t{var3}\n")
-    # write the data
-    for item in particles3_data:
-        f.write(f"{item[0]}\t{item[1]}\t{item[2]}\n")
-
-# Write data to the output file
-with open("thg_composite_particles.txt", 'w') as f:
-    # write the header
-    var1 = "image_name"
-    var2 = "x_coord"
-    var3 = "y_coord"
-    f.write(f"{var1}\t{var2}\t{var3}\n")
-    # write the data
-    for item in particles4_data:
-        f.write(f"{item[0]}\t{item[1]}\t{item[2]}\n")
-
-# Write data to the output file
-with open("ribo_composite_particles.txt", 'w') as f:
-    # write the header
-    var1 = "image_name"
-    var2 = "x_coord"
-    var3 = "y_coord"
-    f.write(f"{var1}\t{var2}\t{var3}\n")
-    # write the data
-    for item in particles5_data:
-        f.write(f"{item[0]}\t{item[1]}\t{item[2]}\n")
-
-# Create the final Grid 6 image
-grid_6_image_data = create_grid_image(grid_6_images, grid_size[0], grid_size[1], image_sizes)
-
-# Save the Grid 6 image as PNG
-save_image_to_png(grid_6_image_data, 'composite_particles.png')
-
-# Save the Grid 6 image as MRC
-save_to_mrc(grid_6_image_data, 'composite_particles.mrc')
+class SourceGrid:
+    """
+    A memory mapped source grid of tile_size x tile_size images.  tiles is a
+    (rows, cols, tile_size, tile_size) view of the mapped data.
+    """
 
-print("Grid 6 saved to composite_particles.png and composite_particles.mrc")
\ No newline at end of file
+    def __init__(self, label, mrc_path, tile_size):
+        self.label = label
+        self.tile_size = tile_size
+        self.mrc = mrcfile.mmap(mrc_path, mode="r", permissive=True)
+        data = self.mrc.data
+        if data.ndim == 3:
+            data = data[0]
+        self.rows = data.shape[0] // tile_size
+        self.cols = data.shape[1] // tile_size
+        if self.rows == 0 or self.cols == 0:
+            raise ValueError(f"{mrc_path} is smaller than one {tile_size} x {tile_size} tile")
+        data = data[:self.rows * tile_size, :self.cols * tile_size]
+        self.tiles = data.reshape(self.rows, tile_size, self.cols, tile_size).swapaxes(1, 2)
+
+    def close(self):
+        self.mrc.close()
+
+def parse_source(spec):
+    # "label:path:tile_size"
+    label, sep, rest = spec.partition(":")
+    path, sep2, tile_size = rest.rpartition(":")
+    if not sep or not sep2 or not label or not path:
+        raise click.BadParameter(f"expected label:path:tile_size, got {spec}")
+    try:
+        return label, path, int(tile_size)
+    except ValueError:
+        raise click.BadParameter(f"tile size of {spec} is not an integer")
+
+#
+# write_composite()
+# fill one composite MRC through a memory mapped writer
+#
+# input:
+# sources - the SourceGrids
+# classes - (rows, cols) source index of every cell
+# tile_index - (rows, cols) flat tile index into the chosen source of every cell
+# cell_size - size of a composite cell, the largest tile size
+#
+def write_composite(mrc_path, sources, classes, tile_index, cell_size, rng):
+
+    rows, cols = classes.shape
+    with mrcfile.new_mmap(mrc_path, shape=(rows * cell_size, cols * cell_size), mrc_mode=2,
+                          overwrite=True) as mrc:
+        # Gaussian noise background, one band of cells at a time
+        for row in range(rows):
+            band = rng.standard_normal((cell_size, cols * cell_size), dtype=np.float32)
+            band *= 0.1
+            band += 0.5
+            mrc.data[row * cell_size:(row + 1) * cell_size] = band
+
+        cells = mrc.data.reshape(rows, cell_size, cols, cell_size)
+        for k, source in enumerate(sources):
+            cell_rows, cell_cols = np.nonzero(classes == k)
+            if len(cell_rows) == 0:
+                continue
+            flat = tile_index[cell_rows, cell_cols]
+            tiles = source.tiles[flat // source.cols, flat % source.cols]
+            # smaller tiles are centered in their cell
+            offset = (cell_size - source.tile_size) // 2
+            span = slice(offset, offset + source.tile_size)
+            cells[cell_rows, span, cell_cols, span] = tiles
+
+        mrc.update_header_stats()
+
+#
+# make_composites()
+# write galleries composites of grid cells picked at random from sources, and one
+# particle file per source
+#
+# return:
+# {label: number of particles}
+#
+def make_composites(sources, output_dir, galleries, grid, seed=None, prefix="composite_particles", png=False):
+
+    rng = np.random.default_rng(seed)
+    rows, cols = grid
+    cell_size = max(source.tile_size for source in sources)
+    os.makedirs(output_dir, exist_ok=True)
+
+    # cell centers, the same for every composite
+    center_y, center_x = np.mgrid[0:rows, 0:cols] * cell_size + cell_size // 2
+
+    counts = {source.label: 0 for source in sources}
+    particle_files = {}
+    try:
+        for source in sources:
+            f = open(os.path.join(output_dir, f"{source.label}_{prefix}.txt"), "w")
+            particle_files[source.label] = f
+            f.write("image_name\tx_coord\ty_coord\n")
+
+        digits = max(3, len(str(galleries - 1)))
+        for gallery in range(galleries):
+            image_name = f"{prefix}_{gallery:0{digits}d}"
+
+            classes = rng.integers(len(sources), size=(rows, cols))
+            tile_counts = np.array([source.rows * source.cols for source in sources])
+            tile_index = (rng.random((rows, cols)) * tile_counts[classes]).astype(np.int64)
+
+            mrc_path = os.path.join(output_dir, image_name + ".mrc")
+            write_composite(mrc_path, sources, classes, tile_index, cell_size, rng)
+
+            for k, source in enumerate(sources):
+                selected = classes == k
+                pd.DataFrame({"image_name": image_name, "x_coord": center_x[selected],
+                              "y_coord": center_y[selected]}).to_csv(
+                    particle_files[source.label], sep="\t", header=False, index=False)
+                counts[source.label] += int(selected.sum())
+
+            if png and gallery == 0:
+                with mrcfile.mmap(mrc_path, mode="r") as mrc:
+                    save_image_to_png(mrc.data, os.path.join(output_dir, image_name + ".png"), show=False)
+    finally:
+        for f in particle_files.values():
+            f.close()
+
+    return counts
+
+@click.command(context_settings={"show_default": True})
+@click.option("-s", "--source", "source_specs", multiple=True, required=True,
+              help="source grid as label:path:tile_size (repeatable), e.g. ribo:particles_005.mrc:88")
+@click.option("-n", "--galleries", type=int, default=1, help="number of composite galleries")
+@click.option("--grid", type=(int, int), default=(16, 15), help="rows and columns of a composite")
+@click.option("--seed", type=int, default=None, help="RNG seed, the same seed writes the same composites")
+@click.option("-o", "--output-dir", default=".", help="directory for the composites and particle files")
+@click.option("--prefix", default="composite_particles", help="composite file name prefix")
+@click.option("--png", is_flag=True, help="also save the first composite as png")
+def make_test_grid(source_specs, galleries, grid, seed, output_dir, prefix, png):
+    """
+    Make composite galleries from tiles picked at random from the source grids.
+    """
+    sources = []
+    try:
+        for spec in source_specs:
+            sources.append(SourceGrid(*parse_source(spec)))
+        counts = make_composites(sources, output_dir, galleries, grid, seed, prefix, png)
+    finally:
+        for source in sources:
+            source.close()
+
+    for label, count in counts.items():
+        print(f"{label}: {count} particles written to {os.path.join(output_dir, label + '_' + prefix + '.txt')}")
+    print(f"{galleries} composites saved to {output_dir}")
+
+if __name__ == "__main__":
+    make_test_grid()
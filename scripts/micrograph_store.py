@@ -0,0 +1,222 @@
+# micrograph_store.py
+#  - content addressed store of preprocessed micrographs shared between runs
+#
+# Runs of one project often preprocess the same galleries with the same parameters.
+# With "micrograph_store": "yes" execute_preprocess looks every raw gallery up in
+# <base_project_path>/micrograph_store and links the stored micrograph into the run's
+# micrographs directory; only the misses are preprocessed, and their outputs are added
+# to the store.
+#
+# layout:
+#   objects/<k[:2]>/<k>.mrc   - the preprocessed micrograph
+#   objects/<k[:2]>/<k>.json  - source, size, parameters and topaz version; its mtime
+#                               is the last time a run used the object
+#
+# k = sha256 of (sha256 of the raw gallery, preprocess parameters, topaz version)
+#
+# Objects are hardlinked into runs, or symlinked where the store is on another file
+# system.  The .mrc mtime is never changed, the step cache of every run that links
+# the object tracks it.
+#
+# evict removes least recently used objects until the store is below a size cap.  A
+# run keeps its hardlinks to evicted objects; its symlinks break and its next
+# preprocess run recomputes them (the step cache sees the outputs as missing).
+#
+# Usage - $ topaz_store stats --store /path/to/project/micrograph_store
+#         $ topaz_store evict --store /path/to/project/micrograph_store --max-size 500G
+#
+
+import hashlib
+import json
+import os
+import re
+import shutil
+import time
+
+import click
+
+class MicrographStore:
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        self.objects_dir = os.path.join(store_dir, "objects")
+        os.makedirs(self.objects_dir, exist_ok=True)
+
+    @staticmethod
+    def key(raw_sha256, params, topaz_version):
+        text = json.dumps({"raw": raw_sha256, "params": params, "topaz_version": topaz_version}, sort_keys=True)
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    def object_path(self, key, ext=".mrc"):
+        return os.path.join(self.objects_dir, key[:2], key + ext)
+
+    def _touch(self, key):
+        try:
+            os.utime(self.object_path(key, ".json"))
+        except OSError:
+            pass
+
+    #
+    # link()
+    # link the stored micrograph of key to dest, replacing dest.
+    #
+    # return:
+    # "hardlink" or "symlink", None if key is not in the store
+    #
+    def link(self, key, dest):
+        source = self.object_path(key)
+        if not os.path.exists(source):
+            return None
+        # unique per process, the array tasks of a sharded preprocess link concurrently
+        tmp = f"{dest}.{os.getpid()}.store.tmp"
+        remove_file(tmp)
+        try:
+            os.link(source, tmp)
+            kind = "hardlink"
+        except FileNotFoundError:
+            # evicted in the meantime
+            return None
+        except OSError:
+            os.symlink(source, tmp)
+            kind = "symlink"
+        os.replace(tmp, dest)
+        self._touch(key)
+        return kind
+
+    #
+    # put()
+    # add the micrograph at path to the store under key.  path is hardlinked into the
+    # store; across file systems it is copied and path is replaced by a symlink to the
+    # stored copy.  An object added concurrently by another run is kept.
+    #
+    def put(self, key, path, metadata):
+        target = self.object_path(key)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        if os.path.exists(target):
+            self._touch(key)
+            return
+        tmp = f"{target}.{os.getpid()}.tmp"
+        remove_file(tmp)
+        try:
+            os.link(path, tmp)
+            copied = False
+        except OSError:
+            shutil.copyfile(path, tmp)
+            copied = True
+
+        metadata = dict(metadata, size=os.path.getsize(tmp), created=time.time())
+        with open(tmp + ".json", "w") as f:
+            json.dump(metadata, f, indent=1)
+        os.replace(tmp + ".json", self.object_path(key, ".json"))
+        os.replace(tmp, target)
+
+        if copied:
+            link_tmp = path + ".store.tmp"
+            remove_file(link_tmp)
+            os.symlink(target, link_tmp)
+            os.replace(link_tmp, path)
+
+    #
+    # entries()
+    # (last_used, size, links, key) of every object, least recently used first
+    #
+    def entries(self):
+        entries = []
+        for prefix in sorted(os.listdir(self.objects_dir)):
+            directory = os.path.join(self.objects_dir, prefix)
+            for name in os.listdir(directory):
+                if not name.endswith(".mrc"):
+                    continue
+                key = name[:-len(".mrc")]
+                try:
+                    st = os.stat(os.path.join(directory, name))
+                except FileNotFoundError:
+                    continue
+                try:
+                    last_used = os.stat(self.object_path(key, ".json")).st_mtime
+                except FileNotFoundError:
+                    last_used = st.st_mtime
+                entries.append((last_used, st.st_size, st.st_nlink, key))
+        return sorted(entries)
+
+    #
+    # evict()
+    # remove least recently used objects until the store holds at most max_bytes.
+    # keep_linked skips objects still hardlinked from a run, removing them frees no space.
+    #
+    # return:
+    # (objects removed, bytes removed from the store, bytes freed on disk)
+    #
+    def evict(self, max_bytes, keep_linked=False, dry_run=False):
+        entries = self.entries()
+        total = sum(size for _, size, _, _ in entries)
+        removed = removed_bytes = freed_bytes = 0
+        for last_used, size, links, key in entries:
+            if total <= max_bytes:
+                break
+            if keep_linked and links > 1:
+                continue
+            if not dry_run:
+                remove_file(self.object_path(key))
+                remove_file(self.object_path(key, ".json"))
+            total -= size
+            removed += 1
+            removed_bytes += size
+            freed_bytes += size if links == 1 else 0
+        return removed, removed_bytes, freed_bytes
+
+def remove_file(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+SIZE_UNITS = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+
+def parse_size(text):
+    # "500G", "1.5T", "1024"
+    match = re.fullmatch(r"\s*([0-9.]+)\s*([KMGT]?)B?\s*", text.upper())
+    if match is None:
+        raise click.BadParameter(f"expected a size like 500G, got {text}")
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2)])
+
+def format_size(size):
+    for unit in ("B", "K", "M", "G"):
+        if size < 1024:
+            return f"{size:.1f}{unit}"
+        size /= 1024
+    return f"{size:.1f}T"
+
+@click.group()
+@click.pass_context
+def cli(ctx):
+    pass
+
+@cli.command(context_settings={"show_default": True})
+@click.option("--store", "store_dir", required=True, help="micrograph store directory")
+def stats(store_dir):
+    """
+    Number of objects and size of the store.
+    """
+    entries = MicrographStore(store_dir).entries()
+    size = sum(entry[1] for entry in entries)
+    linked = sum(entry[1] for entry in entries if entry[2] > 1)
+    click.echo(f"{len(entries)} micrographs, {format_size(size)} ({format_size(linked)} also hardlinked from runs)")
+    if entries:
+        click.echo("least recently used " + time.strftime("%m/%d/%Y, %H:%M:%S", time.localtime(entries[0][0])))
+
+@cli.command(context_settings={"show_default": True})
+@click.option("--store", "store_dir", required=True, help="micrograph store directory")
+@click.option("--max-size", required=True, help="size to evict the store down to, e.g. 500G")
+@click.option("--keep-linked", is_flag=True, help="never evict micrographs still hardlinked from a run")
+@click.option("--dry-run", is_flag=True, help="only report what would be evicted")
+def evict(store_dir, max_size, keep_linked, dry_run):
+    """
+    Evict least recently used micrographs until the store is below --max-size.
+    """
+    removed, removed_bytes, freed_bytes = MicrographStore(store_dir).evict(parse_size(max_size), keep_linked, dry_run)
+    verb = "would evict" if dry_run else "evicted"
+    click.echo(f"{verb} {removed} micrographs, {format_size(removed_bytes)} ({format_size(freed_bytes)} freed on disk)")
+
+if __name__ == "__main__":
+    cli()
@@ -31,6 +31,7 @@ class PipelineSteps(BaseModel):
     run_train: str
     run_extract: str
     run_visualize_picks: str
+    run_evaluate_picks: str = "no"
 
 class TopazParameters(BaseModel):
     boxSize: int    
@@ -43,6 +44,35 @@ class TopazParameters(BaseModel):
     number_of_images_to_visualize: int
     display_plots: str
     score: int
+    max_concurrent_steps: int = 2
+    preprocess_workers: int = 1
+    extract_workers: int = 1
+    extract_threads_per_worker: int = 0
+    execution_mode: str = "subprocess"
+    save_score_maps: str = "no"
+    calculate_centers_mode: str = "occupied"
+    visualize_workers: int = 1
+    evaluate_match_radius: int = 0
+    evaluate_split: str = "test"
+    number_of_epochs: int = 10
+    epoch_size: int = 0
+    micrograph_store: str = "no"
+    resume_training: str = "yes"
+    model_selection: str = "last"
+    early_stopping: str = "no"
+    early_stopping_metric: str = "auprc"
+    early_stopping_patience: int = 3
+    early_stopping_min_delta: float = 0.0
+
+# batch job resources of a step, used by topaz_run --executor local|slurm
+class StepResources(BaseModel):
+    cpus: int = 1
+    mem: str = "8G"
+    time: str = "04:00:00"
+    gpus: int = 0
+    partition: str = ""
+    account: str = ""
+    extra: List[str] = []
 
 class ProcessingConfig(BaseModel):
     experiment: ProcessingExperment
@@ -50,6 +80,15 @@ class ProcessingConfig(BaseModel):
     output: ProcessingOutput
     pipeline: PipelineSteps
     parameters: TopazParameters
+    # {"default": {...}, "<step>": {...}}, a step's entry overrides the fields it sets
+    resources: Dict[str, StepResources] = {}
+
+    def step_resources(self, step):
+        merged = StepResources()
+        for name in ("default", step):
+            if name in self.resources:
+                merged = merged.copy(update=self.resources[name].dict(exclude_unset=True))
+        return merged.dict()
 
     def update_paths(self):
         # Using str.format to dynamically replace placeholders
@@ -90,7 +129,8 @@ def create_boilerplate_json(file_path: str = 'example_parameter.json'):
             run_split_test_train="yes",
             run_train="yes",
             run_extract="yes",
-            run_visualize_picks="yes"
+            run_visualize_picks="yes",
+            run_evaluate_picks="yes"
         ),
         parameters=TopazParameters(
             boxSize=64,            
@@ -102,8 +142,32 @@ def create_boilerplate_json(file_path: str = 'example_parameter.json'):
             extract_radius=14,
             number_of_images_to_visualize=2,
             display_plots="no",
-            score=0
-        )
+            score=0,
+            max_concurrent_steps=2,
+            preprocess_workers=1,
+            extract_workers=1,
+            extract_threads_per_worker=0,
+            execution_mode="subprocess",
+            save_score_maps="no",
+            calculate_centers_mode="occupied",
+            visualize_workers=1,
+            evaluate_match_radius=0,
+            evaluate_split="test",
+            number_of_epochs=10,
+            epoch_size=0,
+            micrograph_store="no",
+            resume_training="yes",
+            model_selection="last",
+            early_stopping="no",
+            early_stopping_metric="auprc",
+            early_stopping_patience=3,
+            early_stopping_min_delta=0.0
+        ),
+        resources={
+            "default": StepResources(cpus=4, mem="16G", time="02:00:00"),
+            "train": StepResources(cpus=8, mem="32G", time="12:00:00", gpus=1),
+            "extract": StepResources(cpus=8, mem="32G", time="04:00:00")
+        }
     )
 
     with open(file_path, "w") as f:
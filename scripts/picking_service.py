@@ -0,0 +1,267 @@
+# picking_service.py
+#  - warm particle picking service for galleries written during collection
+#
+# topaz extract pays for interpreter start, the torch import and loading the model
+# before it scores a single micrograph.  The service loads the model once and answers
+# extraction requests over HTTP, on a TCP port or on a Unix socket:
+#
+#   POST /extract  {"paths": ["/data/gallery/g_0042.mrc"], "radius": 14, "threshold": -6,
+#                   "preprocessed": false}
+#                  -> the picks as a topaz extract particle file (image_name, x_coord,
+#                     y_coord, score; tab separated, coordinates of the preprocessed micrograph)
+#   GET  /health   -> model, requests, images and batches served so far
+#
+# Raw galleries are downsampled and normalized like "topaz preprocess" in the request's
+# thread.  The images of concurrent requests are scored on one thread: images that
+# arrive within max_wait seconds of each other are scored together, up to batch_size
+# images of the same shape in one forward pass.  Non-maximum suppression runs in the
+# request's thread again.
+#
+# Usage - $ topaz_run --file-path params.json serve --port 8765
+#         $ curl -d '{"paths": ["/data/gallery/g_0042.mrc"]}' http://127.0.0.1:8765/extract
+#
+
+import json
+import os
+import queue
+import signal
+import socket
+import socketserver
+import threading
+import time
+from concurrent.futures import Future
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+class PickingService:
+
+    def __init__(self, model_path, radius, threshold=-6.0, downsampling=1, device=-1, batch_size=8,
+                 max_wait=0.02, num_threads=0, log=None, project=""):
+        import torch
+        import topaz.cuda
+        from topaz.commands.normalize import add_arguments
+        from topaz.model.factory import load_model
+
+        if num_threads > 0:
+            torch.set_num_threads(num_threads)
+        self.torch = torch
+        self.use_cuda = topaz.cuda.set_device(device)
+        self.model = load_model(model_path)
+        self.model.eval()
+        self.model.fill()
+        if self.use_cuda:
+            self.model.cuda()
+
+        self.model_path = model_path
+        self.radius = radius
+        self.threshold = threshold
+        self.downsampling = downsampling
+        # the defaults of topaz preprocess, so raw galleries are normalized the same way
+        self.normalize_args = add_arguments().parse_args(["-s", str(downsampling), "unused.mrc"])
+        self.batch_size = max(1, batch_size)
+        self.max_wait = max_wait
+        self.log = log
+        self.project = project
+
+        self.requests = 0
+        self.images = 0
+        self.batches = 0
+        self.lock = threading.Lock()
+        self.queue = queue.Queue()
+        self.scorer = threading.Thread(target=self._score_batches, name="PickingService", daemon=True)
+        self.scorer.start()
+
+    def close(self):
+        self.queue.put(None)
+        self.scorer.join()
+
+    #
+    # prepare()
+    # the micrograph at path as the model sees it, raw galleries are preprocessed
+    #
+    def prepare(self, path, preprocessed):
+        from topaz.stats import normalize
+        from topaz.utils.data.loader import load_image
+        from topaz.utils.image import downsample
+
+        image = load_image(path, make_image=False, return_header=False).astype(np.float32)
+        if preprocessed:
+            return image
+        args = self.normalize_args
+        if args.scale > 1:
+            image = downsample(image, args.scale)
+        image, _ = normalize(image, alpha=args.alpha, beta=args.beta, num_iters=args.niters,
+                             method="affine" if args.affine else "gmm", sample=args.sample, use_cuda=self.use_cuda)
+        return image
+
+    #
+    # extract()
+    # pick the micrographs at paths
+    #
+    # return:
+    # [(image_name, scores, coords)] in the order of paths
+    #
+    def extract(self, paths, preprocessed=False, radius=None, threshold=None):
+        from topaz.algorithms import non_maximum_suppression
+
+        radius = self.radius if radius is None else radius
+        threshold = self.threshold if threshold is None else threshold
+        start_time = time.time()
+
+        # queued as soon as each is prepared, so scoring overlaps preparing the rest
+        futures = []
+        for path in paths:
+            future = Future()
+            self.queue.put((self.prepare(path, preprocessed), future))
+            futures.append(future)
+
+        picks = []
+        for path, future in zip(paths, futures):
+            scores, coords = non_maximum_suppression(future.result(), radius, threshold=threshold)
+            picks.append((os.path.splitext(os.path.basename(path))[0], scores, coords))
+
+        latency = time.time() - start_time
+        with self.lock:
+            self.requests += 1
+            self.images += len(paths)
+        if self.log is not None:
+            count = sum(len(scores) for _, scores, _ in picks)
+            self.log.loginfo("picking_service", f"{count} picks from {len(paths)} micrographs in {latency:.3f} seconds")
+            self.log.logperf(self.project, "picking_service", "request_latency", f"{latency:.3f}", "seconds")
+        return picks
+
+    def _score_batches(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            batch = [item]
+            deadline = time.time() + self.max_wait
+            while len(batch) < self.batch_size:
+                try:
+                    item = self.queue.get(timeout=max(0.0, deadline - time.time()))
+                except queue.Empty:
+                    break
+                if item is None:
+                    self.queue.put(None)
+                    break
+                batch.append(item)
+
+            # one forward pass per image shape
+            by_shape = {}
+            for image, future in batch:
+                by_shape.setdefault(image.shape, []).append((image, future))
+            for group in by_shape.values():
+                try:
+                    with self.torch.no_grad():
+                        x = self.torch.from_numpy(np.stack([image for image, _ in group])).unsqueeze(1)
+                        if self.use_cuda:
+                            x = x.cuda()
+                        scores = self.model(x)[:, 0].cpu().numpy()
+                except Exception as e:
+                    for _, future in group:
+                        future.set_exception(e)
+                    continue
+                for (_, future), score in zip(group, scores):
+                    future.set_result(score)
+                with self.lock:
+                    self.batches += 1
+
+    def health(self):
+        with self.lock:
+            return {"model": self.model_path, "radius": self.radius, "threshold": self.threshold,
+                    "downsampling": self.downsampling, "requests": self.requests, "images": self.images,
+                    "batches": self.batches}
+
+def format_picks(picks):
+    # same line format as topaz extract
+    lines = ["image_name\tx_coord\ty_coord\tscore"]
+    for name, scores, coords in picks:
+        for i in range(len(scores)):
+            lines.append(f"{name}\t{coords[i, 0]}\t{coords[i, 1]}\t{scores[i]}")
+    return "\n".join(lines) + "\n"
+
+class PickingRequestHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.rstrip("/") != "/health":
+            return self.reply(HTTPStatus.NOT_FOUND, "unknown path " + self.path + "\n")
+        self.reply(HTTPStatus.OK, json.dumps(self.server.service.health()) + "\n", "application/json")
+
+    def do_POST(self):
+        if self.path.rstrip("/") != "/extract":
+            return self.reply(HTTPStatus.NOT_FOUND, "unknown path " + self.path + "\n")
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            paths = body["paths"]
+            if isinstance(paths, str):
+                paths = [paths]
+            missing = [path for path in paths if not os.path.isfile(path)]
+            if missing:
+                return self.reply(HTTPStatus.NOT_FOUND, "no such file " + missing[0] + "\n")
+            radius = int(body["radius"]) if body.get("radius") is not None else None
+            threshold = float(body["threshold"]) if body.get("threshold") is not None else None
+        except (ValueError, KeyError, TypeError) as e:
+            return self.reply(HTTPStatus.BAD_REQUEST, f"expected {{\"paths\": [...]}}: {e!r}\n")
+        try:
+            picks = self.server.service.extract(paths, bool(body.get("preprocessed", False)), radius, threshold)
+        except Exception as e:
+            return self.reply(HTTPStatus.INTERNAL_SERVER_ERROR, f"{e!r}\n")
+        self.reply(HTTPStatus.OK, format_picks(picks), "text/tab-separated-values")
+
+    def reply(self, status, text, content_type="text/plain"):
+        data = text.encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return self.client_address[0] if self.client_address else "unix"
+
+    def log_message(self, format, *args):
+        log = self.server.service.log
+        if log is not None:
+            log.loginfo("picking_service", f"{self.address_string()} {format % args}")
+
+class UnixHTTPServer(ThreadingHTTPServer):
+    address_family = socket.AF_UNIX
+
+    def server_bind(self):
+        socketserver.TCPServer.server_bind(self)
+        self.server_name = "localhost"
+        self.server_port = 0
+
+#
+# serve()
+# answer requests for service on a Unix socket, or on host:port, until interrupted
+#
+def serve(service, host="127.0.0.1", port=8765, unix_socket=None):
+    if unix_socket is not None:
+        if os.path.exists(unix_socket):
+            os.remove(unix_socket)
+        server = UnixHTTPServer(unix_socket, PickingRequestHandler)
+        address = "unix:" + unix_socket
+    else:
+        server = ThreadingHTTPServer((host, port), PickingRequestHandler)
+        address = f"http://{host}:{server.server_port}"
+    server.service = service
+    if service.log is not None:
+        service.log.loginfo("picking_service", f"serving {service.model_path} on {address}")
+
+    def stop(signum, frame):
+        raise KeyboardInterrupt()
+    signal.signal(signal.SIGTERM, stop)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+        if unix_socket is not None and os.path.exists(unix_socket):
+            os.remove(unix_socket)
@@ -0,0 +1,87 @@
+# pipeline_graph.py
+#  - dependency graph and scheduler for the topaz_run pipeline steps
+#
+# A step depends on another step when one of its inputs is one of the other step's
+# outputs (file paths, or glob patterns matching them).  Steps whose dependencies have
+# completed are run concurrently on a thread pool, up to max_workers at a time.  When a
+# step fails every step downstream of it is blocked rather than run on stale inputs.
+#
+
+import fnmatch
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+class PipelineStep:
+
+    def __init__(self, name, execute, inputs, outputs):
+        self.name = name
+        self.execute = execute
+        self.inputs = inputs
+        self.outputs = outputs
+
+    def consumes(self, other):
+        for path in self.inputs:
+            for pattern in other.outputs:
+                if path == pattern or fnmatch.fnmatch(path, pattern) or fnmatch.fnmatch(pattern, path):
+                    return True
+        return False
+
+#
+# build_dependencies()
+# returns {step name: [names of the steps it depends on]} for the given steps,
+# which are in pipeline order.  Only the given (selected) steps are considered;
+# the outputs of unselected steps are expected to exist from an earlier run.
+#
+def build_dependencies(steps):
+    dependencies = {}
+    for i, step in enumerate(steps):
+        dependencies[step.name] = [other.name for other in steps[:i] if step.consumes(other)]
+    return dependencies
+
+#
+# run_graph()
+# run the steps respecting their dependencies.  run_step(step) is called from a
+# worker thread and signals failure by raising.
+#
+# returns {step name: "done" | "failed" | "blocked"} and {step name: exception}
+#
+def run_graph(steps, run_step, max_workers=1, log=None):
+
+    dependencies = build_dependencies(steps)
+    by_name = {step.name: step for step in steps}
+    status = {}
+    errors = {}
+    pending = [step.name for step in steps]
+    running = {}
+
+    def ready(name):
+        return all(status.get(dep) == "done" for dep in dependencies[name])
+
+    def blocked(name):
+        return any(status.get(dep) in ("failed", "blocked") for dep in dependencies[name])
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as pool:
+        while pending or running:
+            for name in list(pending):
+                if blocked(name):
+                    pending.remove(name)
+                    status[name] = "blocked"
+                    if log:
+                        log.loginfo("run_graph", f"{name}: blocked by a failed dependency")
+                elif ready(name) and len(running) < max(1, max_workers):
+                    pending.remove(name)
+                    if log:
+                        log.loginfo("run_graph", f"{name}: started")
+                    running[pool.submit(run_step, by_name[name])] = name
+            if not running:
+                continue
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    future.result()
+                    status[name] = "done"
+                except Exception as e:
+                    status[name] = "failed"
+                    errors[name] = e
+
+    return status, errors
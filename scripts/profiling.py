@@ -0,0 +1,119 @@
+# profiling.py
+#  - profile the topaz_run driver and the steps it runs in-process
+#
+# PipelineProfiler.profile(name) profiles the calling thread while the block runs and
+# writes two files to the profile directory:
+#   <name>.pstats     - cProfile statistics (python -m pstats, snakeviz, ...)
+#   <name>.collapsed  - stacks sampled every interval seconds in collapsed format,
+#                       "frame;frame;frame count" per line, for flamegraph.pl/speedscope
+#
+# Steps run on pipeline_graph worker threads, so every step gets its own profile.  On
+# Pythons where only one cProfile can be active at a time, a step that overlaps
+# another profiled step is only sampled.
+#
+# With profile_children, "topaz ..." and "python -m ..." commands run as child
+# processes are started under "python -m cProfile -o <profile dir>/<module>.pstats".
+#
+
+import cProfile
+import os
+import re
+import shutil
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+#
+# StackSampler
+# samples the stack of one thread from a background thread
+#
+class StackSampler(threading.Thread):
+
+    def __init__(self, thread_id, interval=0.01):
+        super().__init__(name="StackSampler", daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+    def write(self, file_path):
+        with open(file_path, "w") as f:
+            for stack, count in sorted(self.stacks.items()):
+                f.write(f"{stack} {count}\n")
+
+def profile_name(log_module):
+    # "execute_extract[shard 003]" -> "execute_extract.shard003"
+    return re.sub(r"\[shard (\d+)\]", r".shard\1", log_module).replace(" ", "_")
+
+class PipelineProfiler:
+
+    def __init__(self, profile_dir, log=None, profile_children=False, interval=0.01):
+        self.profile_dir = profile_dir
+        self.log = log
+        self.profile_children = profile_children
+        self.interval = interval
+        os.makedirs(profile_dir, exist_ok=True)
+
+    #
+    # profile()
+    # cProfile and stack sampling of the calling thread for the duration of the block
+    #
+    @contextmanager
+    def profile(self, name):
+
+        profile = cProfile.Profile()
+        sampler = StackSampler(threading.get_ident(), self.interval)
+        try:
+            profile.enable()
+        except ValueError:
+            # another profiler is active in this process, sample only
+            profile = None
+        sampler.start()
+        start_time = time.time()
+        try:
+            yield
+        finally:
+            if profile is not None:
+                profile.disable()
+            sampler.stop()
+            base = os.path.join(self.profile_dir, profile_name(name))
+            if profile is not None:
+                profile.dump_stats(base + ".pstats")
+            sampler.write(base + ".collapsed")
+            if self.log is not None:
+                self.log.loginfo("profile", f"{name}: {time.time() - start_time:.2f} seconds profiled, "
+                                            f"{sum(sampler.stacks.values())} samples written to {base}.*")
+
+    #
+    # wrap_command()
+    # run python child commands under cProfile when profile_children is set
+    #
+    def wrap_command(self, command, log_module):
+
+        if not self.profile_children:
+            return command
+        output = os.path.join(self.profile_dir, "child_" + profile_name(log_module) + ".pstats")
+        if command.startswith("topaz "):
+            topaz = shutil.which("topaz")
+            if topaz is not None:
+                return sys.executable + " -m cProfile -o " + output + " " + topaz + command[len("topaz"):]
+        elif command.startswith(sys.executable + " -m "):
+            return sys.executable + " -m cProfile -o " + output + command[len(sys.executable):]
+        return command
@@ -0,0 +1,179 @@
+# resource_usage.py
+#  - CPU time, peak RSS, I/O and context switches of child processes and pipeline steps
+#
+# A child is waited for in two stages: os.waitid(WNOWAIT) returns once it has exited
+# but leaves it unreaped, so /proc/<pid>/io can still be read (it includes the I/O of
+# the child's own reaped children, e.g. topaz under "sh -c").  os.wait4 then reaps it
+# and returns its rusage, which likewise covers the whole process tree.
+#
+# Commands run in-process are measured with getrusage(RUSAGE_SELF), getrusage(RUSAGE_CHILDREN)
+# (worker pools of the command) and /proc/self/io deltas, which also count any other
+# thread or child of topaz_run finishing work at the same time.
+#
+# The usage of every command is added to the total of the pipeline step it belongs
+# to ("execute_extract[shard 003]" belongs to "execute_extract"), and run_step writes
+# the step total to the perflog.
+#
+
+import os
+import resource
+import sys
+import threading
+
+# (metric, unit) written to the perflog
+METRICS = [
+    ("user_time", "seconds"),
+    ("system_time", "seconds"),
+    ("max_rss", "kilobytes"),
+    ("read_bytes", "bytes"),
+    ("write_bytes", "bytes"),
+    ("read_chars", "bytes"),
+    ("write_chars", "bytes"),
+    ("voluntary_context_switches", "count"),
+    ("involuntary_context_switches", "count"),
+]
+
+_step_usage = {}
+_step_lock = threading.Lock()
+
+class ResourceUsage:
+
+    def __init__(self, user_time=0.0, system_time=0.0, max_rss=0, io=None,
+                 voluntary_context_switches=0, involuntary_context_switches=0):
+        self.user_time = user_time
+        self.system_time = system_time
+        self.max_rss = max_rss
+        # read_bytes/write_bytes - storage I/O, read_chars/write_chars - all read()/write()
+        # bytes including network file systems.  None where /proc is not available.
+        io = io or {}
+        self.read_bytes = io.get("read_bytes")
+        self.write_bytes = io.get("write_bytes")
+        self.read_chars = io.get("rchar")
+        self.write_chars = io.get("wchar")
+        self.voluntary_context_switches = voluntary_context_switches
+        self.involuntary_context_switches = involuntary_context_switches
+
+    @classmethod
+    def from_rusage(cls, rusage, io=None):
+        return cls(rusage.ru_utime, rusage.ru_stime, max_rss_kilobytes(rusage.ru_maxrss), io,
+                   rusage.ru_nvcsw, rusage.ru_nivcsw)
+
+    #
+    # add()
+    # accumulate other into this usage.  Times, I/O and switches add up, max_rss is
+    # the largest of the two.
+    #
+    def add(self, other):
+        for name in ("user_time", "system_time", "read_bytes", "write_bytes", "read_chars",
+                     "write_chars", "voluntary_context_switches", "involuntary_context_switches"):
+            mine, theirs = getattr(self, name), getattr(other, name)
+            setattr(self, name, theirs if mine is None else mine if theirs is None else mine + theirs)
+        self.max_rss = max(self.max_rss, other.max_rss)
+        return self
+
+    def log(self, log, project, module):
+        for metric, unit in METRICS:
+            value = getattr(self, metric)
+            if value is None:
+                continue
+            measure = f"{value:.2f}" if isinstance(value, float) else str(value)
+            log.logperf(project, module, metric, measure, unit)
+
+def max_rss_kilobytes(ru_maxrss):
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    return ru_maxrss // 1024 if sys.platform == "darwin" else ru_maxrss
+
+#
+# read_proc_io()
+# the counters of /proc/<pid>/io as a dict, None where they are not readable
+#
+def read_proc_io(pid="self"):
+    try:
+        with open(f"/proc/{pid}/io", "r") as f:
+            return {key: int(value) for key, value in (line.split(":") for line in f if ":" in line)}
+    except (OSError, ValueError):
+        return None
+
+#
+# wait_for_exit()
+# wait for a subprocess.Popen child, reap it and measure it.  Sets process.returncode.
+#
+# return:
+# a ResourceUsage, or None where wait4 is not available
+#
+def wait_for_exit(process):
+
+    if not hasattr(os, "wait4"):
+        process.wait()
+        return None
+
+    io = None
+    if hasattr(os, "waitid"):
+        try:
+            os.waitid(os.P_PID, process.pid, os.WEXITED | os.WNOWAIT)
+            io = read_proc_io(process.pid)
+        except ChildProcessError:
+            pass
+
+    try:
+        _, status, rusage = os.wait4(process.pid, 0)
+    except ChildProcessError:
+        # already reaped elsewhere, nothing left to measure
+        process.wait()
+        return None
+
+    if os.WIFSIGNALED(status):
+        process.returncode = -os.WTERMSIG(status)
+    else:
+        process.returncode = os.WEXITSTATUS(status)
+    return ResourceUsage.from_rusage(rusage, io)
+
+#
+# SelfUsage
+# getrusage and /proc/self/io deltas for work done inside this process and by the
+# children it reaped in the meantime
+#
+class SelfUsage:
+
+    def __init__(self):
+        self.rusage = [resource.getrusage(who) for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)]
+        self.io = read_proc_io()
+
+    def delta(self):
+        rusage = [resource.getrusage(who) for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)]
+        io = read_proc_io()
+        if io is not None and self.io is not None:
+            io = {key: value - self.io.get(key, 0) for key, value in io.items()}
+
+        def change(field):
+            return sum(getattr(now, field) - getattr(before, field) for now, before in zip(rusage, self.rusage))
+
+        return ResourceUsage(change("ru_utime"), change("ru_stime"),
+                             # peaks of the process and of its largest child, not of the interval
+                             max_rss_kilobytes(max(usage.ru_maxrss for usage in rusage)), io,
+                             change("ru_nvcsw"), change("ru_nivcsw"))
+
+#
+# begin_step() / record() / end_step()
+# per step totals.  record() adds the usage of a command logged under log_module to
+# the step it belongs to, end_step() returns the total (None if no command ran).
+#
+def begin_step(step_module):
+    with _step_lock:
+        _step_usage[step_module] = None
+
+def record(log_module, usage):
+    if usage is None:
+        return
+    step_module = log_module.split("[", 1)[0]
+    with _step_lock:
+        if step_module not in _step_usage:
+            return
+        if _step_usage[step_module] is None:
+            _step_usage[step_module] = ResourceUsage().add(usage)
+        else:
+            _step_usage[step_module].add(usage)
+
+def end_step(step_module):
+    with _step_lock:
+        return _step_usage.pop(step_module, None)
@@ -0,0 +1,123 @@
+# score_maps.py
+#  - extraction through saved per-micrograph score maps
+#
+# extract - score every micrograph with the model once, save each score map as
+#           <score-maps>/<image_name>.npy and write the picks for one radius,
+#           in the same format as "topaz extract"
+# peaks   - re-run non-maximum suppression on saved score maps for a list of radii
+#           and thresholds without loading the model.  Maps are memory mapped.
+#
+# Usage - $ python -m scripts.score_maps extract -m model.sav -r 14 --score-maps dir -o picks.txt micrographs/*.mrc
+#         $ topaz_score_maps peaks --score-maps dir --radii 8,10,12 --thresholds -6,0 --output-dir dir
+
+import glob
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import click
+import numpy as np
+
+@click.group()
+@click.pass_context
+def cli(ctx):
+    pass
+
+#
+# expand_image_args()
+# expand @file arguments (one path per line, as written by sharding.write_shard_list)
+#
+def expand_image_args(images):
+    paths = []
+    for image in images:
+        if image.startswith("@"):
+            with open(image[1:], "r") as f:
+                paths.extend(line.strip() for line in f if line.strip())
+        else:
+            paths.append(image)
+    return paths
+
+def image_name(path):
+    return os.path.splitext(os.path.basename(path))[0]
+
+#
+# score_micrographs()
+# yields (image_name, score_map) for every micrograph, scoring with the model once
+#
+def score_micrographs(model, paths, device=0):
+    from topaz.extract import score_images
+    for path, scores in score_images(model, paths, device=device):
+        yield image_name(path), scores
+
+def non_maximum_suppression(score_map_path, radius, threshold):
+    from topaz.algorithms import non_maximum_suppression as nms
+    scores = np.load(score_map_path, mmap_mode="r")
+    return nms(np.asarray(scores), radius, threshold=threshold)
+
+def write_picks(f, name, scores, coords):
+    # same line format as topaz extract
+    for i in range(len(scores)):
+        print(f"{name}\t{coords[i,0]}\t{coords[i,1]}\t{scores[i]}", file=f)
+
+def _peaks_for_map(args):
+    path, radius, threshold = args
+    scores, coords = non_maximum_suppression(path, radius, threshold)
+    return image_name(path), scores, coords
+
+@cli.command(context_settings={"show_default": True})
+@click.option("-m", "--model", required=True, help="path to the trained model")
+@click.option("-r", "--radius", type=int, required=True, help="non-maximum suppression radius")
+@click.option("-t", "--threshold", type=float, default=-6, help="log-likelihood score threshold")
+@click.option("--score-maps", "score_map_dir", required=True, help="directory to save the score maps in")
+@click.option("-o", "--output", required=True, help="particle file to write")
+@click.option("-d", "--device", type=int, default=0, help="which device to use, <0 corresponds to CPU")
+@click.option("-j", "--num-threads", type=int, default=0, help="number of threads for pytorch, 0 uses pytorch defaults")
+@click.argument("images", nargs=-1, required=True)
+def extract(model, radius, threshold, score_map_dir, output, device, num_threads, images):
+
+    if num_threads > 0:
+        import torch
+        torch.set_num_threads(num_threads)
+
+    os.makedirs(score_map_dir, exist_ok=True)
+    paths = expand_image_args(images)
+
+    with open(output, "w") as f:
+        print("image_name\tx_coord\ty_coord\tscore", file=f)
+        for name, scores in score_micrographs(model, paths, device):
+            score_map_path = os.path.join(score_map_dir, name + ".npy")
+            np.save(score_map_path, scores.astype(np.float32, copy=False))
+            picks, coords = non_maximum_suppression(score_map_path, radius, threshold)
+            write_picks(f, name, picks, coords)
+            print(f"# Extracted {len(picks)} particles from {name}", file=sys.stderr, flush=True)
+
+@cli.command(context_settings={"show_default": True})
+@click.option("--score-maps", "score_map_dir", required=True, help="directory of saved score maps")
+@click.option("--radii", required=True, help="comma separated non-maximum suppression radii")
+@click.option("--thresholds", default="-6", help="comma separated log-likelihood score thresholds")
+@click.option("--output-dir", required=True, help="directory for predicted_particles_r<radius>_t<threshold>.txt")
+@click.option("--num-workers", type=int, default=1, help="number of processes running non-maximum suppression")
+def peaks(score_map_dir, radii, thresholds, output_dir, num_workers):
+
+    score_maps = sorted(glob.glob(os.path.join(score_map_dir, "*.npy")))
+    if not score_maps:
+        raise click.ClickException("no score maps found in " + score_map_dir)
+    radii = [int(radius) for radius in radii.split(",")]
+    thresholds = [float(threshold) for threshold in thresholds.split(",")]
+    os.makedirs(output_dir, exist_ok=True)
+
+    with ProcessPoolExecutor(max_workers=max(1, num_workers)) as pool:
+        for radius in radii:
+            for threshold in thresholds:
+                output = os.path.join(output_dir, f"predicted_particles_r{radius}_t{threshold:g}.txt")
+                count = 0
+                with open(output, "w") as f:
+                    print("image_name\tx_coord\ty_coord\tscore", file=f)
+                    tasks = [(path, radius, threshold) for path in score_maps]
+                    for name, scores, coords in pool.map(_peaks_for_map, tasks):
+                        write_picks(f, name, scores, coords)
+                        count += len(scores)
+                print(f"# radius={radius} threshold={threshold:g} picks={count} -> {output}", file=sys.stderr)
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,83 @@
+# sharding.py
+#  - split a set of micrographs into balanced shards for parallel topaz workers
+#
+# Shards are balanced by total file size rather than file count, so a shard of large
+# galleries does not hold up the whole step.  Shard lists are handed to topaz as
+# @file arguments (one path per line), which keeps the command line short for
+# thousands of galleries.
+#
+
+import glob
+import heapq
+import os
+
+#
+# expand_images()
+# expand a glob pattern, or an @file list written by write_shard_list, into a
+# sorted list of paths
+#
+def expand_images(pattern):
+    if pattern.startswith("@"):
+        with open(pattern[1:], "r") as f:
+            return sorted(line.strip() for line in f if line.strip())
+    return sorted(glob.glob(pattern))
+
+#
+# balanced_shards()
+# split paths into at most n shards of roughly equal total size (longest processing
+# time first).  The result is deterministic for a given set of files: shards are
+# ordered by their first path and the paths within a shard are sorted.
+#
+def balanced_shards(paths, n):
+    n = max(1, min(n, len(paths)))
+    sized = sorted(((os.path.getsize(path), path) for path in paths), key=lambda item: (-item[0], item[1]))
+    heap = [(0, i) for i in range(n)]
+    shards = [[] for _ in range(n)]
+    for size, path in sized:
+        total, i = heapq.heappop(heap)
+        shards[i].append(path)
+        heapq.heappush(heap, (total + size, i))
+    shards = [sorted(shard) for shard in shards if shard]
+    return sorted(shards, key=lambda shard: shard[0])
+
+#
+# write_shard_list()
+# write the paths of one shard to file_path, one per line, and return the
+# "@file_path" argument that expands to them on the topaz command line.
+#
+def write_shard_list(paths, file_path):
+    with open(file_path, "w") as f:
+        for path in paths:
+            f.write(path + "\n")
+    return "@" + file_path
+
+#
+# merge_particle_files()
+# merge per-shard topaz particle files (image_name, x_coord, y_coord, score) into a
+# single file with the same schema.  Images are written in sorted name order, which
+# is the order a single topaz run over the sorted glob produces, and the picks of
+# each image keep the order topaz wrote them in.
+#
+# returns the number of picks written
+#
+def merge_particle_files(shard_files, output_file):
+    header = None
+    picks = {}
+    for shard_file in shard_files:
+        with open(shard_file, "r") as f:
+            shard_header = f.readline()
+            if header is None:
+                header = shard_header
+            for line in f:
+                if line.strip():
+                    picks.setdefault(line.split("\t", 1)[0], []).append(line)
+
+    count = 0
+    tmp_file = output_file + ".tmp"
+    with open(tmp_file, "w") as f:
+        f.write(header if header is not None else "image_name\tx_coord\ty_coord\tscore\n")
+        for image_name in sorted(picks):
+            f.writelines(picks[image_name])
+            count += len(picks[image_name])
+    os.replace(tmp_file, output_file)
+    return count
@@ -0,0 +1,158 @@
+# shell_runner.py
+#  - run a shell command and stream its output into the event log as it arrives
+#
+# stdout and stderr are read line by line on two reader threads, so a long
+# "topaz train" shows up in topaz_event.log while it runs and the output never
+# accumulates in memory.  Lines that report topaz progress are turned into
+# progress/ETA records, and the return code, wall time and resource usage (CPU time,
+# peak RSS, I/O, context switches) of every child are written to the perflog.
+#
+
+import os
+import re
+import signal
+import subprocess
+import threading
+import time
+
+from scripts import resource_usage
+
+# topaz progress lines
+#   preprocess -v       "# processed: <name>"
+#   extract -v          "# Extracted <n> particles from <name>"
+#   train (to stdout)   "<epoch>\t<iter>\ttrain\t..."
+PROCESSED_ITEM = re.compile(r"^# (processed:|Extracted \d+ particles from) ")
+TRAIN_ITERATION = re.compile(r"^(\d+)\t(\d+)\t(train|test)\t")
+PERCENT = re.compile(r"(\d{1,3})%\|")
+
+class CommandResult:
+
+    def __init__(self, command, returncode, wall_time, usage=None, stopped=False):
+        self.command = command
+        self.returncode = returncode
+        self.wall_time = wall_time
+        self.usage = usage
+        # terminated because the caller set its stop event
+        self.stopped = stopped
+
+#
+# ProgressTracker
+# counts completed items from topaz output lines.  With a known total it reports the
+# fraction done and an ETA extrapolated from the elapsed time.  Records are written
+# at most once per interval seconds.
+#
+class ProgressTracker:
+
+    def __init__(self, log, log_module, total=None, interval=10.0):
+        self.log = log
+        self.log_module = log_module
+        self.total = total
+        self.interval = interval
+        self.done = 0
+        self.start_time = time.time()
+        self.last_report = 0.0
+        self.lock = threading.Lock()
+
+    def update(self, line):
+        if PROCESSED_ITEM.match(line):
+            with self.lock:
+                self.done += 1
+                done = self.done
+        elif TRAIN_ITERATION.match(line):
+            with self.lock:
+                self.done = int(TRAIN_ITERATION.match(line).group(2))
+                done = self.done
+        elif PERCENT.search(line) and self.total is None:
+            with self.lock:
+                self.done = int(PERCENT.search(line).group(1))
+                self.total = 100
+                done = self.done
+        else:
+            return
+        now = time.time()
+        if now - self.last_report >= self.interval or (self.total and done >= self.total):
+            self.last_report = now
+            self.report(done, now - self.start_time)
+
+    def report(self, done, elapsed):
+        if self.total:
+            fraction = min(1.0, done / self.total)
+            eta = elapsed / fraction - elapsed if fraction > 0 else float("nan")
+            self.log.loginfo(self.log_module, f"progress {done}/{self.total} ({100 * fraction:.1f}%) "
+                                              f"elapsed {elapsed:.1f}s eta {eta:.1f}s")
+        else:
+            self.log.loginfo(self.log_module, f"progress {done} elapsed {elapsed:.1f}s")
+
+#
+# run_command()
+# run command in a shell, streaming its output into log under log_module.
+#
+# input:
+# command - the shell command
+# log - a logger.Logger
+# log_module - the module name output and progress are logged under
+# project - the project name used in perflog records (the run output directory)
+# env - full environment for the child, None inherits ours
+# total_items - number of images the command will process, used for the ETA
+# stop - optional threading.Event, the command is terminated when it is set
+#
+# return:
+# a CommandResult
+#
+def run_command(command, log, log_module, project, env=None, total_items=None, stop=None):
+
+    progress = ProgressTracker(log, log_module, total_items)
+
+    start_time = time.time()
+    # a stoppable command gets its own process group, so the shell and what it
+    # started are terminated together
+    process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env,
+                               start_new_session=stop is not None)
+
+    def pump(pipe):
+        with pipe:
+            for raw_line in iter(pipe.readline, b""):
+                line = raw_line.decode(errors="replace").rstrip("\n")
+                log.loginfo(log_module, line)
+                progress.update(line)
+
+    readers = [threading.Thread(target=pump, args=(pipe,), daemon=True)
+               for pipe in (process.stdout, process.stderr)]
+    for reader in readers:
+        reader.start()
+
+    finished = threading.Event()
+    stopped = []
+    terminator = None
+    if stop is not None:
+        def terminate():
+            while not finished.is_set():
+                if stop.wait(0.5):
+                    stopped.append(True)
+                    try:
+                        os.killpg(process.pid, signal.SIGTERM)
+                    except ProcessLookupError:
+                        pass
+                    return
+        terminator = threading.Thread(target=terminate, daemon=True)
+        terminator.start()
+
+    for reader in readers:
+        reader.join()
+    usage = resource_usage.wait_for_exit(process)
+    finished.set()
+    if terminator is not None:
+        terminator.join()
+    returncode = process.returncode
+    wall_time = time.time() - start_time
+
+    if stopped:
+        log.loginfo(log_module, f"stopped after {wall_time:.2f} seconds")
+    log.loginfo(log_module, f"exit code {returncode} after {wall_time:.2f} seconds")
+    log.logperf(project, log_module, "returncode", str(returncode), "code")
+    log.logperf(project, log_module, "wall_time", f"{wall_time:.2f}", "seconds")
+    if usage is not None:
+        usage.log(log, project, log_module)
+        resource_usage.record(log_module, usage)
+
+    return CommandResult(command, returncode, wall_time, usage, bool(stopped))
@@ -0,0 +1,213 @@
+# step_cache.py
+#  - content addressed step manifests for topaz_run
+#
+# Every pipeline step records a manifest of what it consumed:
+#   the ProcessingConfig fields the step reads
+#   size, mtime and sha256 of every input file
+#   the installed topaz version
+# and what it produced (size and mtime of every output file).
+#
+# On the next run a step is skipped when the manifest of its current inputs has the
+# same fields, topaz version and input file contents (sha256) as the recorded one and
+# the recorded outputs are still on disk, unchanged.  Size and mtime only decide
+# whether a file is hashed again, so an unchanged session costs one stat() per file
+# and an input rewritten with the same bytes does not re-run the step.
+#
+# manifests live in <output.dir>/.step_cache/<step>.json
+#
+
+import glob
+import hashlib
+import json
+import os
+import subprocess
+
+HASH_BLOCK_SIZE = 4 * 1024 * 1024
+
+_topaz_version = None
+
+# sha256 of files hashed or checked by this process, by (path, size, mtime_ns)
+_sha256_memo = {}
+
+#
+# topaz_version()
+# returns the installed topaz version string, "unknown" if it cannot be determined.
+# the lookup is done once per process.
+#
+def topaz_version():
+    global _topaz_version
+    if _topaz_version is None:
+        try:
+            from importlib.metadata import version
+            _topaz_version = version("topaz-em")
+        except Exception:
+            try:
+                output = subprocess.run(["topaz", "--version"], stdout=subprocess.PIPE,
+                                        stderr=subprocess.STDOUT, check=True)
+                _topaz_version = output.stdout.decode(errors="replace").strip()
+            except Exception:
+                _topaz_version = "unknown"
+    return _topaz_version
+
+#
+# expand_paths()
+# expand a list of file paths and glob patterns into a sorted list of file paths.
+# a pattern that matches nothing is kept as is so that it is recorded as missing.
+#
+def expand_paths(patterns):
+    paths = []
+    for pattern in patterns:
+        if glob.has_magic(pattern):
+            paths.extend(sorted(glob.glob(pattern)))
+        else:
+            paths.append(pattern)
+    return paths
+
+def sha256_file(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+#
+# cached_sha256()
+# sha256 of path, reusing a hash this process already computed or took from a
+# manifest for the same size and mtime
+#
+def cached_sha256(path):
+    st = os.stat(path)
+    key = (path, st.st_size, st.st_mtime_ns)
+    if key not in _sha256_memo:
+        _sha256_memo[key] = sha256_file(path)
+    return _sha256_memo[key]
+
+#
+# manifest_content()
+# the manifest without sizes and mtimes, what decides whether a step is current
+#
+def manifest_content(manifest):
+    files = {path: record.get("sha256") for path, record in manifest["files"].items()}
+    return dict(manifest, files=files)
+
+def manifest_digest(manifest):
+    text = json.dumps(manifest, sort_keys=True)
+    return hashlib.sha256(text.encode()).hexdigest()
+
+class StepCache:
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    def manifest_path(self, step):
+        return os.path.join(self.cache_dir, step + ".json")
+
+    def load(self, step):
+        try:
+            with open(self.manifest_path(step), "r") as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    #
+    # file_record()
+    # size, mtime and sha256 of a file.  The hash of the previous record is reused
+    # when size and mtime are unchanged.
+    #
+    def file_record(self, path, previous=None, with_hash=True):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return {"missing": True}
+        record = {"size": st.st_size, "mtime_ns": st.st_mtime_ns}
+        if with_hash:
+            if previous is not None and previous.get("size") == st.st_size \
+                    and previous.get("mtime_ns") == st.st_mtime_ns and "sha256" in previous:
+                record["sha256"] = previous["sha256"]
+            else:
+                record["sha256"] = sha256_file(path)
+            _sha256_memo[(path, st.st_size, st.st_mtime_ns)] = record["sha256"]
+        return record
+
+    #
+    # input_manifest()
+    # build the manifest of a step's inputs.
+    # fields - dict of the config values the step depends on
+    # inputs - list of input files / glob patterns
+    #
+    def input_manifest(self, step, fields, inputs):
+        recorded = self.load(step)
+        previous = recorded["inputs"]["files"] if recorded else {}
+        files = {}
+        for path in expand_paths(inputs):
+            files[path] = self.file_record(path, previous.get(path))
+        return {
+            "step": step,
+            "topaz_version": topaz_version(),
+            "fields": fields,
+            "files": files,
+        }
+
+    #
+    # check()
+    # returns (current, reason, manifest) where current is True when the step can be
+    # skipped and manifest is the input manifest to record after the step has run.
+    #
+    def check(self, step, fields, inputs):
+        manifest = self.input_manifest(step, fields, inputs)
+        recorded = self.load(step)
+        if recorded is None:
+            return False, "no recorded manifest", manifest
+        missing = [path for path, record in manifest["files"].items() if record.get("missing")]
+        if missing:
+            return False, "missing input " + missing[0], manifest
+        if manifest_content(recorded["inputs"]) != manifest_content(manifest):
+            return False, self._difference(recorded["inputs"], manifest), manifest
+        outputs = recorded.get("outputs", {})
+        if not outputs:
+            return False, "no recorded outputs", manifest
+        for path, record in outputs.items():
+            if self.file_record(path, with_hash=False) != record:
+                return False, "output changed " + path, manifest
+        if recorded["inputs"] != manifest:
+            # same contents with new mtimes, record them so they are not hashed again
+            self._write(step, {"inputs": manifest, "outputs": outputs})
+        return True, "inputs unchanged", manifest
+
+    def _difference(self, recorded, current):
+        if recorded.get("topaz_version") != current["topaz_version"]:
+            return "topaz version changed"
+        for key, value in current["fields"].items():
+            if recorded["fields"].get(key) != value:
+                return "parameter changed " + key
+        if set(recorded["files"]) != set(current["files"]):
+            return "input file set changed"
+        for path, record in current["files"].items():
+            if recorded["files"][path].get("sha256") != record.get("sha256"):
+                return "input changed " + path
+        return "manifest changed"
+
+    #
+    # record()
+    # save the input manifest and the current state of the step's outputs.
+    #
+    def record(self, step, manifest, outputs):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        output_records = {}
+        for path in expand_paths(outputs):
+            record = self.file_record(path, with_hash=False)
+            if not record.get("missing"):
+                output_records[path] = record
+        self._write(step, {"inputs": manifest, "outputs": output_records})
+
+    def _write(self, step, entry):
+        tmp_path = self.manifest_path(step) + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(entry, f, indent=1)
+        os.replace(tmp_path, self.manifest_path(step))
+
+    def invalidate(self, step):
+        try:
+            os.remove(self.manifest_path(step))
+        except FileNotFoundError:
+            pass
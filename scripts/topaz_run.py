@@ -8,14 +8,37 @@
 #   visualize (visualize predictions overlaying predictions with ground truth) 
 
 # Usage - $ topaz_run --file-path $CONFIG_FILE
+#         $ topaz_run --file-path $CONFIG_FILE --executor slurm
+#         $ topaz_run --file-path $CONFIG_FILE serve --port 8765
+#         $ topaz_run --file-path $CONFIG_FILE --watch
+#         $ topaz_run batch $CONFIG_DIR --cores 32
 
 import subprocess
 import os
+import sys
 import time
-import mrcfile
 import csv
+import glob
+import queue
+import shlex
+from concurrent.futures import ThreadPoolExecutor
 from scripts import logger as logger
 from scripts import parameters_factory as pf
+from scripts import step_cache as sc
+from scripts import pipeline_graph as pg
+from scripts import sharding
+from scripts import shell_runner
+from scripts import inprocess
+from scripts import resource_usage
+from scripts import profiling
+from scripts import calc_centers
+from scripts import visualize_picks
+from scripts import evaluate_picks
+from scripts import micrograph_store
+from scripts import training_metrics
+from scripts import executors
+from scripts import picking_service
+from scripts import gallery_watch
 import click
 
 @click.group()
@@ -23,6 +46,9 @@ import click
 def cli(ctx):
      pass
 
+PIPELINE_STEPS = ["calculate_centers", "preprocess", "convert", "train_test_split",
+                  "train", "extract", "visualize_picks", "evaluate_picks"]
+
 class Sys_Params():
     def __init__(self):
         self.scripts_path = "/scripts/"
@@ -36,26 +62,175 @@ class Sys_Params():
         self.predicted_particles = "/predicted_particles.txt"
         self.save_prefix = "/model"
         self.model_file_path = "/model_training.txt"
-        self.model = "/model_epoch10.sav"
+        self.training_state = "/training_state.json"
+        self.step_cache_path = "/.step_cache"
+        self.shards_path = "/shards/"
+        self.score_maps_path = "/score_maps/"
+        self.evaluation = "/evaluation"
+        self.profile_path = "/profile"
+        self.micrograph_store_path = "/micrograph_store"
+        self.jobs_path = "/jobs/"
+        self.watch_state = "/watch_state.json"
         self.verbosity = 1
+        self.log_max_bytes = 100 * 1024 * 1024
+        self.log_backup_count = 5
         self.system = "hpc"
         #self.system = "macos"
 
-def launch_shell_script(command):
+#
+# launch_shell_script()
+# run command in a shell, streaming its output into the event log under log_module.
+# project is the perflog project (the run output directory) and total_items the
+# number of images the command processes, used for progress/ETA records.
+# Raises CalledProcessError on a non-zero exit.
+#
+# With execution_mode "inprocess" topaz commands are run by the inprocess engine
+# inside this process, everything else is run in a shell.  With a g_profiler that
+# profiles children, python commands run in a shell are started under cProfile.
+#
+# A command given a stop event is always run in a shell, so it can be terminated
+# when the event is set; a command stopped that way does not count as failed.
+#
+g_execution_mode = "subprocess"
+g_profiler = None
+
+def launch_shell_script(command, log_module="shell output", env=None, project="", total_items=None, stop=None):
 
     g_log.loginfo("launch_shell_script", command)    
 
-    # Launch the command in a shell
-    process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    
-    stdout, stderr = process.communicate()
-    std_output = stdout.decode()
-    std_error = stderr.decode()
+    if env is not None:
+        env = dict(os.environ, **env)
+    if g_execution_mode == "inprocess" and inprocess.supports(command) and stop is None:
+        result = inprocess.run_command(command, g_log, log_module, project, env, total_items)
+    else:
+        if g_profiler is not None:
+            command = g_profiler.wrap_command(command, log_module)
+        result = shell_runner.run_command(command, g_log, log_module, project, env, total_items, stop)
+
+    # a failed step must not be recorded in the step cache or feed the next step
+    if result.returncode != 0 and not result.stopped:
+        raise subprocess.CalledProcessError(result.returncode, command)
+    return result
+
+#
+# run_sharded_commands()
+# run one command per shard, at most workers at a time.  Each shard's output is
+# logged under "<module>[shard NNN]" and its duration is written to the perflog as
+# metric "<module>.shardNNN".  Raises the first shard failure once all shards are done.
+# totals holds the number of images in each shard, env extra environment variables
+# for every shard.
+#
+# When a step runs as a batch job array (topaz_run --run-step STEP --shard N) the
+# array task runs only shard N and ends the step with ShardDone; the job that merges
+# the shards (--shard merge) runs none and finishes the step.
+#
+g_shard_mode = None
+
+class ShardDone(Exception):
+    pass
+
+def run_sharded_commands(module, output_dir, commands, workers, env=None, totals=None):
+
+    def run_shard(index, command):
+        shard_module = f"{module}[shard {index:03d}]"
+        total_items = totals[index] if totals else None
+        result = launch_shell_script(command, shard_module, env, output_dir, total_items)
+        g_log.loginfo(shard_module, f"shard took {result.wall_time:.2f} seconds to complete")
+        g_log.logperf(output_dir, f"{module}.shard{index:03d}", "duration", f"{result.wall_time:.2f}", "seconds")
+
+    if g_shard_mode == "merge":
+        g_log.loginfo(module, f"{len(commands)} shards were run as array tasks")
+        return
+    if g_shard_mode is not None:
+        # an array can have more tasks than there are shards of a small data set
+        if g_shard_mode < len(commands):
+            run_shard(g_shard_mode, commands[g_shard_mode])
+        raise ShardDone()
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        futures = [pool.submit(run_shard, index, command) for index, command in enumerate(commands)]
+    for future in futures:
+        future.result()
+
+#
+# model_file()
+# the model topaz train saves after epoch (default the last epoch), relative to the
+# model directory.  topaz pads the epoch to ceil(log10(num_epochs)) digits.
+#
+def model_file(sys_params, num_epochs, epoch=None):
+    epoch = num_epochs if epoch is None else epoch
+    return training_metrics.checkpoint_name(sys_params.save_prefix, num_epochs, epoch)
+
+#
+# selected_model()
+# the model extract uses, relative to the model directory: the last epoch (the best
+# epoch of a training that was stopped early), or with model_selection set to a test
+# metric the saved epoch with the best value of it in model_training.txt.
+#
+# return:
+# model file, epoch, metric, metric value (metric and value None for the last epoch)
+#
+def selected_model(sys_params, user_params):
+
+    params = user_params.parameters
+    model_dir = user_params.output.file_save_model_path
+    num_epochs = params.number_of_epochs
+    if params.model_selection == "last":
+        early_stopped = training_metrics.read_state(model_dir + sys_params.training_state).get("early_stopped")
+        if early_stopped:
+            return (model_file(sys_params, num_epochs, early_stopped["best_epoch"]), early_stopped["best_epoch"],
+                    early_stopped["metric"], early_stopped["value"])
+        return model_file(sys_params, num_epochs), num_epochs, None, None
 
-    if std_output != "":
-        g_log.loginfo("shell output", "\n" + std_output)
-    if std_error != "":
-        g_log.loginfo("shell output", "\n" + std_error)
+    saved = [epoch for epoch in training_metrics.checkpoints(model_dir + sys_params.save_prefix)
+             if epoch <= num_epochs]
+    epoch, value = training_metrics.best_epoch(model_dir + sys_params.model_file_path, params.model_selection, saved)
+    if epoch is None:
+        return model_file(sys_params, num_epochs), num_epochs, None, None
+    return model_file(sys_params, num_epochs, epoch), epoch, params.model_selection, value
+
+#
+# available_cores()
+# the cores this run may use: its core budget, or every core of the node
+#
+g_cores = 0
+
+def available_cores():
+    return g_cores or os.cpu_count() or 1
+
+#
+# thread_env()
+# environment that limits the math library and torch threads of a child to threads
+#
+def thread_env(threads):
+    return {name: str(threads) for name in ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS")}
+
+#
+# apply_core_budget()
+# fit the run into cores: commands run in a shell and torch in this process use at
+# most cores threads, and the worker and concurrency counts of the config are capped
+# at cores.  The shards of a step submitted as a job array are fixed, so a batch job
+# keeps preprocess_workers and extract_workers.
+#
+def apply_core_budget(user_params, cores, batch_job=False):
+
+    global g_cores
+
+    g_cores = cores
+    os.environ.update(thread_env(cores))
+    if "torch" in sys.modules:
+        sys.modules["torch"].set_num_threads(cores)
+
+    params = user_params.parameters
+    for name in ("number_workers", "preprocess_workers", "extract_workers", "extract_threads_per_worker",
+                 "visualize_workers", "max_concurrent_steps"):
+        if batch_job and name in ("preprocess_workers", "extract_workers"):
+            continue
+        value = getattr(params, name)
+        if value > cores:
+            g_log.loginfo("apply_core_budget", f"{name} {value} capped at {cores} cores")
+            setattr(params, name, cores)
+    g_log.loginfo("apply_core_budget", f"running with {cores} cores")
 
 def ensure_directory_exists(directory_path):
     if not os.path.exists(directory_path):
@@ -103,93 +278,140 @@ def find_max_values(csv_file):
     
     return max_third, max_fourth, max_fifth
 
-def get_mrc_dimensions(directory):
-    # Get list of all files in the directory
-    files = os.listdir(directory)
-    
-    # Filter out only .mrc files
-    mrc_files = [file for file in files if file.endswith('.mrc')]
-    
-    if not mrc_files:
-        raise FileNotFoundError("No MRC files found in the specified directory.")
-    
-    # Open the first .mrc file
-    first_mrc_file = os.path.join(directory, mrc_files[0])
-    
-    with mrcfile.open(first_mrc_file, permissive=True) as mrc:
-        x, y = mrc.header.nx, mrc.header.ny
-        
-    return int(x), int(y)
-
-def calculate_centers(rows, cols, img_width, img_height, raw_images_dir, output_file):
-
-    # Calculate the center coordinates of each image in a grid and save to a file.
-
-    # Initialize list to store image identifiers and centers
-    data = []
-
-    # Iterate over each file name
-    for filename in os.listdir(raw_images_dir):
-
-        if filename.endswith('.mrc'):
-            # Iterate over each grid position
-            for row in range(rows):
-                for col in range(cols):
-                    # Calculate center of current image
-                    center_x = col * img_width + img_width // 2
-                    center_y = row * img_height + img_height // 2
-                    # Append to data list                
-                    base_name = os.path.splitext(filename)[0]
-                    data.append((base_name, center_x, center_y))
-
-    # Write data to the output file
-    with open(output_file, 'w') as f:
-        # write the header
-        var1 = "image_name"
-        var2 = "x_coord"
-        var3 = "y_coord"
-        f.write(f"{var1}\t{var2}\t{var3}\n")
-        # write the data
-        for item in data:
-            f.write(f"{item[0]}\t{item[1]}\t{item[2]}\n")
-
 def execute_calculate_centers(sys_params, user_params):
     
     rawdata_images = user_params.input.rawdata_images
     rawdata_path = os.path.dirname(rawdata_images)
     particles_map = rawdata_path + "/particle_map.csv"
-    max_values = find_max_values(particles_map)
-    # max_gallery = max_values[0]
-    max_row = max_values[1] + 1
-    max_col = max_values[2] + 1
-    x_pixels, y_pixels = get_mrc_dimensions(rawdata_path)
-    image_width = int(x_pixels / max_col)
-    image_height = int(y_pixels / max_row)
     rawdata_particles = rawdata_path + "/particles.txt"
-    calculate_centers(max_row, max_col, image_width, image_height, rawdata_path, rawdata_particles)
+    mode = user_params.parameters.calculate_centers_mode
+    if mode == "occupied":
+        # only the grid cells that hold a particle
+        count = calc_centers.calculate_occupied_centers(particles_map, rawdata_path, rawdata_particles)
+    elif mode == "grid":
+        max_values = find_max_values(particles_map)
+        # max_gallery = max_values[0]
+        max_row = max_values[1] + 1
+        max_col = max_values[2] + 1
+        # tile size is read from each gallery's own header
+        count = calc_centers.calculate_centers(max_row, max_col, rawdata_path, rawdata_particles)
+    else:
+        raise ValueError("calculate_centers_mode must be occupied or grid, not " + mode)
     g_log.loginfo("execute_calculate_centers", particles_map)
+    g_log.loginfo("execute_calculate_centers", f"{count} centers written to {rawdata_particles}")
        
-def execute_preprocess(sys_params, user_params):
+#
+# execute_preprocess()
+# preprocess the raw galleries, or only rawdata_images (a glob or @file list) when given
+#
+def execute_preprocess(sys_params, user_params, rawdata_images=None):
    
     downsampling = str(user_params.parameters.downsampling)
-    rawdata_images = user_params.input.rawdata_images    
+    rawdata_images = rawdata_images or user_params.input.rawdata_images
     processed_images_path = user_params.output.dir + sys_params.processed_images_path
     ensure_directory_exists(processed_images_path)
     output_dir = user_params.output.dir
   
     command = "topaz preprocess" \
    + "  -v -s " + downsampling \
-    + " -o " + processed_images_path \
-    + " " + rawdata_images
-    
+    + " -o " + processed_images_path
+
+    workers = user_params.parameters.preprocess_workers
+    images = sharding.expand_images(rawdata_images)
+
     start_time = time.time()
-    launch_shell_script(command)    
+    store = None
+    if user_params.parameters.micrograph_store == "yes":
+        store, keys, images = link_stored_micrographs(sys_params, user_params, images)
+        # the misses go to topaz as a list file instead of the glob
+        ensure_directory_exists(output_dir + sys_params.shards_path)
+        rawdata_images = sharding.write_shard_list(images, output_dir + sys_params.shards_path + "preprocess_misses.txt")
+
+    # topaz rewrites existing outputs in place, which would change every run sharing a
+    # hardlinked micrograph from the store
+    for image in images:
+        output = processed_micrograph(processed_images_path, image)
+        if os.path.islink(output) or (os.path.exists(output) and os.stat(output).st_nlink > 1):
+            # the array tasks of a sharded preprocess job all get here
+            micrograph_store.remove_file(output)
+
+    if not images:
+        g_log.loginfo("execute_preprocess", "every micrograph was linked from the micrograph store")
+    elif workers > 1 and g_execution_mode == "inprocess":
+        # in-process commands run one at a time, let topaz fork its own worker pool
+        # from the already initialized process instead of sharding
+        launch_shell_script(command + " -t " + str(workers) + " " + rawdata_images, "execute_preprocess",
+                            project=output_dir, total_items=len(images))
+    elif workers > 1:
+        # split the galleries into shards balanced by file size, all shards write
+        # into the same micrographs directory
+        shards_path = output_dir + sys_params.shards_path
+        ensure_directory_exists(shards_path)
+        shards = sharding.balanced_shards(images, workers)
+        commands = []
+        for index, shard in enumerate(shards):
+            shard_list = sharding.write_shard_list(shard, shards_path + f"preprocess_{index:03d}.txt")
+            commands.append(command + " " + shard_list)
+        g_log.loginfo("execute_preprocess", f"preprocessing in {len(shards)} shards")
+        run_sharded_commands("execute_preprocess", output_dir, commands, len(shards),
+                             thread_env(max(1, available_cores() // len(shards))),
+                             [len(shard) for shard in shards])
+    else:
+        launch_shell_script(command + " " + rawdata_images, "execute_preprocess", project=output_dir,
+                            total_items=len(images))
+
+    if store is not None:
+        for image in images:
+            store.put(keys[image], processed_micrograph(processed_images_path, image),
+                      {"source": os.path.abspath(image), "downsampling": user_params.parameters.downsampling,
+                       "topaz_version": sc.topaz_version()})
+        g_log.loginfo("execute_preprocess", f"{len(images)} micrographs added to the micrograph store")
     end_time = time.time()
     duration = end_time - start_time
 
     g_log.loginfo("execute_preprocess", f"Function 'execute_preprocess' took {duration:.2f} seconds to complete")
     g_log.logperf(output_dir, "execute_preprocess", "duration", f"{duration:.2f}", "seconds")
 
+#
+# processed_micrograph()
+# the micrograph topaz preprocess writes for a raw gallery
+#
+def processed_micrograph(processed_images_path, image):
+    return processed_images_path + os.path.splitext(os.path.basename(image))[0] + ".mrc"
+
+#
+# link_stored_micrographs()
+# link the micrographs of images already in the micrograph store into the run
+#
+# return:
+# store, {image: store key}, the images that still have to be preprocessed
+#
+def link_stored_micrographs(sys_params, user_params, images):
+
+    store = micrograph_store.MicrographStore(user_params.input.base_project_path + sys_params.micrograph_store_path)
+    processed_images_path = user_params.output.dir + sys_params.processed_images_path
+    # the parameters that change the preprocess output
+    params = {"downsampling": user_params.parameters.downsampling}
+
+    keys = {}
+    misses = []
+    links = {"hardlink": 0, "symlink": 0}
+    for image in images:
+        # hashed once per run, the step cache check of preprocess already read them
+        keys[image] = store.key(sc.cached_sha256(image), params, sc.topaz_version())
+        kind = store.link(keys[image], processed_micrograph(processed_images_path, image))
+        if kind is None:
+            misses.append(image)
+        else:
+            links[kind] += 1
+
+    hits = len(images) - len(misses)
+    g_log.loginfo("execute_preprocess", f"micrograph store {store.store_dir}: {hits} of {len(images)} micrographs "
+                  f"linked ({links['hardlink']} hardlinks, {links['symlink']} symlinks), {len(misses)} to preprocess")
+    g_log.logperf(user_params.output.dir, "execute_preprocess", "store_hits", str(hits), "count")
+    g_log.logperf(user_params.output.dir, "execute_preprocess", "store_misses", str(len(misses)), "count")
+    return store, keys, misses
+
 def execute_convert(sys_params, user_params):
 
     downsampling = str(user_params.parameters.downsampling)     
@@ -205,7 +427,7 @@ def execute_convert(sys_params, user_params):
     + " " + rawdata_particles_path
     
     start_time = time.time()     
-    launch_shell_script(command)
+    launch_shell_script(command, "execute_convert", project=output_dir)
     end_time = time.time()
     duration = end_time - start_time
 
@@ -225,7 +447,7 @@ def execute_train_test_split(sys_params, user_params):
     + " " + processed_particles_path
 
     start_time = time.time()
-    launch_shell_script(command)     
+    launch_shell_script(command, "execute_train_test_split", project=output_dir)
     end_time = time.time()
     duration = end_time - start_time
 
@@ -243,8 +465,10 @@ def execute_train(sys_params, user_params):
     test_targets = user_params.output.dir + sys_params.test_targets
     save_prefix = user_params.output.file_save_model_path + sys_params.save_prefix
     model_file_path = user_params.output.file_save_model_path + sys_params.model_file_path
+    state_file = user_params.output.file_save_model_path + sys_params.training_state
     ensure_directory_exists(user_params.output.file_save_model_path)
     output_dir = user_params.output.dir
+    num_epochs = user_params.parameters.number_of_epochs
 
     # hack until I can figure out torch is not a module bug on macos
     if sys_params.system == "macos":
@@ -256,15 +480,72 @@ def execute_train(sys_params, user_params):
     + " -n " + number_of_predicted_particles \
     + " -r " + radius \
     + " --num-workers=" + number_workers \
+    + (" --epoch-size " + str(user_params.parameters.epoch_size) if user_params.parameters.epoch_size > 0 else "") \
     + " --train-images " + train_images \
     + " --train-targets " + train_targets \
     + " --test-images " + test_images \
-    + " --test-targets " + test_targets \
-    + " --save-prefix " + save_prefix \
-    + " -o " + model_file_path
+    + " --test-targets " + test_targets
+
+    # the parameters and split files the checkpoints are trained with
+    fields, inputs, _ = pipeline_step_io(sys_params, user_params)["train"]
+    training = {"fields": fields, "inputs": {path: sc.cached_sha256(path) for path in inputs}}
+
+    # watch the test metrics topaz writes to model_training.txt and stop training once
+    # they no longer improve; made before any checkpoint is touched, it checks the settings
+    monitor = None
+    if user_params.parameters.early_stopping == "yes":
+        monitor = training_metrics.EarlyStoppingMonitor(
+            model_file_path, user_params.parameters.early_stopping_metric,
+            user_params.parameters.early_stopping_patience, user_params.parameters.early_stopping_min_delta,
+            log=g_log, log_module="execute_train")
+
+    start_epoch = 0
+    if user_params.parameters.resume_training == "yes":
+        start_epoch = training_metrics.resume_epoch(save_prefix, model_file_path, state_file, training, num_epochs)
+
+    if start_epoch > 0:
+        # continue from the last checkpoint, fold_resumed() renumbers the new epochs
+        g_log.loginfo("execute_train", f"resuming training after epoch {start_epoch} of {num_epochs}")
+        command = command \
+        + " -m " + user_params.output.file_save_model_path + model_file(sys_params, num_epochs, start_epoch) \
+        + " --num-epochs " + str(num_epochs - start_epoch) \
+        + " --save-prefix " + save_prefix + "_resume" \
+        + " -o " + training_metrics.resume_log_path(model_file_path)
+        state = {"training": training, "resume": {"offset": start_epoch, "num_epochs": num_epochs - start_epoch}}
+    else:
+        # checkpoints and metrics of an earlier training would be taken for this one's
+        # after a restart or by the early stopping monitor
+        for path in list(training_metrics.checkpoints(save_prefix).values()) \
+                + list(training_metrics.checkpoints(save_prefix + "_resume").values()) \
+                + [model_file_path, training_metrics.resume_log_path(model_file_path)]:
+            if os.path.exists(path):
+                os.remove(path)
+        command = command \
+        + " --num-epochs " + str(num_epochs) \
+        + " --save-prefix " + save_prefix \
+        + " -o " + model_file_path
+        state = {"training": training}
+    training_metrics.write_state(state_file, state)
+    g_log.logperf(output_dir, "execute_train", "start_epoch", str(start_epoch), "count")
+
+    if monitor is not None:
+        monitor.resume_offset = start_epoch
+        monitor.start()
 
     start_time = time.time()
-    launch_shell_script(command)     
+    try:
+        launch_shell_script(command, "execute_train", project=output_dir,
+                            stop=monitor.stop if monitor is not None else None)
+    finally:
+        if monitor is not None:
+            monitor.finish()
+    training_metrics.fold_resumed(save_prefix, model_file_path, state_file)
+    if monitor is not None and monitor.stop_epoch is not None:
+        training_metrics.record_early_stop(save_prefix, state_file, monitor)
+        g_log.loginfo("execute_train", f"stopped early after epoch {monitor.stop_epoch} of {num_epochs}, best test "
+                      f"{monitor.metric} {monitor.best_value:.4f} at epoch {monitor.best_epoch}")
+        g_log.logperf(output_dir, "execute_train", "stop_epoch", str(monitor.stop_epoch), "count")
+        g_log.logperf(output_dir, "execute_train", "best_epoch", str(monitor.best_epoch), "count")
     end_time = time.time()
     duration = end_time - start_time
 
@@ -272,22 +553,80 @@ def execute_train(sys_params, user_params):
     g_log.logperf(output_dir, "execute_train", "duration", f"{duration:.2f}", "seconds")
 
 
-def execute_extract(sys_params, user_params):
+#
+# execute_extract()
+# pick the micrographs into predicted_particles.txt, or only processed_images (a glob
+# or @file list) into predicted_particles when given
+#
+def execute_extract(sys_params, user_params, processed_images=None, predicted_particles=None):
    
     radius = str(user_params.parameters.extract_radius)    
-    predicted_particles = user_params.output.dir + sys_params.predicted_particles
-    model = user_params.output.file_save_model_path  + sys_params.model
-    processed_images = user_params.output.dir + sys_params.processed_images
+    predicted_particles = predicted_particles or user_params.output.dir + sys_params.predicted_particles
+    model_name, epoch, metric, value = selected_model(sys_params, user_params)
+    model = user_params.output.file_save_model_path + model_name
+    processed_images = processed_images or user_params.output.dir + sys_params.processed_images
     output_dir = user_params.output.dir
+
+    if metric is None:
+        g_log.loginfo("execute_extract", f"extracting with {model_name} (epoch {epoch})")
+    else:
+        g_log.loginfo("execute_extract", f"extracting with {model_name}, best test {metric} {value:.4f} at epoch {epoch}")
+    g_log.logperf(output_dir, "execute_extract", "model_epoch", str(epoch), "count")
     
-    command = "topaz extract" \
-    + " -r " + radius \
-    + " -m " + model \
-    + " -o " + predicted_particles \
-    + " " + processed_images
+    save_score_maps = user_params.parameters.save_score_maps == "yes"
+
+    if save_score_maps:
+        # score every micrograph once, keep the score maps for later radius/threshold
+        # sweeps with "topaz_score_maps peaks"
+        command = sys.executable + " -m scripts.score_maps extract" \
+        + " -r " + radius \
+        + " -m " + model \
+        + " --score-maps " + output_dir + sys_params.score_maps_path
+    else:
+        command = "topaz extract -v" \
+        + " -r " + radius \
+        + " -m " + model
+
+    workers = user_params.parameters.extract_workers
 
     start_time = time.time()  
-    launch_shell_script(command)
+    if workers > 1 and g_execution_mode == "inprocess" and not save_score_maps:
+        # in-process commands run one at a time, run one extract that scores with all
+        # cores and does non-maximum suppression on a pool of workers
+        launch_shell_script(command + " --num-workers " + str(workers) + " -o " + predicted_particles
+                            + " " + processed_images, "execute_extract", project=output_dir,
+                            total_items=len(sharding.expand_images(processed_images)))
+        # the worker pool returns images in completion order
+        sharding.merge_particle_files([predicted_particles], predicted_particles)
+    elif workers > 1:
+        # extract shards of the micrographs concurrently, each with its share of the
+        # cores, then merge the shard outputs into predicted_particles.txt
+        shards_path = output_dir + sys_params.shards_path
+        ensure_directory_exists(shards_path)
+        shards = sharding.balanced_shards(sharding.expand_images(processed_images), workers)
+        threads = user_params.parameters.extract_threads_per_worker
+        if threads <= 0 and g_shard_mode is not None:
+            # an array task runs one shard with the cores of its own allocation
+            threads = available_cores()
+        if threads <= 0:
+            threads = max(1, available_cores() // len(shards))
+        env = thread_env(threads)
+        commands = []
+        shard_outputs = []
+        for index, shard in enumerate(shards):
+            shard_list = sharding.write_shard_list(shard, shards_path + f"extract_{index:03d}.txt")
+            shard_output = shards_path + f"predicted_particles_{index:03d}.txt"
+            shard_outputs.append(shard_output)
+            commands.append(command + " -j " + str(threads) + " -o " + shard_output + " " + shard_list)
+        g_log.loginfo("execute_extract", f"extracting in {len(shards)} shards with {threads} threads each")
+        run_sharded_commands("execute_extract", output_dir, commands, len(shards), env,
+                             [len(shard) for shard in shards])
+        count = sharding.merge_particle_files(shard_outputs, predicted_particles)
+        g_log.loginfo("execute_extract", f"merged {count} picks into {predicted_particles}")
+    else:
+        launch_shell_script(command + " -o " + predicted_particles + " " + processed_images,
+                            "execute_extract", project=output_dir,
+                            total_items=len(sharding.expand_images(processed_images)))
     end_time = time.time()
     duration = end_time - start_time
 
@@ -296,45 +635,439 @@ def execute_extract(sys_params, user_params):
 
 def execute_visualize_picks(sys_params, user_params):
 
-    radius = str(user_params.parameters.extract_radius)
-    number_of_images_to_visualize = str(user_params.parameters.number_of_images_to_visualize)
+    radius = user_params.parameters.extract_radius
+    number_of_images_to_visualize = user_params.parameters.number_of_images_to_visualize
     display_plots = user_params.parameters.display_plots
     score = str(user_params.parameters.score)
     base_program_path = user_params.input.base_program_path    
-    scripts_path = base_program_path + sys_params.scripts_path    
     output_dir = user_params.output.dir
     predicted_particles = user_params.output.dir + sys_params.predicted_particles
     processed_particles = user_params.output.dir + sys_params.processed_particles
     processed_images = user_params.output.dir + sys_params.processed_images_path
     test_images = user_params.output.dir + sys_params.test_images
 
-    command = "python3 " + scripts_path + "visualize_picks.py" \
-    + " " + base_program_path \
-    + " " + output_dir \
-    + " " + predicted_particles \
-    + " " + processed_particles \
-    + " " + processed_images \
-    + " " + test_images \
-    + " " + radius \
-    + " " + number_of_images_to_visualize \
-    + " " + display_plots \
-    + " " + score
-
     start_time = time.time()
-    launch_shell_script(command) 
+    if display_plots == "yes":
+        # GUI backends and plt.show() need the main thread of their own process
+        command = "python3 " + base_program_path + sys_params.scripts_path + "visualize_picks.py" \
+        + " " + base_program_path \
+        + " " + output_dir \
+        + " " + predicted_particles \
+        + " " + processed_particles \
+        + " " + processed_images \
+        + " " + test_images \
+        + " " + str(radius) \
+        + " " + str(number_of_images_to_visualize) \
+        + " " + display_plots \
+        + " " + score
+        launch_shell_script(command, "execute_visualize_picks", project=output_dir)
+    else:
+        # rendered with Agg in this process (and its worker pool) instead of a python3 child
+        visualize_picks.main(base_program_path, output_dir, predicted_particles, processed_particles, \
+                             processed_images, test_images, radius, number_of_images_to_visualize, \
+                             display_plots, score, user_params.parameters.visualize_workers, \
+                             report=lambda line: g_log.loginfo("execute_visualize_picks", line))
     end_time = time.time()
     duration = end_time - start_time
 
     g_log.loginfo("execute_visualize_picks", f"Function 'execute_visualize_overlay' took {duration:.2f} seconds to complete")
     g_log.logperf(output_dir, "execute_visualize_picks", "duration", f"{duration:.2f}", "seconds")  
  
-def main(config_file):
+def execute_evaluate_picks(sys_params, user_params):
+
+    params = user_params.parameters
+    output_dir = user_params.output.dir
+    predicted_particles = output_dir + sys_params.predicted_particles
+    processed_particles = output_dir + sys_params.processed_particles
+    radius = params.evaluate_match_radius if params.evaluate_match_radius > 0 else params.extract_radius
+
+    if params.evaluate_split == "test":
+        images = evaluate_picks.read_image_names(output_dir + sys_params.test_images)
+    elif params.evaluate_split == "all":
+        images = None
+    else:
+        raise ValueError("evaluate_split must be test or all, not " + params.evaluate_split)
+
+    start_time = time.time()
+    summary = evaluate_picks.evaluate(predicted_particles, processed_particles, radius,
+                                      output_dir + sys_params.evaluation, images, params.score)
+    end_time = time.time()
+    duration = end_time - start_time
+
+    for key in ["images", "ground_truth", "picks", "matched", "average_precision", "best_f1",
+                "best_f1_threshold", "precision_at_score", "recall_at_score", "f1_at_score"]:
+        g_log.loginfo("execute_evaluate_picks", f"{key} = {summary[key]}")
+    for key in ["average_precision", "best_f1", "precision_at_score", "recall_at_score", "f1_at_score"]:
+        g_log.logperf(output_dir, "execute_evaluate_picks", key, f"{summary[key]:.4f}", "ratio")
+    g_log.logperf(output_dir, "execute_evaluate_picks", "matched", str(summary["matched"]), "count")
+
+    g_log.loginfo("execute_evaluate_picks", f"Function 'execute_evaluate_picks' took {duration:.2f} seconds to complete")
+    g_log.logperf(output_dir, "execute_evaluate_picks", "duration", f"{duration:.2f}", "seconds")
+
+#
+# pipeline_step_io()
+# for every pipeline step return the (fields, inputs, outputs) recorded in its step
+# cache manifest:
+#   fields - the config values the step depends on
+#   inputs - files or glob patterns the step reads
+#   outputs - files or glob patterns the step writes
+#
+def pipeline_step_io(sys_params, user_params):
+
+    params = user_params.parameters
+    output_dir = user_params.output.dir
+    model_dir = user_params.output.file_save_model_path
+    rawdata_path = os.path.dirname(user_params.input.rawdata_images)
+    processed_images = output_dir + sys_params.processed_images
+    processed_particles = output_dir + sys_params.processed_particles
+    predicted_particles = output_dir + sys_params.predicted_particles
+    split_files = [output_dir + sys_params.train_images, output_dir + sys_params.train_targets,
+                   output_dir + sys_params.test_images, output_dir + sys_params.test_targets]
+    extract_model = selected_model(sys_params, user_params)[0]
+
+    return {
+        "calculate_centers": (
+            {"calculate_centers_mode": params.calculate_centers_mode},
+            [rawdata_path + "/particle_map.csv", user_params.input.rawdata_images],
+            [rawdata_path + "/particles.txt"]),
+        "preprocess": (
+            {"downsampling": params.downsampling},
+            [user_params.input.rawdata_images],
+            [processed_images]),
+        "convert": (
+            {"downsampling": params.downsampling},
+            [user_params.input.rawdata_particles],
+            [processed_particles]),
+        "train_test_split": (
+            {"number_of_held_out_test_images": params.number_of_held_out_test_images},
+            [processed_images, processed_particles],
+            split_files),
+        "train": (
+            {"train_radius": params.train_radius,
+             "number_of_predicted_particles": params.number_of_predicted_particles,
+             "number_of_epochs": params.number_of_epochs, "epoch_size": params.epoch_size,
+             "early_stopping": params.early_stopping, "early_stopping_metric": params.early_stopping_metric,
+             "early_stopping_patience": params.early_stopping_patience,
+             "early_stopping_min_delta": params.early_stopping_min_delta},
+            split_files,
+            [model_dir + sys_params.save_prefix + "_epoch*.sav", model_dir + sys_params.model_file_path]),
+        "extract": (
+            {"extract_radius": params.extract_radius, "model": extract_model,
+             "model_selection": params.model_selection, "save_score_maps": params.save_score_maps},
+            [model_dir + extract_model, processed_images],
+            [predicted_particles]
+            + ([output_dir + sys_params.score_maps_path + "*.npy"] if params.save_score_maps == "yes" else [])),
+        "visualize_picks": (
+            {"extract_radius": params.extract_radius,
+             "number_of_images_to_visualize": params.number_of_images_to_visualize,
+             "score": params.score},
+            [predicted_particles, processed_particles, output_dir + sys_params.test_images, processed_images],
+            [output_dir + "/*.png"]),
+        "evaluate_picks": (
+            {"evaluate_match_radius": params.evaluate_match_radius, "extract_radius": params.extract_radius,
+             "evaluate_split": params.evaluate_split, "score": params.score},
+            [predicted_particles, processed_particles, output_dir + sys_params.test_images],
+            [output_dir + sys_params.evaluation + "_curve.csv", output_dir + sys_params.evaluation + "_summary.csv"]),
+    }
+
+#
+# run_step()
+# run one pipeline step unless its step cache manifest shows that nothing it depends
+# on has changed since it last completed.  force_steps holds step names (or "all")
+# that are run regardless of the cache.  The resource usage of the step is written
+# to the perflog under "execute_<step>".
+#
+def run_step(step, execute, sys_params, user_params, step_cache, force_steps):
+
+    fields, inputs, outputs = pipeline_step_io(sys_params, user_params)[step]
+
+    current, reason, manifest = step_cache.check(step, fields, inputs)
+    if step in force_steps or "all" in force_steps:
+        g_log.loginfo("run_step", f"{step}: forced ({reason})")
+    elif current:
+        g_log.loginfo("run_step", f"{step}: skipped, {reason}")
+        g_log.logperf(user_params.output.dir, "execute_" + step, "skipped", "1", "count")
+        return False
+    else:
+        g_log.loginfo("run_step", f"{step}: running, {reason}")
+
+    step_cache.invalidate(step)
+    step_module = "execute_" + step
+    resource_usage.begin_step(step_module)
+    self_usage = resource_usage.SelfUsage()
+    try:
+        if g_profiler is not None:
+            with g_profiler.profile(step):
+                execute(sys_params, user_params)
+        else:
+            execute(sys_params, user_params)
+    finally:
+        # the sum over the step's commands, or this process for steps that run none
+        usage = resource_usage.end_step(step_module) or self_usage.delta()
+        usage.log(g_log, user_params.output.dir, step_module)
+    step_cache.record(step, manifest, outputs)
+    return True
+
+#
+# selected_steps()
+# the PipelineSteps selected by the run_* yes/no flags of the config, in pipeline order
+#
+def selected_steps(sys_params, user_params):
+
+    pipeline_steps = user_params.pipeline
+    step_io = pipeline_step_io(sys_params, user_params)
+    steps = []
+    for step, execute, selected in [
+        ("calculate_centers", execute_calculate_centers, pipeline_steps.run_calculate_centers),
+        ("preprocess", execute_preprocess, pipeline_steps.run_preprocess),
+        ("convert", execute_convert, pipeline_steps.run_convert),
+        ("train_test_split", execute_train_test_split, pipeline_steps.run_split_test_train),
+        ("train", execute_train, pipeline_steps.run_train),
+        ("extract", execute_extract, pipeline_steps.run_extract),
+        ("visualize_picks", execute_visualize_picks, pipeline_steps.run_visualize_picks),
+        ("evaluate_picks", execute_evaluate_picks, pipeline_steps.run_evaluate_picks),
+    ]:
+        if selected == "yes":
+            _, inputs, outputs = step_io[step]
+            steps.append(pg.PipelineStep(step, execute, inputs, outputs))
+    return steps
+
+#
+# initialize_logging()
+# open the event and perf logs used by every step
+#
+def initialize_logging(sys_params, eventlog="topaz_event.log", perflog="topaz_perf.log", perf_format="csv",
+                       log_dir=None):
 
     global g_log
 
+    # relative log names are placed in log_dir instead of the working directory
+    if log_dir:
+        os.makedirs(log_dir, exist_ok=True)
+        eventlog = os.path.join(log_dir, eventlog)
+        perflog = os.path.join(log_dir, perflog)
+    g_log = logger.Logger(eventlog, perflog, sys_params.verbosity, perf_format,
+                          max_bytes=sys_params.log_max_bytes, backup_count=sys_params.log_backup_count)
+    return g_log
+
+#
+# run_pipeline()
+# run the selected steps of user_params as a dependency graph.
+#
+# returns:
+# status - {step: "done" | "failed" | "blocked"}
+# errors - {step: exception} for the failed steps
+# durations - {step: seconds} for the steps that ran, None for steps skipped by the step cache
+#
+def run_pipeline(sys_params, user_params, force_steps=()):
+
+    global g_execution_mode
+
+    g_execution_mode = user_params.parameters.execution_mode
+    if g_execution_mode not in ("subprocess", "inprocess"):
+        raise ValueError("execution_mode must be subprocess or inprocess")
+    if user_params.parameters.model_selection not in training_metrics.MODEL_SELECTIONS:
+        raise ValueError("model_selection must be one of " + ", ".join(training_metrics.MODEL_SELECTIONS))
+
+    step_cache = sc.StepCache(user_params.output.dir + sys_params.step_cache_path)
+
+    steps = selected_steps(sys_params, user_params)
+    durations = {}
+
+    def run_pipeline_step(step):
+        start_time = time.time()
+        ran = run_step(step.name, step.execute, sys_params, user_params, step_cache, force_steps)
+        durations[step.name] = time.time() - start_time if ran else None
+
+    status, errors = pg.run_graph(steps, run_pipeline_step,
+                                  user_params.parameters.max_concurrent_steps, g_log)
+
+    for step, error in errors.items():
+        if isinstance(error, subprocess.CalledProcessError):
+            g_log.loginfo("run_pipeline", f"Error: step {step} failed with exit code {error.returncode}")
+        else:
+            g_log.loginfo("run_pipeline", f"Error: step {step} failed: {error!r}")
+
+    return status, errors, durations
+
+#
+# watch_galleries()
+# pick the galleries that arrive under rawdata_images with the model extract uses,
+# one batch of new galleries at a time, until interrupted or until no gallery arrived
+# for idle_timeout seconds (0 watches forever).  Each batch is preprocessed and
+# extracted on its own and its picks are appended to predicted_particles.txt; the raw
+# particle file is converted again when it changed.
+#
+def watch_galleries(sys_params, user_params, poll_interval=10.0, settle=5.0, idle_timeout=0.0):
+
+    global g_execution_mode
+
+    g_execution_mode = user_params.parameters.execution_mode
+    output_dir = user_params.output.dir
+    processed_images_path = output_dir + sys_params.processed_images_path
+    shards_path = output_dir + sys_params.shards_path
+    rawdata_particles = user_params.input.rawdata_particles
+    ensure_directory_exists(processed_images_path)
+    ensure_directory_exists(shards_path)
+
+    model_name, epoch, metric, value = selected_model(sys_params, user_params)
+    if not os.path.exists(user_params.output.file_save_model_path + model_name):
+        raise FileNotFoundError("no model " + user_params.output.file_save_model_path + model_name
+                                + ", train one before watching")
+
+    watcher = gallery_watch.GalleryWatcher(user_params.input.rawdata_images, output_dir + sys_params.watch_state,
+                                           output_dir + sys_params.predicted_particles, settle)
+    picked = watcher.restore(lambda image: processed_micrograph(processed_images_path, image))
+    model_name = os.path.basename(model_name)
+    g_log.loginfo("watch_galleries", f"watching {user_params.input.rawdata_images} with {model_name}, "
+                  f"{picked} galleries already picked")
+
+    last_arrival = time.time()
+    while True:
+        galleries = watcher.poll()
+        if not galleries:
+            if idle_timeout and time.time() - last_arrival >= idle_timeout:
+                g_log.loginfo("watch_galleries", f"no new gallery for {idle_timeout:g} seconds, stopping")
+                return
+            time.sleep(poll_interval)
+            continue
+
+        start_time = time.time()
+        g_log.loginfo("watch_galleries", f"{len(galleries)} new galleries")
+        try:
+            execute_preprocess(sys_params, user_params,
+                               sharding.write_shard_list(galleries, shards_path + "watch_galleries.txt"))
+            if user_params.pipeline.run_convert == "yes" and watcher.particles_changed(rawdata_particles):
+                execute_convert(sys_params, user_params)
+                watcher.record_particles(rawdata_particles)
+            micrographs = [processed_micrograph(processed_images_path, gallery) for gallery in galleries]
+            batch_particles = shards_path + "watch_predicted_particles.txt"
+            execute_extract(sys_params, user_params,
+                            sharding.write_shard_list(micrographs, shards_path + "watch_micrographs.txt"),
+                            batch_particles)
+        except subprocess.CalledProcessError as e:
+            g_log.loginfo("watch_galleries", f"Error: batch failed with exit code {e.returncode}, "
+                          "its galleries are retried once they change")
+            watcher.record_failed(galleries)
+            continue
+        count = watcher.append_picks(batch_particles, galleries, model_name)
+        last_arrival = time.time()
+
+        duration = last_arrival - start_time
+        g_log.loginfo("watch_galleries", f"{count} picks from {len(galleries)} galleries appended in {duration:.2f} seconds")
+        g_log.logperf(output_dir, "watch_galleries", "batch_duration", f"{duration:.2f}", "seconds")
+        g_log.logperf(output_dir, "watch_galleries", "galleries", str(len(galleries)), "count")
+
+#
+# sharded_workers()
+# the number of shards step is split into, 1 if it is not sharded
+#
+def sharded_workers(step, user_params):
+    params = user_params.parameters
+    if params.execution_mode != "subprocess":
+        return 1
+    return {"preprocess": params.preprocess_workers, "extract": params.extract_workers}.get(step, 1)
+
+#
+# submit_pipeline()
+# submit the selected steps as batch jobs with the step dependencies as scheduler
+# dependencies.  Every job runs "topaz_run --run-step STEP" with its own event and
+# perf logs in {output.dir}/jobs/STEP; a sharded preprocess or extract becomes a job
+# array of one task per shard and a job that merges the shards after the array.
+# Steps with no submitted upstream step whose step cache is current are not submitted.
+#
+# return:
+# the executor, {step: id of the job that finishes the step}
+#
+def submit_pipeline(sys_params, user_params, config_file, executor_name, force_steps=(), perf_log_format="csv",
+                    profile_options=""):
+
+    jobs_path = user_params.output.dir + sys_params.jobs_path
+    executor = executors.EXECUTORS[executor_name](jobs_path, g_log)
+    step_cache = sc.StepCache(user_params.output.dir + sys_params.step_cache_path)
+    step_io = pipeline_step_io(sys_params, user_params)
+
+    steps = selected_steps(sys_params, user_params)
+    dependencies = pg.build_dependencies(steps)
+
+    command = sys.executable + " -m scripts.topaz_run" \
+    + " --file-path " + shlex.quote(os.path.abspath(config_file)) \
+    + " --perf-log-format " + perf_log_format \
+    + "".join(" --force " + step for step in force_steps) \
+    + profile_options
+
+    job_ids = {}
+    for step in steps:
+        after = [job_ids[name] for name in dependencies[step.name] if name in job_ids]
+        if not after and step.name not in force_steps and "all" not in force_steps:
+            fields, inputs, _ = step_io[step.name]
+            current, reason, _ = step_cache.check(step.name, fields, inputs)
+            if current:
+                g_log.loginfo("submit_pipeline", f"{step.name}: not submitted, {reason}")
+                continue
+
+        resources = user_params.step_resources(step.name)
+        step_command = command + " --run-step " + step.name
+        workers = sharded_workers(step.name, user_params)
+        if workers > 1:
+            # resources are per array task, the merge job gets the default resources
+            array_id = executor.submit(executors.Job(
+                step.name, step_command + " --shard $SLURM_ARRAY_TASK_ID --log-dir "
+                + shlex.quote(jobs_path + step.name + ".shard") + "$SLURM_ARRAY_TASK_ID",
+                resources, array_size=workers, after=after))
+            job_ids[step.name] = executor.submit(executors.Job(
+                step.name + "_merge", step_command + " --shard merge --log-dir " + shlex.quote(jobs_path + step.name),
+                user_params.step_resources("default"), after=[array_id]))
+        else:
+            job_ids[step.name] = executor.submit(executors.Job(
+                step.name, step_command + " --log-dir " + shlex.quote(jobs_path + step.name), resources, after=after))
+
+    return executor, job_ids
+
+#
+# run_job_step()
+# run one step submitted by submit_pipeline().  shard is None for the whole step,
+# the index of the shard an array task runs or "merge" for the job that finishes a
+# sharded step.  Array tasks neither skip on nor record into the step cache on their
+# own, the merge job does.
+#
+def run_job_step(sys_params, user_params, step, shard=None, force_steps=()):
+
+    global g_execution_mode, g_shard_mode
+
+    g_execution_mode = user_params.parameters.execution_mode
+    step_cache = sc.StepCache(user_params.output.dir + sys_params.step_cache_path)
+    execute = {pipeline_step.name: pipeline_step.execute
+               for pipeline_step in selected_steps(sys_params, user_params)}.get(step)
+    if execute is None:
+        raise ValueError(f"{step} is not selected in the pipeline section of the config")
+
+    if shard is None or shard == "merge":
+        g_shard_mode = shard
+        run_step(step, execute, sys_params, user_params, step_cache, force_steps)
+        return
+
+    # tasks of one array see the same inputs, so they either all skip or all run
+    fields, inputs, _ = pipeline_step_io(sys_params, user_params)[step]
+    current, reason, _ = step_cache.check(step, fields, inputs)
+    if current and step not in force_steps and "all" not in force_steps:
+        g_log.loginfo("run_job_step", f"{step} shard {shard}: skipped, {reason}")
+        return
+    step_cache.invalidate(step)
+    g_shard_mode = int(shard)
+    try:
+        execute(sys_params, user_params)
+    except ShardDone:
+        pass
+
+def main(config_file, force_steps=(), perf_log_format="csv", profile=False, profile_children=False,
+         executor="inline", wait=False, job_step=None, shard=None, log_dir=None, watch=None, cores=0):
+
+    global g_profiler
+
     sys_params = Sys_Params()
 
-    g_log = logger.Logger("topaz_event.log", "topaz_perf.log", sys_params.verbosity)
+    initialize_logging(sys_params, perf_format=perf_log_format, log_dir=log_dir)
 
     if config_file == "" :
         g_log.loginfo("main", "config_file is missing")
@@ -346,34 +1079,208 @@ def main(config_file):
         g_log.loginfo("main", "Error: Unable to read " + config_file)
         exit(1)
 
-    pipeline_steps = user_params.pipeline
+    if user_params.parameters.execution_mode not in ("subprocess", "inprocess"):
+        g_log.loginfo("main", "Error: execution_mode must be subprocess or inprocess")
+        exit(1)
 
-    if pipeline_steps.run_calculate_centers == "yes":
-         execute_calculate_centers(sys_params, user_params)   
-        
-    if pipeline_steps.run_preprocess == "yes":
-        execute_preprocess(sys_params, user_params)
-    
-    if pipeline_steps.run_convert == "yes":
-        execute_convert(sys_params, user_params)
-    
-    if pipeline_steps.run_split_test_train == "yes":
-        execute_train_test_split(sys_params, user_params)
-    
-    if pipeline_steps.run_train == "yes":
-        execute_train(sys_params, user_params)
-    
-    if pipeline_steps.run_extract == "yes":
-        execute_extract(sys_params, user_params)
-    
-    if pipeline_steps.run_visualize_picks == "yes":
-        execute_visualize_picks(sys_params, user_params)
+    if user_params.parameters.model_selection not in training_metrics.MODEL_SELECTIONS:
+        g_log.loginfo("main", "Error: model_selection must be one of " + ", ".join(training_metrics.MODEL_SELECTIONS))
+        exit(1)
+
+    if job_step is not None and not cores and "SLURM_CPUS_PER_TASK" in os.environ:
+        # a batch job runs with the cpus of its allocation
+        cores = int(os.environ["SLURM_CPUS_PER_TASK"])
+    if cores and (executor == "inline" or job_step is not None):
+        apply_core_budget(user_params, cores, job_step is not None)
+
+    if watch is not None:
+        try:
+            watch_galleries(sys_params, user_params, **watch)
+        except KeyboardInterrupt:
+            g_log.loginfo("main", "watch stopped")
+        except Exception as e:
+            g_log.loginfo("main", f"Error: watch failed: {e!r}")
+            exit(1)
+        g_log.close()
+        return
+
+    if job_step is not None:
+        if profile or profile_children:
+            g_profiler = profiling.PipelineProfiler(user_params.output.dir + sys_params.profile_path,
+                                                    g_log, profile_children)
+        try:
+            run_job_step(sys_params, user_params, job_step, shard, force_steps)
+        except Exception as e:
+            g_log.loginfo("main", f"Error: step {job_step} failed: {e!r}")
+            exit(1)
+        g_log.loginfo("topaz_run.py main", f"{job_step} done")
+        g_log.close()
+        return
+
+    if executor != "inline":
+        profile_options = (" --profile" if profile else "") + (" --profile-children" if profile_children else "")
+        submitted, job_ids = submit_pipeline(sys_params, user_params, config_file, executor, force_steps,
+                                             perf_log_format, profile_options)
+        g_log.loginfo("main", f"submitted {len(job_ids)} steps to the {executor} executor, job logs in "
+                      + user_params.output.dir + sys_params.jobs_path)
+        if executor == "local" or wait:
+            states = submitted.wait()
+            failed = [step for step, job_id in job_ids.items() if states.get(job_id) != executors.COMPLETED]
+            for step, job_id in job_ids.items():
+                g_log.loginfo("main", f"{step}: job {job_id} {states.get(job_id)}")
+            if failed:
+                exit(1)
+        g_log.loginfo("topaz_run.py main", "All done... good bye")
+        g_log.close()
+        return
+
+    if profile or profile_children:
+        # <output.dir>/profile/driver.* and one pair of files per step
+        g_profiler = profiling.PipelineProfiler(user_params.output.dir + sys_params.profile_path,
+                                                g_log, profile_children)
+        with g_profiler.profile("driver"):
+            status, errors, durations = run_pipeline(sys_params, user_params, force_steps)
+    else:
+        status, errors, durations = run_pipeline(sys_params, user_params, force_steps)
+    if errors:
+        exit(1)
 
     g_log.loginfo("topaz_run.py main", "All done... good bye")
+    g_log.close()
+
+
+#
+# serve_picks()
+# run the picking service with the model extract would use (or model) and the
+# extract_radius and downsampling of the config
+#
+def serve_picks(config_file, model=None, host="127.0.0.1", port=8765, unix_socket=None, batch_size=8,
+                max_wait=0.02, device=0, num_threads=0, threshold=-6.0, perf_log_format="csv", log_dir=None):
+
+    sys_params = Sys_Params()
+
+    initialize_logging(sys_params, perf_format=perf_log_format, log_dir=log_dir)
+
+    user_params = pf.read_topaz_parameters(config_file)
+    if user_params == None:
+        g_log.loginfo("serve_picks", "Error: Unable to read " + config_file)
+        exit(1)
+
+    if model is None and user_params.parameters.model_selection not in training_metrics.MODEL_SELECTIONS:
+        g_log.loginfo("serve_picks", "Error: model_selection must be one of "
+                                     + ", ".join(training_metrics.MODEL_SELECTIONS))
+        exit(1)
+
+    if model is None:
+        model_name, epoch, metric, value = selected_model(sys_params, user_params)
+        model = user_params.output.file_save_model_path + model_name
+    if not os.path.exists(model):
+        g_log.loginfo("serve_picks", "Error: no model " + model + ", train one first or pass --model")
+        exit(1)
+
+    start_time = time.time()
+    service = picking_service.PickingService(model, user_params.parameters.extract_radius, threshold,
+                                             user_params.parameters.downsampling, device, batch_size, max_wait,
+                                             num_threads, g_log, user_params.output.dir)
+    duration = time.time() - start_time
+    g_log.loginfo("serve_picks", f"model loaded in {duration:.2f} seconds")
+    g_log.logperf(user_params.output.dir, "serve_picks", "model_load", f"{duration:.2f}", "seconds")
+
+    picking_service.serve(service, host, port, unix_socket)
+    g_log.loginfo("serve_picks", "service stopped")
+    g_log.close()
+
+#
+# find_configs()
+# the config files in paths, directories contribute their *.json files
+#
+def find_configs(paths):
+    configs = []
+    for path in paths:
+        if os.path.isdir(path):
+            configs.extend(sorted(glob.glob(os.path.join(path, "*.json"))))
+        else:
+            configs.append(path)
+    return configs
 
+#
+# core_shares()
+# split cores into runs shares that differ by at most one core
+#
+def core_shares(cores, runs):
+    return [cores // runs + (1 if i < cores % runs else 0) for i in range(runs)]
+
+#
+# run_batch()
+# run the pipelines of many configs as topaz_run child processes, at most parallel at
+# a time, each with its share of cores as its core budget.  The event and perf logs
+# and the output of every run are written to {output.dir}/logs, or <log_dir>/<config name>.
+#
+# return:
+# {config: exit code}
+#
+def run_batch(sys_params, config_paths, cores, parallel=0, force_steps=(), perf_log_format="csv", log_dir=None):
+
+    cores = max(1, cores)
+    runs = []
+    output_dirs = {}
+    for config_path in find_configs(config_paths):
+        try:
+            user_params = pf.read_topaz_parameters(config_path)
+        except ValueError as e:
+            # not a pipeline config, e.g. a sweep file next to the configs
+            g_log.loginfo("run_batch", f"skipping {config_path}: {e}")
+            continue
+        if user_params is None:
+            g_log.loginfo("run_batch", f"skipping {config_path}: unable to read it")
+            continue
+        output_dir = user_params.output.dir
+        if output_dir in output_dirs:
+            raise ValueError(f"{config_path} and {output_dirs[output_dir]} write to the same output.dir {output_dir}")
+        output_dirs[output_dir] = config_path
+        run_log_dir = os.path.join(log_dir, os.path.splitext(os.path.basename(config_path))[0]) if log_dir \
+            else output_dir + "/logs"
+        runs.append((config_path, output_dir, run_log_dir))
+    if not runs:
+        raise ValueError("no configs found in " + ", ".join(config_paths))
+
+    parallel = min(len(runs), parallel if parallel > 0 else max(1, cores // 4), cores)
+    # a finished run hands its share to the next
+    shares = queue.Queue()
+    for share in core_shares(cores, parallel):
+        shares.put(share)
+    g_log.loginfo("run_batch", f"{len(runs)} runs, {parallel} at a time on {cores} cores")
+
+    def run(config_path, output_dir, run_log_dir):
+        share = shares.get()
+        try:
+            os.makedirs(run_log_dir, exist_ok=True)
+            command = sys.executable + " -m scripts.topaz_run" \
+            + " --file-path " + shlex.quote(os.path.abspath(config_path)) \
+            + " --cores " + str(share) \
+            + " --log-dir " + shlex.quote(run_log_dir) \
+            + " --perf-log-format " + perf_log_format \
+            + "".join(" --force " + step for step in force_steps)
+            g_log.loginfo("run_batch", f"{config_path}: started with {share} cores, logs in {run_log_dir}")
+            start_time = time.time()
+            with open(os.path.join(run_log_dir, "topaz_run.out"), "w") as output:
+                returncode = subprocess.call(command, shell=True, stdout=output, stderr=subprocess.STDOUT,
+                                             env=dict(os.environ, **thread_env(share)))
+            duration = time.time() - start_time
+        finally:
+            shares.put(share)
+        g_log.loginfo("run_batch", f"{config_path}: exit code {returncode} after {duration:.2f} seconds")
+        g_log.logperf(output_dir, "run_batch", "duration", f"{duration:.2f}", "seconds")
+        g_log.logperf(output_dir, "run_batch", "cores", str(share), "count")
+        return returncode
+
+    with ThreadPoolExecutor(max_workers=parallel) as pool:
+        futures = {config_path: pool.submit(run, config_path, output_dir, run_log_dir)
+                   for config_path, output_dir, run_log_dir in runs}
+    return {config_path: future.result() for config_path, future in futures.items()}
 
 # Create the boilerplate JSON file with a default file path
-@click.command(context_settings={"show_default": True})
+@click.group(invoke_without_command=True, context_settings={"show_default": True})
 @click.option(
    "--file-path",
     type=str,
@@ -382,9 +1289,163 @@ def main(config_file):
     help="The Name for the input parameter file",
 )
 
-def topaz_run(file_path: str):
-    main(file_path)
+@click.option(
+    "--force",
+    "force_steps",
+    type=click.Choice(PIPELINE_STEPS + ["all"]),
+    multiple=True,
+    help="Run this step even if its step cache shows its inputs are unchanged (repeatable)",
+)
+
+@click.option(
+    "--perf-log-format",
+    type=click.Choice(logger.PERF_FORMATS),
+    default="csv",
+    help="Format of topaz_perf.log: comma separated lines or JSON lines with typed fields",
+)
+
+@click.option(
+    "--profile",
+    is_flag=True,
+    help="Profile the driver and every step run in this process into {output.dir}/profile (.pstats and collapsed stacks)",
+)
+
+@click.option(
+    "--profile-children",
+    is_flag=True,
+    help="Also run python child commands (topaz ...) under cProfile, implies --profile",
+)
+
+@click.option(
+    "--executor",
+    type=click.Choice(["inline"] + list(executors.EXECUTORS)),
+    default="inline",
+    help="Run the steps in this process (inline), as jobs of a local stand-in scheduler or as SLURM jobs",
+)
+
+@click.option(
+    "--wait",
+    is_flag=True,
+    help="With --executor slurm wait for the jobs and exit 1 if one failed (--executor local always waits)",
+)
+
+@click.option(
+    "--run-step",
+    "job_step",
+    type=click.Choice(PIPELINE_STEPS),
+    default=None,
+    help="Run only this step, the command of a batch job submitted by --executor",
+)
+
+@click.option(
+    "--shard",
+    type=str,
+    default=None,
+    help="With --run-step: the shard an array task runs, or merge to finish the sharded step",
+)
+
+@click.option(
+    "--log-dir",
+    type=str,
+    default=None,
+    help="Write topaz_event.log and topaz_perf.log into this directory instead of the working directory",
+)
+
+@click.option(
+    "--watch",
+    is_flag=True,
+    help="Pick new galleries under rawdata_images as they arrive with the existing model, appending to predicted_particles.txt",
+)
+
+@click.option(
+    "--poll-interval",
+    type=float,
+    default=10.0,
+    help="With --watch: seconds between looks for new galleries",
+)
+
+@click.option(
+    "--settle",
+    type=float,
+    default=5.0,
+    help="With --watch: seconds a new gallery must be unchanged before it is picked",
+)
+
+@click.option(
+    "--idle-timeout",
+    type=float,
+    default=0.0,
+    help="With --watch: stop when no gallery arrived for this many seconds, 0 watches until interrupted",
+)
+
+@click.option(
+    "--cores",
+    type=int,
+    default=0,
+    help="Core budget of the run: caps the worker counts and the torch/OpenMP/MKL threads, 0 uses every core",
+)
+
+@click.pass_context
+def topaz_run(ctx, file_path: str, force_steps, perf_log_format, profile, profile_children, executor, wait,
+              job_step, shard, log_dir, watch, poll_interval, settle, idle_timeout, cores):
+    ctx.obj = {"file_path": file_path, "perf_log_format": perf_log_format, "log_dir": log_dir,
+               "force_steps": force_steps}
+    if ctx.invoked_subcommand is not None:
+        return
+    if shard is not None and (job_step is None or not (shard == "merge" or shard.isdigit())):
+        raise click.BadParameter("--shard takes a shard index or merge and needs --run-step", param_hint="--shard")
+    if watch and (executor != "inline" or job_step is not None):
+        raise click.BadParameter("--watch runs in this process, without --executor or --run-step", param_hint="--watch")
+    watch_options = {"poll_interval": poll_interval, "settle": settle, "idle_timeout": idle_timeout} if watch else None
+    main(file_path, force_steps, perf_log_format, profile, profile_children, executor, wait, job_step, shard,
+         log_dir, watch_options, cores)
+
+@topaz_run.command(context_settings={"show_default": True})
+@click.option("--model", default=None, help="model to serve, default the model extract uses with the config")
+@click.option("--host", default="127.0.0.1", help="address to listen on")
+@click.option("--port", type=int, default=8765, help="port to listen on")
+@click.option("--socket", "unix_socket", default=None, help="listen on this Unix socket instead of a port")
+@click.option("--batch-size", type=int, default=8, help="largest number of micrographs scored in one forward pass")
+@click.option("--max-wait", type=float, default=0.02, help="seconds to wait for more micrographs to fill a batch")
+@click.option("-d", "--device", type=int, default=0, help="which device to use, <0 corresponds to CPU")
+@click.option("-j", "--num-threads", type=int, default=0, help="number of threads for pytorch, 0 uses pytorch defaults")
+@click.option("-t", "--threshold", type=float, default=-6.0, help="default log-likelihood score threshold")
+@click.pass_context
+def serve(ctx, model, host, port, unix_socket, batch_size, max_wait, device, num_threads, threshold):
+    """
+    Keep the model loaded and pick galleries on request (POST /extract, GET /health).
+    """
+    serve_picks(ctx.obj["file_path"], model, host, port, unix_socket, batch_size, max_wait, device, num_threads,
+                threshold, ctx.obj["perf_log_format"], ctx.obj["log_dir"])
+
+@topaz_run.command(context_settings={"show_default": True})
+@click.argument("configs", nargs=-1, required=True)
+@click.option("--cores", type=int, default=os.cpu_count() or 1, help="cores shared by the runs")
+@click.option("--parallel", type=int, default=0, help="runs at a time, 0 gives every run at least 4 cores")
+@click.option("--log-dir", "runs_log_dir", default=None,
+              help="write the logs of every run to <log-dir>/<config name> instead of {output.dir}/logs")
+@click.pass_context
+def batch(ctx, configs, cores, parallel, runs_log_dir):
+    """
+    Run the pipelines of many configs (files or directories of *.json) concurrently within --cores.
+    """
+    sys_params = Sys_Params()
+    initialize_logging(sys_params, perf_format=ctx.obj["perf_log_format"], log_dir=ctx.obj["log_dir"])
+    try:
+        returncodes = run_batch(sys_params, configs, cores, parallel, ctx.obj["force_steps"],
+                                ctx.obj["perf_log_format"], runs_log_dir)
+    except ValueError as e:
+        g_log.loginfo("batch", f"Error: {e}")
+        exit(1)
+    failed = [config_path for config_path, returncode in returncodes.items() if returncode != 0]
+    for config_path in failed:
+        g_log.loginfo("batch", f"Error: {config_path} failed")
+    if failed:
+        exit(1)
+    g_log.loginfo("batch", f"All {len(returncodes)} runs done... good bye")
+    g_log.close()
 
 if __name__ == "__main__":
-    cli() 
+    # the command of the batch jobs submitted by --executor
+    topaz_run()
 
@@ -1,17 +1,21 @@
 #!/bin/bash
 #! chmod +x run_topaz.sh
-#! ./run_topaz.sh params.json
+#! ./run_topaz.sh params.json [topaz_run options, e.g. --executor slurm --wait]
+#
+# submitted batch jobs run "python -m scripts.topaz_run" with the python of the
+# environment activated here, so they do not go through this script again
 
 ml anaconda/latest 
 conda activate /hpc/projects/group.czii/krios1.processing/software/topaz_wrapper/pytopaz
 
-if [ $# -ne 1 ]; then
-    echo "Usage: $0 absolute_path_to_config_file"
+if [ $# -lt 1 ]; then
+    echo "Usage: $0 absolute_path_to_config_file [topaz_run options]"
     exit 1
 fi
 
 # Assign the parameter to a variable
 CONFIG_FILE=$1
+shift
 
 echo
 echo Running Topaz Commands with $CONFIG_FILE
@@ -19,7 +23,7 @@ echo
 
 date; step_start_time=`date +%s`
 
-topaz_run --file-path $CONFIG_FILE
+topaz_run --file-path $CONFIG_FILE "$@"
 
 echo
 echo End Run Topaz Commmands
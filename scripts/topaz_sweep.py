@@ -0,0 +1,259 @@
+# topaz_sweep.py
+#  - hyperparameter sweeps over TopazParameters fields
+#
+# A sweep file lists values for one or more TopazParameters fields, either as a list
+# or as an inclusive range:
+#
+#   {
+#       "parameters": {
+#           "extract_radius": [10, 12, 14],
+#           "train_radius": {"start": 2, "stop": 4, "step": 1}
+#       }
+#   }
+#
+# The cartesian product of the values is expanded into runs under
+# <output.dir>/sweep/<run name>/.  A step's artifacts depend only on the parameters
+# the step and its upstream steps read, so runs that agree on those parameters share
+# one copy: the first run computes the step and later runs symlink its outputs
+# (e.g. one set of preprocessed micrographs per downsampling value).
+#
+# Timings and pick counts of every run are collected in <output.dir>/sweep/sweep_summary.csv
+#
+# Usage - $ topaz_sweep --file-path $CONFIG_FILE --sweep-file $SWEEP_FILE
+
+import csv
+import glob
+import itertools
+import json
+import os
+
+import click
+
+from scripts import logger
+from scripts import parameters_factory as pf
+from scripts import pipeline_graph as pg
+from scripts import topaz_run as tr
+
+STEP_FLAGS = {
+    "calculate_centers": "run_calculate_centers",
+    "preprocess": "run_preprocess",
+    "convert": "run_convert",
+    "train_test_split": "run_split_test_train",
+    "train": "run_train",
+    "extract": "run_extract",
+    "visualize_picks": "run_visualize_picks",
+    "evaluate_picks": "run_evaluate_picks",
+}
+
+#
+# read_sweep()
+# returns an ordered list of (field, [values]) from a sweep file
+#
+def read_sweep(sweep_file):
+    with open(sweep_file, "r") as f:
+        spec = json.load(f)
+
+    sweep = []
+    for field, values in spec["parameters"].items():
+        if field not in pf.TopazParameters.__fields__:
+            raise ValueError(f"{field} is not a TopazParameters field")
+        if isinstance(values, dict):
+            start, stop, step = values["start"], values["stop"], values.get("step", 1)
+            values = []
+            value = start
+            while value <= stop:
+                values.append(value)
+                value += step
+        if not values:
+            raise ValueError(f"no values given for {field}")
+        sweep.append((field, list(values)))
+    return sweep
+
+def run_name(overrides):
+    return "_".join(f"{field}-{value}" for field, value in overrides.items())
+
+#
+# expand_runs()
+# one ProcessingConfig per combination of sweep values, with its own output
+# directory and model directory
+#
+def expand_runs(user_params, sweep):
+    sweep_dir = user_params.output.dir + "/sweep"
+    fields = [field for field, _ in sweep]
+    runs = []
+    for values in itertools.product(*[values for _, values in sweep]):
+        overrides = dict(zip(fields, values))
+        run_params = user_params.copy(deep=True)
+        run_params.parameters = pf.TopazParameters(**dict(user_params.parameters.dict(), **overrides))
+        run_params.output.dir = sweep_dir + "/" + run_name(overrides)
+        run_params.output.file_save_model_path = run_params.output.dir + "/models"
+        runs.append((run_name(overrides), overrides, run_params))
+    return sweep_dir, runs
+
+#
+# artifact_keys()
+# for every step, the values of the parameters the step and all of its upstream
+# steps depend on.  Two runs with equal keys for a step produce the same artifacts.
+#
+def artifact_keys(sys_params, user_params):
+    step_io = tr.pipeline_step_io(sys_params, user_params)
+    steps = [pg.PipelineStep(step, None, step_io[step][1], step_io[step][2]) for step in tr.PIPELINE_STEPS]
+    dependencies = pg.build_dependencies(steps)
+
+    keys = {}
+    for step in tr.PIPELINE_STEPS:
+        key = {}
+        for dependency in dependencies[step]:
+            key.update(keys[dependency])
+        key.update(step_io[step][0])
+        keys[step] = key
+    return {step: json.dumps(key, sort_keys=True) for step, key in keys.items()}
+
+#
+# link_outputs()
+# symlink the outputs of step from the run that produced them into run_params
+#
+def link_outputs(step, sys_params, owner_params, run_params):
+    owner_outputs = tr.pipeline_step_io(sys_params, owner_params)[step][2]
+    run_outputs = tr.pipeline_step_io(sys_params, run_params)[step][2]
+    for source, destination in zip(owner_outputs, run_outputs):
+        if source == destination:
+            continue
+        if glob.has_magic(source) and os.path.dirname(source) != owner_params.output.dir:
+            # a directory of outputs, e.g. micrographs/ or models/
+            pairs = [(os.path.dirname(source), os.path.dirname(destination))]
+        elif glob.has_magic(source):
+            pairs = [(path, os.path.join(os.path.dirname(destination), os.path.basename(path)))
+                     for path in glob.glob(source)]
+        else:
+            pairs = [(source, destination)]
+        for source_path, destination_path in pairs:
+            if os.path.lexists(destination_path):
+                continue
+            os.makedirs(os.path.dirname(destination_path), exist_ok=True)
+            os.symlink(source_path, destination_path)
+
+def count_picks(predicted_particles, score):
+    total = 0
+    above = 0
+    try:
+        with open(predicted_particles, "r") as f:
+            next(f)
+            for line in f:
+                total += 1
+                if float(line.rsplit("\t", 1)[1]) >= score:
+                    above += 1
+    except (FileNotFoundError, StopIteration):
+        return "", ""
+    return total, above
+
+def run_sweep(sys_params, user_params, sweep, force_steps=()):
+
+    log = tr.g_log
+    sweep_dir, runs = expand_runs(user_params, sweep)
+    log.loginfo("run_sweep", f"expanded {len(runs)} runs into {sweep_dir}")
+    for name, overrides, run_params in runs:
+        if run_params.parameters.model_selection not in tr.training_metrics.MODEL_SELECTIONS:
+            raise ValueError(f"{name}: model_selection must be one of "
+                             + ", ".join(tr.training_metrics.MODEL_SELECTIONS))
+
+    owners = {}
+    rows = []
+    for name, overrides, run_params in runs:
+        keys = artifact_keys(sys_params, run_params)
+        columns = {step: "" for step in tr.PIPELINE_STEPS}
+        for step in tr.PIPELINE_STEPS:
+            flag = STEP_FLAGS[step]
+            if getattr(run_params.pipeline, flag) != "yes":
+                continue
+            owner = owners.get((step, keys[step]))
+            if owner is None:
+                owners[(step, keys[step])] = run_params
+            else:
+                link_outputs(step, sys_params, owner, run_params)
+                setattr(run_params.pipeline, flag, "no")
+                columns[step] = "shared"
+                log.loginfo("run_sweep", f"{name}: {step} shared from {owner.output.dir}")
+
+        tr.ensure_directory_exists(run_params.output.dir)
+        log.loginfo("run_sweep", f"{name}: running")
+        status, errors, durations = tr.run_pipeline(sys_params, run_params, force_steps)
+
+        for step, state in status.items():
+            if state != "done" and owners.get((step, keys[step])) is run_params:
+                # later runs compute this artifact themselves
+                del owners[(step, keys[step])]
+            if state != "done":
+                columns[step] = state
+            elif durations[step] is None:
+                columns[step] = "cached"
+            else:
+                columns[step] = f"{durations[step]:.2f}"
+        total_time = sum(duration for duration in durations.values() if duration)
+        picks_total, picks_above_score = count_picks(run_params.output.dir + sys_params.predicted_particles,
+                                                     run_params.parameters.score)
+        row = {"run": name}
+        row.update(overrides)
+        row["status"] = "failed" if errors else "ok"
+        row.update(columns)
+        row["total_seconds"] = f"{total_time:.2f}"
+        row["picks"] = picks_total
+        row["picks_above_score"] = picks_above_score
+        rows.append(row)
+        log.logperf(run_params.output.dir, "run_sweep", "duration", f"{total_time:.2f}", "seconds")
+
+    summary = sweep_dir + "/sweep_summary.csv"
+    with open(summary, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[0].keys()))
+        writer.writeheader()
+        writer.writerows(rows)
+    log.loginfo("run_sweep", "summary written to " + summary)
+    return rows
+
+@click.command(context_settings={"show_default": True})
+@click.option(
+    "--file-path",
+    type=str,
+    required=False,
+    default='params.json',
+    help="The Name for the base input parameter file",
+)
+@click.option(
+    "--sweep-file",
+    type=str,
+    required=True,
+    help="JSON file listing the TopazParameters values to sweep",
+)
+@click.option(
+    "--force",
+    "force_steps",
+    type=click.Choice(tr.PIPELINE_STEPS + ["all"]),
+    multiple=True,
+    help="Run this step in every sweep run even if its step cache shows its inputs are unchanged",
+)
+@click.option(
+    "--perf-log-format",
+    type=click.Choice(logger.PERF_FORMATS),
+    default="csv",
+    help="Format of topaz_perf.log: comma separated lines or JSON lines with typed fields",
+)
+def topaz_sweep(file_path: str, sweep_file: str, force_steps, perf_log_format):
+
+    sys_params = tr.Sys_Params()
+    log = tr.initialize_logging(sys_params, perf_format=perf_log_format)
+
+    user_params = pf.read_topaz_parameters(file_path)
+    if user_params == None:
+        log.loginfo("topaz_sweep", "Error: Unable to read " + file_path)
+        exit(1)
+
+    try:
+        rows = run_sweep(sys_params, user_params, read_sweep(sweep_file), force_steps)
+    except ValueError as e:
+        log.loginfo("topaz_sweep", f"Error: {e}")
+        exit(1)
+    if any(row["status"] != "ok" for row in rows):
+        exit(1)
+
+if __name__ == "__main__":
+    topaz_sweep()
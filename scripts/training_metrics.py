@@ -0,0 +1,346 @@
+# training_metrics.py
+#  - topaz train checkpoints, the model_training.txt train/test curve and resumed training
+#
+# topaz train saves <save_prefix>_epoch<N>.sav after every epoch (N padded to
+# ceil(log10(num_epochs)) digits) and writes one "test" row of metrics per epoch to
+# model_training.txt (-o).  It always counts epochs from 1, so a resumed training
+# (-m <last checkpoint> --num-epochs <remaining>) writes to <save_prefix>_resume and
+# model_training_resume.txt, and fold_resumed() renames and appends them into the
+# original sequence.  If the resumed training is killed, the next run folds whatever
+# it finished before resuming again.
+#
+# topaz logs an epoch's test row before it saves the epoch's checkpoint, and the save
+# is not atomic, so a training killed while saving leaves a truncated checkpoint with
+# a matching log row.  A run only resumes from a checkpoint that loads; broken ones
+# are removed and the previous epoch is resumed instead.
+#
+# The training state file records the train parameters and split files a checkpoint
+# sequence was trained with, so a run only resumes checkpoints of the same training,
+# and how a training that was stopped early ended:
+#   {"training": {...}, "resume": {"offset": 7, "num_epochs": 3}}
+#   {"training": {...}, "early_stopped": {"stop_epoch": 9, "best_epoch": 6, "metric": "auprc", "value": 0.91}}
+#
+
+import glob
+import io
+import json
+import math
+import os
+import re
+import threading
+
+import pandas as pd
+
+# test metrics a model can be selected by, and whether larger is better
+SELECTION_METRICS = {
+    "auprc": True,
+    "precision": True,
+    "adjusted_precision": True,
+    "tpr": True,
+    "loss": False,
+    "fpr": False,
+}
+MODEL_SELECTIONS = ["last"] + list(SELECTION_METRICS)
+
+#
+# checkpoint_name()
+# the checkpoint topaz train saves after epoch when training num_epochs epochs
+#
+def checkpoint_name(save_prefix, num_epochs, epoch):
+    digits = int(math.ceil(math.log10(num_epochs))) if num_epochs > 1 else 0
+    return save_prefix + ("_epoch{:0" + str(digits) + "}.sav").format(epoch)
+
+#
+# checkpoints()
+# {epoch: path} of the checkpoints saved with save_prefix
+#
+def checkpoints(save_prefix):
+    found = {}
+    for path in glob.glob(glob.escape(save_prefix) + "_epoch*.sav"):
+        match = re.fullmatch(r"_epoch(\d+)\.sav", path[len(save_prefix):])
+        if match is not None:
+            found[int(match.group(1))] = path
+    return found
+
+#
+# latest_checkpoint()
+# the last epoch saved for a training of num_epochs epochs, 0 if there is none
+#
+def latest_checkpoint(save_prefix, num_epochs):
+    epochs = [epoch for epoch, path in checkpoints(save_prefix).items()
+              if epoch <= num_epochs and path == checkpoint_name(save_prefix, num_epochs, epoch)]
+    return max(epochs, default=0)
+
+#
+# checkpoint_loads()
+# True when the checkpoint at path is complete, i.e. topaz can load the model from it
+#
+def checkpoint_loads(path):
+    from topaz.model.factory import load_model
+
+    try:
+        load_model(path)
+    except Exception:
+        return False
+    return True
+
+#
+# read_test_metrics()
+# the "test" rows of model_training.txt indexed by epoch, empty if there are none.
+# topaz may still be writing the log, a last line without a newline is left out.
+#
+def read_test_metrics(log_path):
+    try:
+        with open(log_path, "r") as f:
+            text = f.read()
+    except FileNotFoundError:
+        return pd.DataFrame()
+    text = text[:text.rfind("\n") + 1]
+    try:
+        log = pd.read_csv(io.StringIO(text), sep="\t", na_values="-")
+    except pd.errors.EmptyDataError:
+        return pd.DataFrame()
+    if "split" not in log.columns:
+        return pd.DataFrame()
+    test = log[log["split"] == "test"]
+    # a restarted epoch is logged again, its last row counts
+    return test.drop_duplicates("epoch", keep="last").set_index("epoch")
+
+#
+# best_epoch()
+# the epoch in epochs with the best test metric
+#
+# return:
+# (epoch, value), (None, None) if model_training.txt has no test metrics for them
+#
+def best_epoch(log_path, metric, epochs):
+    if metric not in SELECTION_METRICS:
+        raise ValueError("model_selection must be one of " + ", ".join(MODEL_SELECTIONS) + ", not " + metric)
+    test = read_test_metrics(log_path)
+    if test.empty or metric not in test.columns:
+        return None, None
+    values = test.loc[test.index.isin(list(epochs)), metric].dropna()
+    if values.empty:
+        return None, None
+    epoch = values.idxmax() if SELECTION_METRICS[metric] else values.idxmin()
+    return int(epoch), float(values[epoch])
+
+def read_state(state_file):
+    try:
+        with open(state_file, "r") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+def write_state(state_file, state):
+    tmp = state_file + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(state, f, indent=1)
+    os.replace(tmp, state_file)
+
+def resume_log_path(log_path):
+    base, ext = os.path.splitext(log_path)
+    return base + "_resume" + ext
+
+#
+# truncate_training_log()
+# drop the rows of epochs after max_epoch, they are trained again
+#
+def truncate_training_log(log_path, max_epoch):
+    if not os.path.exists(log_path):
+        return
+    with open(log_path, "r") as f:
+        lines = f.readlines()
+    kept = lines[:1] + [line for line in lines[1:] if line.strip() and int(line.split("\t", 1)[0]) <= max_epoch]
+    if len(kept) != len(lines):
+        with open(log_path, "w") as f:
+            f.writelines(kept)
+
+#
+# append_training_log()
+# append the rows of epochs 1..max_epoch of a resumed training to log_path with
+# epochs shifted by epoch_offset and iterations continuing the logged ones
+#
+def append_training_log(resume_log, log_path, epoch_offset, max_epoch):
+    if not os.path.exists(resume_log):
+        return
+    with open(resume_log, "r") as f:
+        lines = f.readlines()
+    iteration_offset = 0
+    if os.path.exists(log_path):
+        with open(log_path, "r") as f:
+            logged = [line for line in f.readlines()[1:] if line.strip()]
+        # test rows carry the iteration after the epoch, continue from the last train row
+        iterations = [int(line.split("\t")[1]) for line in logged if line.split("\t")[2] == "train"]
+        iteration_offset = max(iterations, default=0)
+    else:
+        with open(log_path, "w") as f:
+            f.write(lines[0] if lines else "")
+
+    with open(log_path, "a") as f:
+        for line in lines[1:]:
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) < 3 or int(fields[0]) > max_epoch:
+                continue
+            fields[0] = str(int(fields[0]) + epoch_offset)
+            fields[1] = str(int(fields[1]) + iteration_offset)
+            f.write("\t".join(fields) + "\n")
+
+#
+# fold_resumed()
+# move the checkpoints and log rows of a resumed training recorded in the state file
+# into the original checkpoint sequence and model_training.txt
+#
+def fold_resumed(save_prefix, log_path, state_file):
+    state = read_state(state_file)
+    resume = state.get("resume")
+    if not resume:
+        return
+    offset = resume["offset"]
+    num_epochs = offset + resume["num_epochs"]
+
+    folded = 0
+    for epoch, path in sorted(checkpoints(save_prefix + "_resume").items()):
+        if epoch <= resume["num_epochs"]:
+            os.replace(path, checkpoint_name(save_prefix, num_epochs, offset + epoch))
+            folded = max(folded, epoch)
+        else:
+            os.remove(path)
+
+    truncate_training_log(log_path, offset)
+    append_training_log(resume_log_path(log_path), log_path, offset, folded)
+    if os.path.exists(resume_log_path(log_path)):
+        os.remove(resume_log_path(log_path))
+    state.pop("resume")
+    write_state(state_file, state)
+
+#
+# resume_epoch()
+# the epoch an interrupted training of the same parameters and splits can resume
+# after, 0 to train from scratch.  A finished or early stopped training is trained again.
+#
+def resume_epoch(save_prefix, log_path, state_file, training, num_epochs):
+    state = read_state(state_file)
+    if state.get("training") != training or "early_stopped" in state:
+        return 0
+    fold_resumed(save_prefix, log_path, state_file)
+    latest = latest_checkpoint(save_prefix, num_epochs)
+    while latest > 0 and not checkpoint_loads(checkpoint_name(save_prefix, num_epochs, latest)):
+        # cut off while it was saved, the epoch is trained again
+        os.remove(checkpoint_name(save_prefix, num_epochs, latest))
+        latest = latest_checkpoint(save_prefix, num_epochs)
+    if latest >= num_epochs:
+        return 0
+    truncate_training_log(log_path, latest)
+    return latest
+
+#
+# read_live_test_metrics()
+# the test metrics of a running training indexed by the epoch of the whole training:
+# model_training.txt, and while resuming after resume_offset epochs the rows of the
+# resumed training on top of the first resume_offset epochs
+#
+def read_live_test_metrics(log_path, resume_offset=0):
+    if not resume_offset:
+        return read_test_metrics(log_path)
+    earlier = read_test_metrics(log_path)
+    if not earlier.empty:
+        earlier = earlier[earlier.index <= resume_offset]
+    resumed = read_test_metrics(resume_log_path(log_path))
+    if not resumed.empty:
+        resumed.index = resumed.index + resume_offset
+    return pd.concat([earlier, resumed])
+
+#
+# EarlyStoppingMonitor
+# polls the test metrics of a running topaz train every interval seconds and sets
+# stop once metric has not improved by more than min_delta for patience epochs.
+# best_epoch / best_value hold the best epoch so far, stop_epoch the epoch that
+# triggered the stop.
+#
+class EarlyStoppingMonitor(threading.Thread):
+
+    def __init__(self, log_path, metric, patience, min_delta=0.0, resume_offset=0, log=None,
+                 log_module="early_stopping", interval=5.0):
+        super().__init__(name="EarlyStoppingMonitor", daemon=True)
+        if metric not in SELECTION_METRICS:
+            raise ValueError("early_stopping_metric must be one of " + ", ".join(SELECTION_METRICS) + ", not " + metric)
+        if patience < 1:
+            raise ValueError(f"early_stopping_patience must be at least 1, not {patience}")
+        self.log_path = log_path
+        self.metric = metric
+        self.patience = patience
+        self.min_delta = min_delta
+        self.resume_offset = resume_offset
+        self.log = log
+        self.log_module = log_module
+        self.interval = interval
+        self.stop = threading.Event()
+        self.finished = threading.Event()
+        self.best_epoch = None
+        self.best_value = None
+        self.stop_epoch = None
+        self.last_epoch = 0
+
+    def run(self):
+        while not self.finished.wait(self.interval):
+            if self.poll():
+                return
+
+    def finish(self):
+        self.finished.set()
+        self.join()
+
+    def improved(self, value):
+        if self.best_value is None:
+            return True
+        if SELECTION_METRICS[self.metric]:
+            return value > self.best_value + self.min_delta
+        return value < self.best_value - self.min_delta
+
+    #
+    # poll()
+    # read the epochs logged since the last poll, return True once training should stop
+    #
+    def poll(self):
+        try:
+            test = read_live_test_metrics(self.log_path, self.resume_offset)
+        except ValueError as e:
+            # a log topaz is writing, read it again on the next poll
+            if self.log is not None:
+                self.log.loginfo(self.log_module, f"cannot read the test metrics yet: {e!r}")
+            return False
+        if test.empty or self.metric not in test.columns:
+            return False
+        for epoch, value in test[self.metric].sort_index().items():
+            if epoch <= self.last_epoch or pd.isna(value):
+                continue
+            self.last_epoch = int(epoch)
+            if self.improved(value):
+                self.best_epoch, self.best_value = int(epoch), float(value)
+            if self.log is not None:
+                self.log.loginfo(self.log_module, f"epoch {epoch} test {self.metric} {value:.4f}, "
+                                                  f"best {self.best_value:.4f} at epoch {self.best_epoch}")
+            if self.last_epoch - self.best_epoch >= self.patience:
+                self.stop_epoch = self.last_epoch
+                if self.log is not None:
+                    self.log.loginfo(self.log_module, f"no improvement for {self.patience} epochs, stopping "
+                                                      f"after epoch {self.stop_epoch}")
+                self.stop.set()
+                return True
+        return False
+
+#
+# record_early_stop()
+# drop the checkpoints from the stop epoch on, the stop epoch's may have been cut off
+# while it was written, and record the best epoch for extraction.  The best epoch's
+# checkpoint is always kept.
+#
+def record_early_stop(save_prefix, state_file, monitor):
+    for epoch, path in checkpoints(save_prefix).items():
+        if epoch >= monitor.stop_epoch and epoch != monitor.best_epoch:
+            os.remove(path)
+    state = read_state(state_file)
+    state["early_stopped"] = {"stop_epoch": monitor.stop_epoch, "best_epoch": monitor.best_epoch,
+                              "metric": monitor.metric, "value": monitor.best_value}
+    write_state(state_file, state)
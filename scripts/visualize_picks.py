@@ -1,12 +1,17 @@
 import numpy as np
 import pandas as pd
+import matplotlib
+if __name__ != "__main__":
+    # imported by topaz_run or an overlay worker: render to files, never to a GUI
+    matplotlib.use("Agg")
 import matplotlib.pyplot as plt
-from matplotlib.patches import Circle
-from PIL import Image
-import glob
+from matplotlib.collections import EllipseCollection
 import os
-import sys
 import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+import mrcfile
 import click
 
 @click.group()
@@ -15,40 +20,70 @@ def cli(ctx):
     pass
 
 
+#
+# open_micrograph()
+# memory map one processed micrograph.  Pixel data is only read from disk when
+# it is drawn, so the cost depends on the images plotted, not on the session size.
+#
+@contextmanager
+def open_micrograph(processed_images_dir, name):
+    with mrcfile.mmap(os.path.join(processed_images_dir, name + ".mrc"), mode='r', permissive=True) as mrc:
+        im = mrc.data
+        if im.ndim == 3 and im.shape[0] == 1:
+            im = im[0]
+        if im.dtype == np.float16:
+            im = im.astype(np.float32)
+        yield im
+
+#
+# group_coordinates()
+# (x, y) coordinate arrays per image_name, built with one pass over the picks
+#
+def group_coordinates(particles):
+    coordinates = particles[['x_coord', 'y_coord']].to_numpy()
+    return {name: coordinates[rows] for name, rows in particles.groupby('image_name').indices.items()}
+
 #
 # print out a distribution of confidence scores
 # print out a plot of predicted and ground truth overlays
 # save plots to png files
+#
+# number_of_images_to_visualize <= 0 plots every test image.  Overlays are
+# rendered by number_workers processes with the non-interactive Agg backend, which
+# the module selects when it is imported.  display_plots "yes" needs a GUI backend on
+# the main thread and is only shown when this file runs as a script (topaz_run starts
+# it as a child then).  Figures are drawn through their own axes, not the current pyplot
+# figure, so other threads using pyplot do not interfere.  report is called with
+# each summary line.
 # 
 
 def main(root_path, dataset_path, predicted_particles_file_path, processed_particles_file_path, \
-         processed_images, train_targets, radius, number_of_images_to_visualize, display_plots, score):
+         processed_images, train_targets, radius, number_of_images_to_visualize, display_plots, score, \
+         number_workers=1, report=print):
     
     root_path = root_path
     dataset_path = dataset_path
     predicted_particles_file_path = predicted_particles_file_path
     processed_particles_file_path = processed_particles_file_path
-    processed_images = processed_images + "*.mrc"
     train_targets = train_targets
     radius = int(radius)
-
-    sys.path.append(root_path)
-    from topaz.utils.data.loader import load_image
+    score = str(score)
 
     predicted_particles = pd.read_csv(predicted_particles_file_path, sep='\t')
-    predicted_particles.head()
 
     # plot the distribution of scores (predicted log-likelihood ratios)
-    _ = plt.hist(predicted_particles.score, bins=50)
-    plt.xlabel('Predicted score (predicted log-likelihood ratio) radius==' + str(radius))
-    plt.ylabel('Number of particles')
-    plt.savefig(dataset_path + "/scores_distribution_radius_" + str(radius) + ".png")
+    fig, ax = plt.subplots()
+    _ = ax.hist(predicted_particles.score, bins=50)
+    ax.set_xlabel('Predicted score (predicted log-likelihood ratio) radius==' + str(radius))
+    ax.set_ylabel('Number of particles')
+    fig.savefig(dataset_path + "/scores_distribution_radius_" + str(radius) + ".png")
     if display_plots == "yes":
             plt.show()   
+    plt.close(fig)
 
     # print the mumber of particles >= score 
     num_particles =np.sum(predicted_particles.score >= int(score)) # how many particles are predicted with score >= 0
-    print("Number of particles with score > " + score + " = " + str(num_particles))
+    report("Number of particles with score > " + score + " = " + str(num_particles))
 
     #
     # Show the overlay of predicted particles and ground truth particles
@@ -59,54 +94,68 @@ def main(root_path, dataset_path, predicted_particles_file_path, processed_parti
 
     # print the mumber of ground truth particles
     num_labeled_particles = np.sum(labeled_particles.image_name != "") # number of ground truth particles
-    print("Number of labeled particles = " + str(num_labeled_particles))
+    report("Number of labeled particles = " + str(num_labeled_particles))
 
 
-    ## load the micrographs for visualization
-    micrographs = {}
-    for path in glob.glob(processed_images):
-        im = np.array(load_image(path), copy=False)
-        name,_ = os.path.splitext(os.path.basename(path))
-        micrographs[name] = im
-
+    ## resolve the test set micrographs to visualize before reading any image data
     images_test = pd.read_csv(train_targets, sep='\t')
-    images_test = set(images_test.image_name)
-    image_names = list(images_test) # micrograph names for the test set
+    image_names = [name for name in pd.unique(images_test.image_name) # micrograph names for the test set
+                   if os.path.exists(os.path.join(processed_images, name + ".mrc"))]
+    if int(number_of_images_to_visualize) > 0:
+        image_names = image_names[:int(number_of_images_to_visualize)]
+
+    # visualize predicted particles with log-likelihood ratio >= score (score 0 is p >= 0.5)
+    predicted = group_coordinates(predicted_particles.loc[predicted_particles['score'] >= int(score)])
+    ground_truth = group_coordinates(labeled_particles)
+    empty = np.empty((0, 2))
+
+    label = " predicted==blue(" + str(num_particles) + "); ground_truth==red(" + str(num_labeled_particles) + "); score >= " + score
+    tasks = [(processed_images, name, predicted.get(name, empty), ground_truth.get(name, empty), \
+              dataset_path, radius, name + label, display_plots) for name in image_names]
+
+    if display_plots == "yes" or int(number_workers) <= 1 or len(tasks) <= 1:
+        for task in tasks:
+            render_overlay(task)
+    else:
+        # spawn, the caller (topaz_run) may have threads running
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=int(number_workers), mp_context=context) as pool:
+            list(pool.map(render_overlay, tasks))
+    report("Rendered " + str(len(tasks)) + " overlays")
 
-    for image_name in image_names[:int(number_of_images_to_visualize)]:
+#
+# render_overlay()
+# plot the predicted (blue) and ground truth (red) particles of one micrograph
+# and save it as <name>_predicted_plus_ground_truth.png
+#
+def render_overlay(task):
 
-        name = image_name
-        im = micrographs[name]
-        particles = predicted_particles.loc[predicted_particles['image_name'] == name]
+    processed_images, name, particles, ground_truth, dataset_path, radius, label, display_plots = task
 
-        # visualize predicted particles with log-likelihood ratio >= 0 (p >= 0.5)
-        particles = particles.loc[particles['score'] >= int(score)]
+    with open_micrograph(processed_images, name) as im:
 
         #
         # plot the overlay of predicted and truth and show them
         #
 
-        _,ax = plt.subplots(figsize=(16,16))
+        fig,ax = plt.subplots(figsize=(16,16))
         ax.imshow(im, cmap='Greys_r', vmin=-3.5, vmax=3.5, interpolation='bilinear')
 
-        # plot the predicted particles in blue
-        for x,y in zip(particles.x_coord, particles.y_coord):
-            c = Circle((x,y),radius,fill=False,color='b')
-            ax.add_patch(c)
-        
-        # plot the (partial) ground truth particles in red
-        ground_truth = labeled_particles.loc[labeled_particles['image_name'] == name]
+        # plot the predicted particles in blue, all circles in one collection
+        ax.add_collection(EllipseCollection(2 * radius, 2 * radius, 0, units='xy', offsets=particles, \
+                                            offset_transform=ax.transData, facecolors='none', edgecolors='b'))
 
-        for x,y in zip(ground_truth.x_coord, ground_truth.y_coord):
-            c = Circle((x,y),radius/2,fill=False,color='r')
-            ax.add_patch(c)
+        # plot the (partial) ground truth particles in red
+        ax.add_collection(EllipseCollection(radius, radius, 0, units='xy', offsets=ground_truth, \
+                                            offset_transform=ax.transData, facecolors='none', edgecolors='r'))
 
-        plt.xlabel(name + " predicted==blue(" + str(num_particles) + "); ground_truth==red(" + str(num_labeled_particles) + "); score >= " + score)
-        plt.savefig(dataset_path + "/" + name + "_predicted_plus_ground_truth.png")
+        ax.set_xlabel(label)
+        fig.savefig(dataset_path + "/" + name + "_predicted_plus_ground_truth.png")
         if display_plots == "yes":
             plt.show()
+        plt.close(fig)
+
 
-    
 if __name__ == "__main__":
 
     # Create the parser
@@ -123,15 +172,19 @@ if __name__ == "__main__":
     parser.add_argument("number_of_images_to_visualize", type=str)
     parser.add_argument("display_plots", type=str)
     parser.add_argument("score", type=str)  
+    parser.add_argument("--workers", type=int, default=1)
 
     # Parse the arguments
     args = parser.parse_args()
+
+    if args.display_plots != "yes":
+        matplotlib.use("Agg")
     
     # Pass the input strings to the main function
     main(args.root_path, args.dataset_path, args.predicted_particles_file_path, \
          args.processed_particles_file_path, args.processed_images, \
               args.train_targets, args.radius, args.number_of_images_to_visualize, args.display_plots, \
-                args.score)
+                args.score, args.workers)
 
 '''
 import click
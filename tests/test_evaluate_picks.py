@@ -0,0 +1,60 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from scripts import evaluate_picks as ep
+
+def picks(rows):
+    return pd.DataFrame(rows, columns=["image_name", "x_coord", "y_coord", "score"])
+
+def truth(rows):
+    return pd.DataFrame(rows, columns=["image_name", "x_coord", "y_coord"])
+
+def test_match_within_radius_and_image():
+    predicted = picks([("a", 0, 0, 1.0), ("a", 20, 0, 1.0), ("b", 0, 0, 1.0)])
+    ground_truth = truth([("a", 3, 4), ("c", 0, 0)])
+    assert ep.match_picks(predicted, ground_truth, 5).tolist() == [True, False, False]
+
+def test_taken_nearest_pick_falls_back_to_a_free_one():
+    # the lower scoring prediction's nearest ground truth pick (x=0) is taken, x=8 is free and in range
+    predicted = picks([("a", 1, 0, 2.0), ("a", 3, 0, 1.0)])
+    ground_truth = truth([("a", 0, 0), ("a", 8, 0)])
+    assert ep.match_picks(predicted, ground_truth, 6).tolist() == [True, True]
+
+def test_each_ground_truth_pick_counts_once_for_the_highest_score():
+    predicted = picks([("a", 1, 0, 0.5), ("a", -1, 0, 2.0)])
+    ground_truth = truth([("a", 0, 0)])
+    assert ep.match_picks(predicted, ground_truth, 5).tolist() == [False, True]
+
+def test_empty_inputs():
+    assert len(ep.match_picks(picks([]), truth([("a", 0, 0)]), 5)) == 0
+    assert ep.match_picks(picks([("a", 0, 0, 1.0)]), truth([]), 5).tolist() == [False]
+
+def test_curve_reports_the_last_pick_of_tied_scores():
+    scores = np.array([3.0, 2.0, 2.0, 1.0])
+    matched = np.array([True, False, True, False])
+    curve = ep.precision_recall_curve(scores, matched, num_truth=4)
+    assert curve.threshold.tolist() == [3.0, 2.0, 1.0]
+    assert curve.true_positives.tolist() == [1, 2, 2]
+    assert curve.precision.tolist() == pytest.approx([1.0, 2 / 3, 0.5])
+    assert curve.recall.tolist() == pytest.approx([0.25, 0.5, 0.5])
+
+def test_average_precision():
+    # perfect ranking of every ground truth pick
+    curve = ep.precision_recall_curve(np.array([3.0, 2.0]), np.array([True, True]), num_truth=2)
+    assert ep.average_precision(curve) == pytest.approx(1.0)
+    # a false positive ranked first: 1/2 recall at precision 1/2, then 1/2 more at precision 2/3
+    curve = ep.precision_recall_curve(np.array([3.0, 2.0, 1.0]), np.array([False, True, True]), num_truth=2)
+    assert ep.average_precision(curve) == pytest.approx(0.5 * 0.5 + 0.5 * 2 / 3)
+    # half the ground truth is never found
+    curve = ep.precision_recall_curve(np.array([1.0]), np.array([True]), num_truth=2)
+    assert ep.average_precision(curve) == pytest.approx(0.5)
+
+def test_evaluate_restricts_to_images(tmp_path):
+    picks([("a", 0, 0, 1.0), ("b", 0, 0, 1.0)]).to_csv(tmp_path / "predicted.txt", sep="\t", index=False)
+    truth([("a", 1, 1), ("b", 50, 50)]).to_csv(tmp_path / "truth.txt", sep="\t", index=False)
+    summary = ep.evaluate(str(tmp_path / "predicted.txt"), str(tmp_path / "truth.txt"), 5,
+                          str(tmp_path / "evaluation"), images={"a"})
+    assert (summary["images"], summary["ground_truth"], summary["picks"], summary["matched"]) == (1, 1, 1, 1)
+    assert summary["average_precision"] == pytest.approx(1.0)
+    assert (tmp_path / "evaluation_curve.csv").exists() and (tmp_path / "evaluation_summary.csv").exists()
@@ -0,0 +1,87 @@
+import json
+import os
+
+import pytest
+
+from scripts import gallery_watch as gw
+
+HEADER = "image_name\tx_coord\ty_coord\tscore\n"
+
+@pytest.fixture
+def session(tmp_path):
+    (tmp_path / "raw").mkdir()
+    (tmp_path / "processed").mkdir()
+    watcher = gw.GalleryWatcher(str(tmp_path / "raw" / "*.mrc"), str(tmp_path / "watch_state.json"),
+                                str(tmp_path / "predicted_particles.txt"), settle=0)
+    return watcher, tmp_path
+
+def processed(tmp_path):
+    return lambda path: str(tmp_path / "processed" / os.path.basename(path))
+
+def gallery(tmp_path, name, preprocessed=False):
+    (tmp_path / "raw" / name).write_bytes(b"gallery")
+    if preprocessed:
+        (tmp_path / "processed" / name).write_bytes(b"gallery")
+    return str(tmp_path / "raw" / name)
+
+def test_new_gallery_is_ready_on_the_second_unchanged_poll(session):
+    watcher, tmp_path = session
+    assert watcher.restore(processed(tmp_path)) == 0
+    path = gallery(tmp_path, "g1.mrc")
+    assert watcher.poll() == []
+    assert watcher.poll() == [path]
+    with open(path, "ab") as f:
+        f.write(b"more")
+    assert watcher.poll() == []
+
+def test_append_picks_records_galleries(session):
+    watcher, tmp_path = session
+    watcher.restore(processed(tmp_path))
+    paths = [gallery(tmp_path, "g1.mrc"), gallery(tmp_path, "g2.mrc")]
+    watcher.poll()
+    (tmp_path / "batch.txt").write_text(HEADER + "g1\t1\t1\t0.5\ng1\t2\t2\t0.5\n")
+    assert watcher.append_picks(str(tmp_path / "batch.txt"), paths, "model_epoch10.sav") == 2
+    assert (tmp_path / "predicted_particles.txt").read_text() == HEADER + "g1\t1\t1\t0.5\ng1\t2\t2\t0.5\n"
+    state = json.loads((tmp_path / "watch_state.json").read_text())
+    assert [state["galleries"][path]["picks"] for path in paths] == [2, 0]
+    assert "appending" not in state
+    assert watcher.poll() == []
+
+def test_restore_truncates_an_unrecorded_append(session):
+    watcher, tmp_path = session
+    picked = HEADER + "g1\t1\t1\t0.5\n"
+    (tmp_path / "predicted_particles.txt").write_text(picked + "g2\t1\t1\t0.5\n")
+    (tmp_path / "watch_state.json").write_text(json.dumps(
+        {"galleries": {"g1": {"size": 7, "mtime_ns": 1, "model": None, "picks": 1}}, "failed": {},
+         "particles": None, "appending": len(picked)}))
+    assert watcher.restore(processed(tmp_path)) == 1
+    assert (tmp_path / "predicted_particles.txt").read_text() == picked
+    assert "appending" not in json.loads((tmp_path / "watch_state.json").read_text())
+
+def test_restore_without_state_counts_preprocessed_galleries_as_picked(session):
+    watcher, tmp_path = session
+    picked = gallery(tmp_path, "g1.mrc", preprocessed=True)
+    new = gallery(tmp_path, "g2.mrc")
+    (tmp_path / "predicted_particles.txt").write_text(HEADER + "g1\t1\t1\t0.5\n")
+    assert watcher.restore(processed(tmp_path)) == 1
+    assert list(json.loads((tmp_path / "watch_state.json").read_text())["galleries"]) == [picked]
+    watcher.poll()
+    assert watcher.poll() == [new]
+
+def test_restore_without_state_or_picks_starts_empty(session):
+    watcher, tmp_path = session
+    gallery(tmp_path, "g1.mrc", preprocessed=True)
+    assert watcher.restore(processed(tmp_path)) == 0
+    assert not (tmp_path / "watch_state.json").exists()
+
+def test_failed_gallery_is_retried_once_it_changes(session):
+    watcher, tmp_path = session
+    watcher.restore(processed(tmp_path))
+    path = gallery(tmp_path, "g1.mrc")
+    watcher.poll()
+    watcher.record_failed([path])
+    assert watcher.poll() == []
+    with open(path, "ab") as f:
+        f.write(b"rewritten")
+    watcher.poll()
+    assert watcher.poll() == [path]
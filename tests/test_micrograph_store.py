@@ -0,0 +1,75 @@
+import os
+
+import pytest
+
+from scripts import micrograph_store as ms
+
+@pytest.fixture
+def store(tmp_path):
+    return ms.MicrographStore(str(tmp_path / "micrograph_store"))
+
+def micrograph(tmp_path, name, size=100):
+    path = tmp_path / name
+    path.write_bytes(b"m" * size)
+    return str(path)
+
+def test_key_depends_on_raw_params_and_version():
+    key = ms.MicrographStore.key("abc", {"scale": 4}, "0.2.5")
+    assert key == ms.MicrographStore.key("abc", {"scale": 4}, "0.2.5")
+    assert key != ms.MicrographStore.key("abd", {"scale": 4}, "0.2.5")
+    assert key != ms.MicrographStore.key("abc", {"scale": 8}, "0.2.5")
+    assert key != ms.MicrographStore.key("abc", {"scale": 4}, "0.2.6")
+
+def test_put_then_link_into_another_run(store, tmp_path):
+    key = store.key("abc", {"scale": 4}, "0.2.5")
+    assert store.link(key, str(tmp_path / "missing.mrc")) is None
+    store.put(key, micrograph(tmp_path, "g1.mrc"), {"source": "g1.mrc"})
+    (tmp_path / "run2").mkdir()
+    dest = str(tmp_path / "run2" / "g1.mrc")
+    assert store.link(key, dest) == "hardlink"
+    assert os.path.samefile(dest, store.object_path(key))
+    # the object, the first run's output and the linked copy
+    assert os.stat(dest).st_nlink == 3
+
+def test_put_keeps_an_existing_object(store, tmp_path):
+    key = store.key("abc", {}, "0.2.5")
+    first = micrograph(tmp_path, "first.mrc")
+    store.put(key, first, {})
+    store.put(key, micrograph(tmp_path, "second.mrc", size=50), {})
+    assert os.path.samefile(first, store.object_path(key))
+
+def test_evict_least_recently_used_first(store, tmp_path):
+    keys = [store.key(str(i), {}, "0.2.5") for i in range(3)]
+    for i, key in enumerate(keys):
+        path = micrograph(tmp_path, f"g{i}.mrc")
+        store.put(key, path, {})
+        os.remove(path)
+        os.utime(store.object_path(key, ".json"), (1000 + i, 1000 + i))
+    # keys[0] is used again, so keys[1] is the least recently used
+    store.link(keys[0], str(tmp_path / "again.mrc"))
+    os.remove(str(tmp_path / "again.mrc"))
+
+    assert store.evict(200, dry_run=True) == (1, 100, 100)
+    assert len(store.entries()) == 3
+    assert store.evict(200) == (1, 100, 100)
+    assert [key for _, _, _, key in store.entries()] == [keys[2], keys[0]]
+
+def test_evict_keep_linked_skips_objects_used_by_a_run(store, tmp_path):
+    linked = store.key("linked", {}, "0.2.5")
+    store.put(linked, micrograph(tmp_path, "linked.mrc"), {})
+    os.utime(store.object_path(linked, ".json"), (1000, 1000))
+    unlinked = store.key("unlinked", {}, "0.2.5")
+    path = micrograph(tmp_path, "unlinked.mrc")
+    store.put(unlinked, path, {})
+    os.remove(path)
+
+    assert store.evict(100, keep_linked=True) == (1, 100, 100)
+    assert [key for _, _, _, key in store.entries()] == [linked]
+    # removing a hardlinked object frees no space, the run still holds the data
+    assert store.evict(0) == (1, 100, 0)
+
+def test_parse_and_format_size():
+    assert ms.parse_size("500G") == 500 * 1024 ** 3
+    assert ms.parse_size("1.5t") == int(1.5 * 1024 ** 4)
+    assert ms.parse_size("1024") == 1024
+    assert ms.format_size(1536) == "1.5K"
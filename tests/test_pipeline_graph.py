@@ -0,0 +1,64 @@
+import threading
+
+from scripts import pipeline_graph as pg
+
+def steps():
+    # preprocess -> convert -> train -> extract; visualize and evaluate both read the picks
+    return [
+        pg.PipelineStep("preprocess", None, ["raw/*.mrc"], ["micrographs/*.mrc"]),
+        pg.PipelineStep("convert", None, ["micrographs/*.mrc", "particles.txt"], ["targets.txt"]),
+        pg.PipelineStep("train", None, ["targets.txt"], ["models/model_epoch*.sav"]),
+        pg.PipelineStep("extract", None, ["models/model_epoch10.sav", "micrographs/*.mrc"], ["picks.txt"]),
+        pg.PipelineStep("visualize_picks", None, ["picks.txt"], ["*.png"]),
+        pg.PipelineStep("evaluate_picks", None, ["picks.txt", "targets.txt"], ["evaluation.csv"]),
+    ]
+
+def test_dependencies_follow_inputs_and_globs():
+    dependencies = pg.build_dependencies(steps())
+    assert dependencies["preprocess"] == []
+    assert dependencies["convert"] == ["preprocess"]
+    assert dependencies["extract"] == ["preprocess", "train"]
+    assert dependencies["evaluate_picks"] == ["convert", "extract"]
+
+def test_unselected_steps_are_not_dependencies():
+    selected = [step for step in steps() if step.name in ("extract", "visualize_picks")]
+    assert pg.build_dependencies(selected) == {"extract": [], "visualize_picks": ["extract"]}
+
+def test_all_steps_run_after_their_dependencies():
+    order = []
+    lock = threading.Lock()
+
+    def run_step(step):
+        with lock:
+            order.append(step.name)
+
+    status, errors = pg.run_graph(steps(), run_step, max_workers=3)
+    assert set(status.values()) == {"done"} and errors == {}
+    for name, dependencies in pg.build_dependencies(steps()).items():
+        assert all(order.index(dependency) < order.index(name) for dependency in dependencies)
+
+def test_failure_blocks_downstream_steps_only():
+    ran = []
+
+    def run_step(step):
+        ran.append(step.name)
+        if step.name == "train":
+            raise RuntimeError("out of memory")
+
+    status, errors = pg.run_graph(steps(), run_step, max_workers=2)
+    assert status == {"preprocess": "done", "convert": "done", "train": "failed", "extract": "blocked",
+                      "visualize_picks": "blocked", "evaluate_picks": "blocked"}
+    assert isinstance(errors["train"], RuntimeError) and list(errors) == ["train"]
+    assert "extract" not in ran
+
+def test_independent_steps_run_concurrently():
+    both_started = threading.Barrier(2, timeout=5)
+
+    def run_step(step):
+        if step.name in ("visualize_picks", "evaluate_picks"):
+            # fails with BrokenBarrierError unless the two steps overlap
+            both_started.wait()
+
+    selected = [step for step in steps() if step.name in ("extract", "visualize_picks", "evaluate_picks")]
+    status, errors = pg.run_graph(selected, run_step, max_workers=2)
+    assert errors == {}
@@ -0,0 +1,46 @@
+from scripts import sharding
+
+def write_files(tmp_path, sizes):
+    paths = []
+    for name, size in sizes.items():
+        path = tmp_path / (name + ".mrc")
+        path.write_bytes(b"x" * size)
+        paths.append(str(path))
+    return paths
+
+def test_balanced_shards_split_by_size(tmp_path):
+    paths = write_files(tmp_path, {"g_00": 900, "g_01": 500, "g_02": 400, "g_03": 300, "g_04": 200})
+    shards = sharding.balanced_shards(paths, 2)
+    totals = sorted(sum(len(open(path, "rb").read()) for path in shard) for shard in shards)
+    assert totals == [1100, 1200]
+    assert sorted(path for shard in shards for path in shard) == sorted(paths)
+    assert all(shard == sorted(shard) for shard in shards)
+
+def test_balanced_shards_never_returns_empty_shards(tmp_path):
+    paths = write_files(tmp_path, {"g_00": 10, "g_01": 10})
+    assert len(sharding.balanced_shards(paths, 8)) == 2
+    assert sharding.balanced_shards(paths, 0) == [sorted(paths)]
+
+def test_shard_list_expands_back(tmp_path):
+    paths = write_files(tmp_path, {"g_00": 10, "g_01": 10})
+    argument = sharding.write_shard_list(paths, str(tmp_path / "shard.txt"))
+    assert argument == "@" + str(tmp_path / "shard.txt")
+    assert sharding.expand_images(argument) == paths
+
+def test_merge_particle_files_orders_images_and_keeps_picks(tmp_path):
+    header = "image_name\tx_coord\ty_coord\tscore\n"
+    (tmp_path / "shard_0.txt").write_text(header + "g_02\t5\t5\t1.5\ng_00\t1\t1\t2.0\ng_00\t9\t9\t0.5\n")
+    (tmp_path / "shard_1.txt").write_text(header + "g_01\t3\t3\t1.0\n\n")
+    (tmp_path / "shard_2.txt").write_text(header)
+    output = str(tmp_path / "picks.txt")
+    count = sharding.merge_particle_files([str(tmp_path / f"shard_{i}.txt") for i in range(3)], output)
+    assert count == 4
+    assert open(output).read() == header + "g_00\t1\t1\t2.0\ng_00\t9\t9\t0.5\ng_01\t3\t3\t1.0\ng_02\t5\t5\t1.5\n"
+
+def test_merge_particle_files_in_place(tmp_path):
+    header = "image_name\tx_coord\ty_coord\tscore\n"
+    picks = tmp_path / "picks.txt"
+    picks.write_text(header + "g_01\t3\t3\t1.0\ng_00\t1\t1\t2.0\n")
+    assert sharding.merge_particle_files([str(picks)], str(picks)) == 2
+    assert picks.read_text() == header + "g_00\t1\t1\t2.0\ng_01\t3\t3\t1.0\n"
+    assert not (tmp_path / "picks.txt.tmp").exists()
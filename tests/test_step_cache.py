@@ -0,0 +1,70 @@
+import json
+import os
+
+import pytest
+
+from scripts import step_cache as sc
+
+@pytest.fixture
+def step(tmp_path):
+    (tmp_path / "in.txt").write_text("galleries\n")
+    (tmp_path / "out.txt").write_text("picks\n")
+    cache = sc.StepCache(str(tmp_path / ".step_cache"))
+    return cache, str(tmp_path / "in.txt"), str(tmp_path / "out.txt")
+
+def run(cache, inputs, outputs, fields=None):
+    current, reason, manifest = cache.check("extract", fields or {"extract_radius": 10}, inputs)
+    if not current:
+        cache.record("extract", manifest, outputs)
+    return current, reason
+
+def test_first_run_has_no_manifest(step):
+    cache, input_path, output_path = step
+    assert run(cache, [input_path], [output_path]) == (False, "no recorded manifest")
+    assert run(cache, [input_path], [output_path]) == (True, "inputs unchanged")
+
+def test_same_bytes_with_new_mtime_is_current(step):
+    cache, input_path, output_path = step
+    run(cache, [input_path], [output_path])
+    with open(input_path, "w") as f:
+        f.write("galleries\n")
+    os.utime(input_path, ns=(1, 10 ** 18))
+    assert run(cache, [input_path], [output_path]) == (True, "inputs unchanged")
+    # the new mtime is recorded, so the file is not hashed again
+    recorded = json.load(open(cache.manifest_path("extract")))
+    assert recorded["inputs"]["files"][input_path]["mtime_ns"] == 10 ** 18
+
+def test_changed_content_reruns(step):
+    cache, input_path, output_path = step
+    run(cache, [input_path], [output_path])
+    with open(input_path, "w") as f:
+        f.write("more galleries\n")
+    assert run(cache, [input_path], [output_path]) == (False, "input changed " + input_path)
+
+def test_changed_parameter_reruns(step):
+    cache, input_path, output_path = step
+    run(cache, [input_path], [output_path])
+    assert run(cache, [input_path], [output_path], {"extract_radius": 12}) == \
+        (False, "parameter changed extract_radius")
+
+def test_missing_input_and_changed_output(step):
+    cache, input_path, output_path = step
+    run(cache, [input_path], [output_path])
+    with open(output_path, "a") as f:
+        f.write("edited\n")
+    assert run(cache, [input_path], [output_path]) == (False, "output changed " + output_path)
+    os.remove(input_path)
+    assert run(cache, [input_path], [output_path]) == (False, "missing input " + input_path)
+
+def test_glob_inputs_track_the_file_set(step, tmp_path):
+    cache, input_path, output_path = step
+    pattern = str(tmp_path / "*.txt")
+    run(cache, [pattern], [output_path])
+    (tmp_path / "new.txt").write_text("gallery\n")
+    assert run(cache, [pattern], [output_path]) == (False, "input file set changed")
+
+def test_invalidate_forgets_the_step(step):
+    cache, input_path, output_path = step
+    run(cache, [input_path], [output_path])
+    cache.invalidate("extract")
+    assert run(cache, [input_path], [output_path]) == (False, "no recorded manifest")
@@ -0,0 +1,155 @@
+import os
+
+import pytest
+
+from scripts import training_metrics as tm
+
+HEADER = "epoch\titer\tsplit\tloss\tge_penalty\tprecision\tadjusted_precision\ttpr\tfpr\tauprc\n"
+
+def rows(epochs, iterations_per_epoch=2, auprc=None):
+    lines = []
+    for epoch in epochs:
+        for step in range(1, iterations_per_epoch + 1):
+            iteration = (epoch - 1) * iterations_per_epoch + step
+            lines.append(f"{epoch}\t{iteration}\ttrain\t0.5\t-\t0.5\t0.5\t0.5\t0.1\t-\n")
+        value = auprc[epoch] if auprc else 0.5 + epoch / 100
+        lines.append(f"{epoch}\t{epoch * iterations_per_epoch}\ttest\t0.4\t-\t0.6\t0.6\t0.6\t0.1\t{value}\n")
+    return "".join(lines)
+
+def logged_epochs(log_path, split="test"):
+    with open(log_path) as f:
+        return [int(line.split("\t")[0]) for line in f.readlines()[1:] if line.split("\t")[2] == split]
+
+@pytest.fixture
+def training(tmp_path, monkeypatch):
+    # a checkpoint is complete when it holds b"model", no topaz needed
+    monkeypatch.setattr(tm, "checkpoint_loads", lambda path: open(path, "rb").read() == b"model")
+    prefix = str(tmp_path / "model")
+    return prefix, str(tmp_path / "model_training.txt"), str(tmp_path / "training_state.json")
+
+def save(path, content=b"model"):
+    with open(path, "wb") as f:
+        f.write(content)
+
+def test_checkpoint_name_pads_like_topaz(tmp_path):
+    assert tm.checkpoint_name("model", 1, 1) == "model_epoch1.sav"
+    assert tm.checkpoint_name("model", 10, 3) == "model_epoch3.sav"
+    assert tm.checkpoint_name("model", 11, 3) == "model_epoch03.sav"
+    assert tm.checkpoint_name("model", 200, 7) == "model_epoch007.sav"
+
+def test_resume_after_the_last_checkpoint(training):
+    prefix, log_path, state_file = training
+    for epoch in (1, 2, 3):
+        save(tm.checkpoint_name(prefix, 10, epoch))
+    with open(log_path, "w") as f:
+        f.write(HEADER + rows([1, 2, 3, 4]))
+    tm.write_state(state_file, {"training": {"radius": 3}})
+
+    assert tm.resume_epoch(prefix, log_path, state_file, {"radius": 3}, 10) == 3
+    # epoch 4 is trained again
+    assert logged_epochs(log_path) == [1, 2, 3]
+
+def test_changed_training_starts_over(training):
+    prefix, log_path, state_file = training
+    save(tm.checkpoint_name(prefix, 10, 1))
+    tm.write_state(state_file, {"training": {"radius": 3}})
+    assert tm.resume_epoch(prefix, log_path, state_file, {"radius": 4}, 10) == 0
+
+def test_finished_or_early_stopped_training_starts_over(training):
+    prefix, log_path, state_file = training
+    for epoch in (1, 2):
+        save(tm.checkpoint_name(prefix, 2, epoch))
+    tm.write_state(state_file, {"training": {"radius": 3}})
+    assert tm.resume_epoch(prefix, log_path, state_file, {"radius": 3}, 2) == 0
+    tm.write_state(state_file, {"training": {"radius": 3}, "early_stopped": {"stop_epoch": 2}})
+    assert tm.resume_epoch(prefix, log_path, state_file, {"radius": 3}, 10) == 0
+
+def test_truncated_checkpoint_falls_back_to_the_previous_epoch(training):
+    prefix, log_path, state_file = training
+    save(tm.checkpoint_name(prefix, 10, 1))
+    save(tm.checkpoint_name(prefix, 10, 2))
+    save(tm.checkpoint_name(prefix, 10, 3), b"mod")
+    with open(log_path, "w") as f:
+        f.write(HEADER + rows([1, 2, 3]))
+    tm.write_state(state_file, {"training": {"radius": 3}})
+
+    assert tm.resume_epoch(prefix, log_path, state_file, {"radius": 3}, 10) == 2
+    assert not os.path.exists(tm.checkpoint_name(prefix, 10, 3))
+    assert logged_epochs(log_path) == [1, 2]
+
+def test_fold_resumed_renumbers_checkpoints_and_log(training):
+    prefix, log_path, state_file = training
+    for epoch in (1, 2):
+        save(tm.checkpoint_name(prefix, 5, epoch))
+    # the resumed training finished 2 of its 3 epochs, and left a partial third checkpoint name behind
+    for epoch in (1, 2):
+        save(tm.checkpoint_name(prefix + "_resume", 3, epoch))
+    with open(log_path, "w") as f:
+        f.write(HEADER + rows([1, 2, 3]))
+    with open(tm.resume_log_path(log_path), "w") as f:
+        f.write(HEADER + rows([1, 2]))
+    tm.write_state(state_file, {"training": {"radius": 3}, "resume": {"offset": 2, "num_epochs": 3}})
+
+    tm.fold_resumed(prefix, log_path, state_file)
+
+    assert sorted(tm.checkpoints(prefix)) == [1, 2, 3, 4]
+    assert tm.checkpoints(prefix + "_resume") == {}
+    assert logged_epochs(log_path) == [1, 2, 3, 4]
+    # iterations continue from the last train row of epoch 2
+    assert [int(line.split("\t")[1]) for line in open(log_path).readlines()[1:]][-3:] == [7, 8, 8]
+    assert not os.path.exists(tm.resume_log_path(log_path))
+    assert "resume" not in tm.read_state(state_file)
+
+def test_best_epoch_by_metric(training):
+    prefix, log_path, state_file = training
+    with open(log_path, "w") as f:
+        f.write(HEADER + rows([1, 2, 3], auprc={1: 0.7, 2: 0.9, 3: 0.8}))
+    assert tm.best_epoch(log_path, "auprc", [1, 2, 3]) == (2, 0.9)
+    assert tm.best_epoch(log_path, "auprc", [1, 3]) == (3, 0.8)
+    with pytest.raises(ValueError):
+        tm.best_epoch(log_path, "f1", [1, 2, 3])
+
+def test_read_test_metrics_skips_a_partial_last_line(training):
+    prefix, log_path, state_file = training
+    with open(log_path, "w") as f:
+        f.write(HEADER + rows([1, 2]) + "3\t6\ttest\t0.4")
+    assert tm.read_test_metrics(log_path).index.tolist() == [1, 2]
+
+def test_early_stopping_after_patience_epochs(training):
+    prefix, log_path, state_file = training
+    monitor = tm.EarlyStoppingMonitor(log_path, "auprc", patience=2)
+    with open(log_path, "w") as f:
+        f.write(HEADER + rows([1, 2, 3], auprc={1: 0.7, 2: 0.9, 3: 0.85}))
+    assert not monitor.poll()
+    with open(log_path, "a") as f:
+        f.write(rows([4], auprc={4: 0.88}))
+    assert monitor.poll()
+    assert (monitor.best_epoch, monitor.stop_epoch) == (2, 4)
+
+def test_early_stopping_rejects_a_patience_below_one(training):
+    prefix, log_path, state_file = training
+    with pytest.raises(ValueError):
+        tm.EarlyStoppingMonitor(log_path, "auprc", patience=0)
+
+def test_early_stopping_survives_an_unparsable_log(training):
+    prefix, log_path, state_file = training
+    monitor = tm.EarlyStoppingMonitor(log_path, "auprc", patience=1)
+    with open(log_path, "w") as f:
+        f.write(HEADER + "1\t1" + "\t0" * 20 + "\n")
+    assert not monitor.poll()
+    with open(log_path, "w") as f:
+        f.write(HEADER + rows([1, 2], auprc={1: 0.9, 2: 0.8}))
+    assert monitor.poll()
+
+def test_record_early_stop_keeps_the_best_checkpoint(training):
+    prefix, log_path, state_file = training
+    for epoch in (1, 2, 3, 4):
+        save(tm.checkpoint_name(prefix, 10, epoch))
+    monitor = tm.EarlyStoppingMonitor(log_path, "auprc", patience=1)
+    monitor.best_epoch, monitor.best_value, monitor.stop_epoch = 4, 0.9, 4
+    tm.record_early_stop(prefix, state_file, monitor)
+    assert sorted(tm.checkpoints(prefix)) == [1, 2, 3, 4]
+    monitor.best_epoch, monitor.stop_epoch = 2, 3
+    tm.record_early_stop(prefix, state_file, monitor)
+    assert sorted(tm.checkpoints(prefix)) == [1, 2]
+    assert tm.read_state(state_file)["early_stopped"]["best_epoch"] == 2